@@ -0,0 +1,448 @@
+"""
+Load tests every route of the API on a seeded question bank.
+
+For each table size the routes are driven sequentially through the Flask
+test client, then concurrently over HTTP against a local threaded server
+running the Flask app and against a uvicorn server running the ASGI app.
+The p50 and p99 latencies, the throughput and the number of SQL statements
+per request are reported as JSON, which can be compared with the JSON of a
+previous run with --baseline.
+
+Usage, from the backend directory:
+    python -m benchmarks.api --output results.json
+    python -m benchmarks.api --sizes 1000 --routes quizzes,search
+    python -m benchmarks.api --baseline results.json
+    python -m benchmarks.api --database-url postgresql://localhost/bench
+
+The batch update and delete scenarios work on the questions imported by
+the import scenario, select it along with them.
+"""
+import argparse
+import http.client
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import uvicorn
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from werkzeug.serving import make_server
+
+from flaskr import create_app
+from flaskr.asgi import AsyncTrivia
+from flaskr.models import db
+from benchmarks.seed import seed, vocabulary
+
+PROFILE_TOKEN = 'benchmark'  # Token of the profiled requests.
+BATCH_SIZE = 10  # Questions imported, updated and deleted per request.
+
+
+class StatementCounter:
+    """Counts the SQL statements executed by every engine of the process."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(Engine, 'after_cursor_execute', self._count)
+
+    def _count(self, *args):
+        with self._lock:
+            self.count += 1
+
+
+def scenarios(size, categories, seed_value=0):
+    """
+    returns: a dict mapping route names to callables issuing one request of
+    the route through the send callable they are given.
+    """
+    rng = random.Random(seed_value)
+    words = vocabulary()
+    pages = max(1, min(size // 10, 100))
+    created = deque()
+    imported = deque()
+    numbers = itertools.count()
+    lock = threading.Lock()
+    profiled = {'headers': {'X-Profile-Token': PROFILE_TOKEN}}
+
+    # Statuses of the requests which legitimately find nothing.
+    not_found = {'expected': (404,)}
+
+    def start_quiz(send):
+        send('POST', '/quizzes', {
+            'previous_questions': [],
+            'quiz_category': {'type': '', 'id': rng.randint(0, categories)}})
+
+    quiz = {}
+
+    def next_quiz_question(send):
+        if 'quiz_session' not in quiz:
+            quiz['quiz_session'] = send('POST', '/quizzes', {
+                'previous_questions': [],
+                'quiz_category': {'type': '', 'id': 1}},
+                measure=False)[1]['quiz_session']
+        send('POST', '/quizzes', dict(quiz, previous_questions=[],
+                                      quiz_category={'type': '', 'id': 1}))
+
+    def create_question(send):
+        status, data = send('POST', '/questions', {
+            'question': f'Benchmark question {next(numbers)} '
+                        f'{rng.random()}?',
+            'answer': 'benchmark',
+            'category': str(rng.randint(1, categories)),
+            'difficulty': rng.randint(1, 5)})
+        if status == 201:
+            created.append(data['question_id'])
+
+    def delete_question(send):
+        try:
+            question_id = created.popleft()
+        except IndexError:
+            return
+        send('DELETE', f'/questions/{question_id}', None)
+
+    def quiz_round(send):
+        send('POST', '/quizzes/round', {
+            'quiz_category': {'type': '', 'id': rng.randint(0, categories)},
+            'size': rng.choice([5, 10])}, **not_found)
+
+    def adaptive_question(send):
+        send('POST', '/quizzes/adaptive', {
+            'quiz_category': {'type': '', 'id': rng.randint(0, categories)},
+            'answers': [{'difficulty': rng.randint(1, 5),
+                         'correct': rng.random() < 0.5}
+                        for _ in range(3)]}, **not_found)
+
+    def suggest(send):
+        word = rng.choice(words[:200])
+        prefix = quote(word[:rng.randint(1, len(word))])
+        send('GET', f'/search/suggest?prefix={prefix}', None)
+
+    feed = {}
+
+    def start_revision(send):
+        """returns: the revision current before the import scenario"""
+        with lock:
+            if 'revision' not in feed:
+                feed['revision'] = send('GET', '/changes', None,
+                                        measure=False)[1]['revision']
+        return feed['revision']
+
+    def import_questions(send):
+        start_revision(send)
+        lines = ''.join(json.dumps({
+            'question': f'Imported question {next(numbers)} {rng.random()}?',
+            'answer': 'benchmark',
+            'category': rng.randint(1, categories),
+            'difficulty': rng.randint(1, 5)}) + '\n'
+            for _ in range(BATCH_SIZE))
+        send('POST', '/questions/import?format=ndjson', lines.encode())
+
+    def imported_ids(send):
+        """
+        returns: the ids of the questions imported so far, read once from
+        the change feed.
+        """
+        with lock:
+            if 'ids' not in feed and 'revision' in feed:
+                feed['ids'] = True
+                since, more = feed['revision'], True
+                while more:
+                    data = send('GET', f'/changes?since={since}', None,
+                                measure=False)[1]
+                    imported.extend(
+                        change['id'] for change in data['changes']
+                        if change['table'] == 'questions' and
+                        change['row'] is not None)
+                    since, more = data['revision'], data['more']
+        return list(imported)
+
+    def update_questions(send):
+        ids = imported_ids(send)
+        if not ids:
+            return
+        send('PATCH', '/questions', {
+            'ids': rng.sample(ids, min(BATCH_SIZE, len(ids))),
+            'values': {'difficulty': rng.randint(1, 5)}})
+
+    def delete_questions(send):
+        imported_ids(send)
+        ids = []
+        while len(ids) < BATCH_SIZE:
+            try:
+                ids.append(imported.popleft())
+            except IndexError:
+                break
+        if ids:
+            send('DELETE', '/questions', {'ids': ids})
+
+    def changes(send):
+        send('GET', f'/changes?since={rng.randint(0, start_revision(send))}'
+                    f'&limit=100', None)
+
+    return {
+        'categories': lambda send: send('GET', '/categories', None),
+        'questions': lambda send: send(
+            'GET', f'/questions?page={rng.randint(1, pages)}', None),
+        'questions after': lambda send: send(
+            'GET', f'/questions?after={rng.randint(0, size)}', None,
+            **not_found),
+        'category questions': lambda send: send(
+            'GET', f'/categories/{rng.randint(1, categories)}/questions',
+            None),
+        'search': lambda send: send('POST', '/search', {
+            'searchTerm': rng.choice(words[:200])}, **not_found),
+        'search suggest': suggest,
+        'quizzes start': start_quiz,
+        'quizzes next': next_quiz_question,
+        'quizzes round': quiz_round,
+        'quizzes adaptive': adaptive_question,
+        'stats': lambda send: send('GET', '/stats', None),
+        'metrics': lambda send: send('GET', '/metrics', None),
+        'profiled questions': lambda send: send(
+            'GET', f'/questions?page={rng.randint(1, pages)}', None,
+            **profiled),
+        'profiles': lambda send: send('GET', '/admin/profiles', None,
+                                      **profiled),
+        'create question': create_question,
+        'delete question': delete_question,
+        'import': import_questions,
+        'changes': changes,
+        'update questions': update_questions,
+        'delete questions': delete_questions,
+        'export': lambda send: send('GET', '/questions/export', None),
+    }
+
+
+def summarize(latencies, duration, statements, errors, statuses):
+    if len(latencies) > 1:
+        quantiles = statistics.quantiles(latencies, n=100)
+        p50, p99 = quantiles[49], quantiles[98]
+    else:
+        p50 = p99 = latencies[0] if latencies else 0
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'statuses': {str(status): count
+                     for status, count in sorted(statuses.items())},
+        'p50_ms': round(p50 * 1000, 3),
+        'p99_ms': round(p99 * 1000, 3),
+        'throughput_rps': round(len(latencies) / duration, 1)
+        if duration else 0,
+        'queries_per_request': round(statements / len(latencies), 2)
+        if latencies else 0
+    }
+
+
+class Recorder:
+    """
+    Wraps a send callable to time the requests it issues and count their
+    statuses. Every 4xx and 5xx status is an error, unless the scenario
+    expects it.
+    """
+
+    def __init__(self, send):
+        self._send = send
+        self.latencies = []
+        self.errors = 0
+        self.statuses = Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, method, path, body, measure=True, expected=(),
+                 headers=None):
+        start = time.perf_counter()
+        status, data = self._send(method, path, body, headers)
+        duration = time.perf_counter() - start
+        if measure:
+            with self._lock:
+                self.latencies.append(duration)
+                self.statuses[status] += 1
+                if status >= 400 and status not in expected:
+                    self.errors += 1
+        return status, data
+
+
+def test_client_sender(app):
+    client = app.test_client()
+
+    def send(method, path, body, headers=None):
+        if isinstance(body, bytes):
+            response = client.open(path, method=method, data=body,
+                                   headers=headers)
+        else:
+            response = client.open(path, method=method, json=body,
+                                   headers=headers)
+        response.get_data()
+        return response.status_code, response.get_json(silent=True)
+    return send
+
+
+def http_sender(port):
+    def send(method, path, body, headers=None):
+        if body is not None and not isinstance(body, bytes):
+            body = json.dumps(body)
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        try:
+            connection.request(
+                method, path, body=body,
+                headers=dict({'Content-Type': 'application/json'},
+                             **(headers or {})))
+            response = connection.getresponse()
+            data = response.read()
+        finally:
+            connection.close()
+        try:
+            data = json.loads(data)
+        except ValueError:
+            data = None
+        return response.status, data
+    return send
+
+
+def serve_asgi(app):
+    """
+    Start a uvicorn server of the ASGI app in a thread.
+    returns: the server and its port.
+    """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(
+        AsyncTrivia(app), host='127.0.0.1', port=port, log_level='error',
+        lifespan='on'))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return server, port
+
+
+def run(database_url, size, categories, routes, requests, concurrency,
+        counter):
+    app = create_app({'TESTING': True,
+                      'SQLALCHEMY_DATABASE_URI': database_url,
+                      'PROFILE_TOKEN': PROFILE_TOKEN})
+    with app.app_context():
+        seed(db.engine, size, categories)
+
+    results = []
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    asgi_server, asgi_port = serve_asgi(app)
+    try:
+        modes = (('test client', test_client_sender(app), 1),
+                 ('http', http_sender(server.server_port), concurrency),
+                 ('asgi', http_sender(asgi_port), concurrency))
+        for mode, send, workers in modes:
+            routes_of_size = scenarios(size, categories)
+            for route, scenario in routes_of_size.items():
+                if routes and not any(name in route for name in routes):
+                    continue
+                recorder = Recorder(send)
+                statements = counter.count
+                start = time.perf_counter()
+                with ThreadPoolExecutor(workers) as executor:
+                    list(executor.map(lambda _: scenario(recorder),
+                                      range(requests)))
+                duration = time.perf_counter() - start
+                results.append(dict(
+                    {'questions': size, 'route': route, 'mode': mode,
+                     'concurrency': workers},
+                    **summarize(recorder.latencies, duration,
+                                counter.count - statements,
+                                recorder.errors, recorder.statuses)))
+    finally:
+        server.shutdown()
+        asgi_server.should_exit = True
+    return results
+
+
+def commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    previous = {}
+    if baseline:
+        previous = {(result['questions'], result['route'], result['mode']):
+                    result for result in baseline['results']}
+    print(f"{'questions':>10} {'mode':>11} {'route':>18} {'p50 ms':>9} "
+          f"{'p99 ms':>9} {'req/s':>8} {'queries':>8} {'errors':>7}"
+          + (f" {'p50 vs base':>12}" if baseline else ''))
+    for result in results:
+        line = (f"{result['questions']:>10} {result['mode']:>11} "
+                f"{result['route']:>18} {result['p50_ms']:>9} "
+                f"{result['p99_ms']:>9} {result['throughput_rps']:>8} "
+                f"{result['queries_per_request']:>8} {result['errors']:>7}")
+        before = previous.get(
+            (result['questions'], result['route'], result['mode']))
+        if before and before['p50_ms']:
+            line += f" {result['p50_ms'] / before['p50_ms']:>11.2f}x"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', default='1000,100000,1000000',
+                        help='comma separated numbers of questions')
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route and mode')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='client threads of the http mode')
+    parser.add_argument('--routes',
+                        help='comma separated route names to run, all '
+                             'routes by default')
+    parser.add_argument('--database-url',
+                        help='db to benchmark, a temporary SQLite file '
+                             'by default. Its tables are dropped!')
+    parser.add_argument('--output', help='file receiving the JSON results')
+    parser.add_argument('--baseline',
+                        help='JSON results of a previous run to compare with')
+    args = parser.parse_args()
+
+    counter = StatementCounter()
+    routes = args.routes.split(',') if args.routes else None
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = args.database_url or \
+            'sqlite:///' + os.path.join(directory, 'bench.db')
+        results = []
+        for size in map(int, args.sizes.split(',')):
+            results += run(database_url, size, args.categories, routes,
+                           args.requests, args.concurrency, counter)
+
+    report = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'database': database_url.split(':', 1)[0],
+        'results': results
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""
+Measures the CPU cost of compressing the responses against the bytes saved.
+
+The bodies of the main read routes are fetched from a seeded question bank
+and compressed with every available encoding at several levels. For each
+one the compressed size, the share of bytes saved and the CPU time spent
+per response and per KB saved are printed. The CPU time of whole requests
+is then compared without compression, with compression, and with the
+compressed body of cached pages reused from the response cache.
+
+Usage, from the backend directory:
+    python -m benchmarks.compression
+    python -m benchmarks.compression --questions 100000 --runs 200
+    python -m benchmarks.compression --database-url postgresql://localhost/bench
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+from flaskr import create_app
+from flaskr.compression import compress, encodings
+from benchmarks.seed import seed, vocabulary
+
+LEVELS = {'gzip': (1, 6, 9), 'br': (1, 4, 11)}
+
+
+def routes(categories):
+    """
+    returns: a dict mapping route names to the (method, path, json) of
+    their request.
+    """
+    word = vocabulary()[0]
+    return {
+        'questions': ('GET', '/questions?page=2', None),
+        'category': ('GET', f'/categories/{categories}/questions?page=2',
+                     None),
+        'search': ('POST', '/search', {'searchTerm': word}),
+        'export_ndjson': ('GET', '/questions/export?format=ndjson', None),
+        'export_csv': ('GET', '/questions/export?format=csv', None),
+    }
+
+
+def cpu_per_call(function, runs):
+    """returns: the CPU time of a call of function, in microseconds"""
+    function()  # Warm the caches and connections up.
+    start = time.process_time()
+    for _ in range(runs):
+        function()
+    return (time.process_time() - start) / runs * 1e6
+
+
+def measure_bodies(client, requests, runs):
+    """
+    returns: a list of dicts of the size and CPU cost of the body of each
+    route, compressed with each encoding and level.
+    """
+    results = []
+    for name, (method, path, body) in requests.items():
+        data = client.open(path, method=method, json=body).get_data()
+        for encoding in encodings():
+            for level in LEVELS[encoding]:
+                compressed = compress(data, encoding, level)
+                # The slow levels are measured on fewer runs.
+                cpu = cpu_per_call(lambda: compress(data, encoding, level),
+                                   max(1, runs // (10 if level > 9 else 1)))
+                saved = len(data) - len(compressed)
+                results.append({
+                    'route': name,
+                    'encoding': f'{encoding}-{level}',
+                    'bytes': len(data),
+                    'compressed': len(compressed),
+                    'saved_percent': 100 * saved / len(data) if data else 0,
+                    'cpu_us': cpu,
+                    'cpu_us_per_kb_saved': cpu / (saved / 1024)
+                    if saved > 0 else None
+                })
+    return results
+
+
+def measure_requests(database_url, requests, runs):
+    """
+    returns: a dict mapping route names to the CPU time of a request, in
+    microseconds, without compression, with gzip and with gzip once the
+    page is cached, None for the routes that aren't cached.
+    """
+    identity = create_app({'SQLALCHEMY_DATABASE_URI': database_url,
+                           'COMPRESSION': False,
+                           'RESPONSE_CACHE_SIZE': 0}).test_client()
+    compressed = create_app({'SQLALCHEMY_DATABASE_URI': database_url,
+                             'RESPONSE_CACHE_SIZE': 0}).test_client()
+    cached = create_app({'SQLALCHEMY_DATABASE_URI': database_url}) \
+        .test_client()
+    gzip = {'Accept-Encoding': 'gzip'}
+
+    results = {}
+    for name, (method, path, body) in requests.items():
+        if name.startswith('export'):
+            continue
+        results[name] = {
+            label: cpu_per_call(
+                lambda: client.open(path, method=method, json=body,
+                                    headers=headers).get_data(), runs)
+            for label, client, headers in (
+                ('identity', identity, {}),
+                ('gzip', compressed, gzip),
+                ('gzip_cached', cached, gzip))
+            if method == 'GET' or label != 'gzip_cached'}
+    return results
+
+
+def print_results(bodies, requests):
+    print(f"{'route':>14} {'encoding':>9} {'bytes':>10} {'compressed':>10} "
+          f"{'saved %':>8} {'cpu us':>10} {'us/KB saved':>12}")
+    for result in bodies:
+        per_kb = result['cpu_us_per_kb_saved']
+        print(f"{result['route']:>14} {result['encoding']:>9} "
+              f"{result['bytes']:>10} {result['compressed']:>10} "
+              f"{result['saved_percent']:>8.1f} {result['cpu_us']:>10.1f} "
+              f"{per_kb if per_kb is None else round(per_kb, 2)!s:>12}")
+    print()
+    print(f"{'route':>14} {'identity us':>12} {'gzip us':>10} "
+          f"{'cached gzip us':>15}")
+    for name, result in requests.items():
+        cached = result.get('gzip_cached')
+        print(f"{name:>14} {result['identity']:>12.1f} {result['gzip']:>10.1f} "
+              f"{'-' if cached is None else round(cached, 1)!s:>15}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--questions', type=int, default=10000,
+                        help='questions seeded before the runs')
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--runs', type=int, default=100,
+                        help='compressions or requests per measure')
+    parser.add_argument('--database-url',
+                        help='db to benchmark, a temporary SQLite file '
+                             'by default. Its tables are dropped!')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = args.database_url or \
+            'sqlite:///' + os.path.join(directory, 'bench.db')
+        seed(create_engine(database_url), args.questions, args.categories)
+        requests = routes(args.categories)
+        client = create_app({'SQLALCHEMY_DATABASE_URI': database_url,
+                             'COMPRESSION': False}).test_client()
+        bodies = measure_bodies(client, requests, args.runs)
+        timings = measure_requests(database_url, requests, args.runs)
+
+    print_results(bodies, timings)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Compares the /search backends with the original ilike search.
+
+Every backend available for the database is timed on a frequent word, a
+rare word and a two words term at each table size. Results are printed as a
+table and written as JSON lines when --output is given.
+
+Usage, from the backend directory:
+    python -m benchmarks.search
+    python -m benchmarks.search --sizes 10000,100000
+    python -m benchmarks.search --database-url postgresql://localhost/bench
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+
+from flask import Flask, request
+
+from flaskr.models import db, setup_db
+from flaskr.search import SEARCH_BACKENDS
+from benchmarks.seed import seed, vocabulary
+
+POSTGRES_BACKENDS = ('fulltext', 'trigram')
+
+
+def timed(function, repeat):
+    """returns: the median duration of function in milliseconds."""
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append((time.perf_counter() - start) * 1000)
+    return statistics.median(durations)
+
+
+def run(database_url, size, repeat):
+    app = Flask(__name__)
+    setup_db(app, database_url)
+    seed(db.engine, size)
+
+    words = vocabulary()
+    terms = {
+        'frequent': words[0],
+        'rare': words[len(words) // 2],
+        'two words': f'{words[1]} {words[10]}'
+    }
+    results = []
+    for name, backend in SEARCH_BACKENDS.items():
+        if name in POSTGRES_BACKENDS and db.engine.dialect.name != 'postgresql':
+            continue
+
+        engine = backend()
+        with app.app_context():
+            setup = timed(engine.prepare, 1)
+            if name == 'memory':
+                setup += timed(engine.load, 1)
+            for label, term in terms.items():
+                with app.test_request_context('/search'):
+                    total = engine.search(request, term)[1]
+                    duration = timed(
+                        lambda: engine.search(request, term), repeat)
+                results.append({
+                    'questions': size,
+                    'backend': name,
+                    'term': label,
+                    'matches': total,
+                    'median_ms': round(duration, 3),
+                    'setup_ms': round(setup, 1)
+                })
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', default='10000,100000,1000000',
+                        help='comma separated numbers of questions')
+    parser.add_argument('--database-url',
+                        help='db to benchmark, a temporary SQLite file '
+                             'by default. Its tables are dropped!')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--output', help='file receiving JSON lines')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = args.database_url or \
+            'sqlite:///' + os.path.join(directory, 'bench.db')
+        results = []
+        for size in map(int, args.sizes.split(',')):
+            results += run(database_url, size, args.repeat)
+
+    print(f"{'questions':>10} {'backend':>9} {'term':>10} {'matches':>8} "
+          f"{'median ms':>10} {'setup ms':>10}")
+    for result in results:
+        print(f"{result['questions']:>10} {result['backend']:>9} "
+              f"{result['term']:>10} {result['matches']:>8} "
+              f"{result['median_ms']:>10} {result['setup_ms']:>10}")
+    if args.output:
+        with open(args.output, 'w') as output:
+            for result in results:
+                output.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Helpers generating a synthetic question bank for the benchmarks.
+"""
+import random
+
+from flaskr.models import (Question, Category, Revision, Compaction,
+                           question_digest)
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'te', 'zu', 'no', 'vi', 'sa', 'pe',
+             'do', 'gu', 'ri', 'ha', 'be', 'to', 'fa', 'ne', 'so', 'wi']
+VOCABULARY_SIZE = 5000
+WORDS_PER_QUESTION = 8
+BATCH_SIZE = 10000
+
+
+def vocabulary(size=VOCABULARY_SIZE):
+    """
+    returns: a list of distinct made up words. Words are drawn with a Zipf
+    distribution, the first words of the list being the most frequent.
+    """
+    rng = random.Random(0)
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES)
+                          for _ in range(rng.randint(2, 4))))
+    return sorted(words, key=lambda word: (len(word), word))
+
+
+def seed(engine, questions, categories=6, seed=0):
+    """
+    Recreate the tables and fill them with synthetic rows.
+    @param: engine: SQLAlchemy engine of the benchmark db.
+    @param: questions: number of questions to insert.
+    @param: categories: number of categories the questions are spread over.
+    @param: seed: seed of the random generator.
+    """
+    rng = random.Random(seed)
+    words = vocabulary()
+    weights = [1 / rank for rank in range(1, len(words) + 1)]
+
+    # The writes record their revisions, see record_revisions.
+    for table in (Revision.__table__, Compaction.__table__,
+                  Question.__table__, Category.__table__):
+        table.drop(engine, checkfirst=True)
+    for table in (Category.__table__, Question.__table__,
+                  Revision.__table__, Compaction.__table__):
+        table.create(engine)
+
+    with engine.begin() as connection:
+        connection.execute(Category.__table__.insert(), [
+            {'id': category_id, 'type': f'Category {category_id}'}
+            for category_id in range(1, categories + 1)])
+
+        digests = set()
+        inserted = 0
+        while inserted < questions:
+            rows = []
+            while len(rows) < min(BATCH_SIZE, questions - inserted):
+                text = ' '.join(rng.choices(words, weights,
+                                            k=WORDS_PER_QUESTION))
+                text = text.capitalize() + '?'
+                digest = question_digest(text)
+                if digest in digests:
+                    continue
+                digests.add(digest)
+                rows.append({
+                    'question': text,
+                    'answer': rng.choice(words),
+                    'category': rng.randint(1, categories),
+                    'difficulty': rng.randint(1, 5),
+                    'question_hash': digest
+                })
+            connection.execute(Question.__table__.insert(), rows)
+            inserted += len(rows)
@@ -0,0 +1,86 @@
+"""
+Measures the cold start of a worker process.
+
+Every run starts a fresh interpreter that imports flaskr, creates the app
+and serves a first request, and reports the time spent in each step. The
+medians over the runs are printed. Creating the app shouldn't depend on the
+database: only the first request connects to it.
+
+Usage, from the backend directory:
+    python -m benchmarks.startup
+    python -m benchmarks.startup --runs 20
+    python -m benchmarks.startup --database-url postgresql://localhost/bench
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from sqlalchemy import create_engine
+
+from benchmarks.seed import seed
+
+STEPS = ('import_ms', 'create_app_ms', 'first_request_ms')
+
+WORKER = '''
+import json, sys, time
+start = time.perf_counter()
+import flaskr
+imported = time.perf_counter()
+app = flaskr.create_app({'SQLALCHEMY_DATABASE_URI': sys.argv[1]})
+created = time.perf_counter()
+status = app.test_client().get('/questions').status_code
+served = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': (served - created) * 1000,
+    'status': status
+}))
+'''
+
+
+def measure(database_url, runs):
+    """
+    returns: a dict mapping the steps of the startup to their median
+    duration in milliseconds.
+    """
+    durations = {step: [] for step in STEPS}
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', WORKER, database_url], check=True,
+            capture_output=True, text=True).stdout
+        result = json.loads(output)
+        if result['status'] != 200:
+            raise RuntimeError(f"first request failed: {result['status']}")
+        for step in STEPS:
+            durations[step].append(result[step])
+    return {step: round(statistics.median(values), 2)
+            for step, values in durations.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--questions', type=int, default=1000,
+                        help='questions seeded before the runs')
+    parser.add_argument('--database-url',
+                        help='db to benchmark, a temporary SQLite file '
+                             'by default. Its tables are dropped!')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = args.database_url or \
+            'sqlite:///' + os.path.join(directory, 'bench.db')
+        seed(create_engine(database_url), args.questions)
+        results = measure(database_url, args.runs)
+
+    for step in STEPS:
+        print(f'{step:>18} {results[step]:>9}')
+
+
+if __name__ == '__main__':
+    main()
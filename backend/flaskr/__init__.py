@@ -1,17 +1,157 @@
-from flask import Flask, request, abort, jsonify
-from flask_cors import CORS
-
-import random
+import io
+import secrets
+import time
 
-from .models import setup_db, Question, Category
+import click
+from flask import (Flask, Response, request, abort, jsonify,
+                   stream_with_context)
+from flask_cors import CORS
+from sqlalchemy.exc import IntegrityError
+
+from .bulk import (import_questions, export_questions, delete_questions,
+                   update_questions, parse_selection, parse_values,
+                   BULK_BATCH_SIZE, DIFFICULTIES, FORMATS)
+from .cache import (CategoryCache, ResponseCache, SingleFlight, cached,
+                    coalesced, CATEGORY_CACHE_TTL, RESPONSE_CACHE_SIZE,
+                    RESPONSE_CACHE_TTL, COALESCE_TIMEOUT)
+from .compression import (Compressor, COMPRESS_MIN_SIZE, GZIP_LEVEL,
+                          BROTLI_QUALITY)
+from .counters import QuestionCounters, COUNTERS_TTL
+from .feed import (current_revision, read_changes, compact_changes,
+                   CHANGES_PAGE_SIZE, CHANGES_MAX_PAGE_SIZE,
+                   CHANGES_RETENTION)
+from .metrics import Metrics
+from .profiler import (Profiler, not_profiled, PROFILE_SAMPLE_RATE,
+                       PROFILE_BUFFER_SIZE, SLOW_QUERY_SECONDS,
+                       REPEATED_STATEMENTS)
+from .migrations import upgrade
+from .models import (setup_db, db, Question, Category, add_change_listener,
+                     question_digest, environment)
+from .replicas import (ReplicaRouter, read_only, replica_binds,
+                       REPLICA_POLICY, READ_YOUR_WRITES)
+from .quiz import (QuizTokens, start_quiz, next_question, parse_round,
+                   round_query, format_round, parse_adaptive,
+                   adaptive_difficulty, adaptive_query, QUIZ_SESSION_TTL)
+from .search import (SuggestionIndex, create_search_engine, SUGGEST_LIMIT,
+                     SUGGEST_MAX_LIMIT, SUGGEST_MAX_TOKENS, SEARCH_INDEX_TTL)
+from .snapshot import (QuestionSnapshot, snapshot_path,
+                       QUESTION_SNAPSHOT_TTL, QUESTION_SNAPSHOT_LOG_SIZE)
 from .utils import *
 
 
 def create_app(test_config=None):
     """ create and configure the app """
+    started = time.perf_counter()
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.from_mapping(test_config)
     setup_db(app)
 
+    # Per endpoint latency and SQL measures, served by /metrics.
+    metrics = Metrics()
+    if app.config.get('METRICS_ENABLED', True):
+        metrics.init_app(app)
+
+    # Profiles of the requests sending PROFILE_TOKEN or drawn by the
+    # sample rate, browsed at /admin/profiles.
+    profiler = Profiler(
+        token=app.config.get('PROFILE_TOKEN') or
+        environment().get('PROFILE_TOKEN'),
+        sample_rate=app.config.get('PROFILE_SAMPLE_RATE',
+                                   PROFILE_SAMPLE_RATE),
+        size=app.config.get('PROFILE_BUFFER_SIZE', PROFILE_BUFFER_SIZE),
+        slow_query=app.config.get('SLOW_QUERY_SECONDS', SLOW_QUERY_SECONDS),
+        repeated=app.config.get('REPEATED_STATEMENTS', REPEATED_STATEMENTS))
+    if profiler.token is not None or profiler.sample_rate:
+        profiler.init_app(app)
+
+    # gzip or brotli compression of the responses, negotiated with the
+    # clients. Registered after the measures so they include it.
+    compressor = Compressor(
+        min_size=app.config.get('COMPRESS_MIN_SIZE', COMPRESS_MIN_SIZE),
+        gzip_level=app.config.get('GZIP_LEVEL', GZIP_LEVEL),
+        brotli_quality=app.config.get('BROTLI_QUALITY', BROTLI_QUALITY))
+    if app.config.get('COMPRESSION', True):
+        compressor.init_app(app)
+
+    # Signs the quiz tokens, which hold the progress of the quiz rounds.
+    # SECRET_KEY must be shared by the workers serving the same clients.
+    if not app.config.get('SECRET_KEY'):
+        app.config['SECRET_KEY'] = environment().get('SECRET_KEY')
+    if not app.config['SECRET_KEY']:
+        if not app.testing:
+            app.logger.warning(
+                'SECRET_KEY is not set, the quiz tokens are signed with a '
+                'random key of this process and are rejected by the other '
+                'workers and after a restart. Set SECRET_KEY in production.')
+        app.config['SECRET_KEY'] = secrets.token_hex(32)
+    quiz_tokens = QuizTokens(
+        app.config['SECRET_KEY'],
+        ttl=app.config.get('QUIZ_SESSION_TTL', QUIZ_SESSION_TTL))
+
+    # Formatted category list, reloaded only after a category is written.
+    category_cache = CategoryCache(
+        ttl=app.config.get('CATEGORY_CACHE_TTL', CATEGORY_CACHE_TTL))
+    add_change_listener(app, category_cache.on_changes)
+
+    # Data version and bodies of the cacheable GET endpoints.
+    response_cache = ResponseCache(
+        size=app.config.get('RESPONSE_CACHE_SIZE', RESPONSE_CACHE_SIZE),
+        ttl=app.config.get('RESPONSE_CACHE_TTL', RESPONSE_CACHE_TTL))
+    add_change_listener(app, response_cache.on_changes)
+
+    # Identical expensive reads served concurrently share a single run.
+    single_flight = SingleFlight(
+        timeout=app.config.get('COALESCE_TIMEOUT', COALESCE_TIMEOUT))
+    add_change_listener(app, single_flight.on_changes)
+
+    # Ids of the questions by category and difficulty, shared by the worker
+    # processes through a memory-mapped file. Picks the quiz questions and
+    # holds the question totals.
+    question_snapshot = None
+    if app.config.get('QUESTION_SNAPSHOT', True):
+        question_snapshot = QuestionSnapshot(
+            snapshot_path(app),
+            ttl=app.config.get('QUESTION_SNAPSHOT_TTL',
+                               QUESTION_SNAPSHOT_TTL),
+            log_size=app.config.get('QUESTION_SNAPSHOT_LOG_SIZE',
+                                    QUESTION_SNAPSHOT_LOG_SIZE))
+        add_change_listener(app, question_snapshot.on_changes)
+
+    # Question totals, maintained on writes instead of counting the table.
+    question_counters = QuestionCounters(
+        ttl=app.config.get('COUNTERS_TTL', COUNTERS_TTL),
+        snapshot=question_snapshot)
+    add_change_listener(app, question_counters.on_changes)
+
+    # Backend answering /search, selected by the SEARCH_BACKEND config value.
+    search_engine = create_search_engine(app)
+
+    # Completions of the words typed in the search box, see /search/suggest.
+    suggestion_index = SuggestionIndex(
+        max_tokens=app.config.get('SUGGEST_MAX_TOKENS', SUGGEST_MAX_TOKENS),
+        ttl=app.config.get('SEARCH_INDEX_TTL', SEARCH_INDEX_TTL))
+    add_change_listener(app, suggestion_index.on_changes)
+
+    # Read-only endpoints are answered by the replicas of DB_REPLICA_URIS.
+    replica_router = ReplicaRouter(
+        replica_binds(app),
+        policy=app.config.get('REPLICA_POLICY', REPLICA_POLICY),
+        read_your_writes=app.config.get('READ_YOUR_WRITES',
+                                        READ_YOUR_WRITES))
+    if replica_router.binds:
+        replica_router.init_app(app)
+
+    # Components shared with the ASGI entry point, see asgi.py.
+    app.extensions['trivia'] = {
+        'quiz_tokens': quiz_tokens,
+        'category_cache': category_cache,
+        'search_engine': search_engine,
+        'suggestion_index': suggestion_index,
+        'question_snapshot': question_snapshot,
+        'replica_router': replica_router
+    }
+
     # CORS SETUP #
     # Allow all origins to access any endpoint by setting up CORS
     CORS(app, resources={'/*': {'origins': '*'}})
@@ -27,55 +167,64 @@ def create_app(test_config=None):
 
     # MAIN ENDPOINTS #
     @app.route('/categories')
+    @read_only
+    @cached(response_cache)
     def retrieve_categories():
         """
         Returns a JSON response with the available categories
         Sample: curl http://127.0.0.1:5000/categories
         """
         try:
-            categories = Category.query.order_by(Category.id).all()
+            # The category cache holds the categories on the format expected
+            # by the front-end
+            formatted_categories = category_cache.formatted()
 
-            if len(categories) < 1:
+            if len(formatted_categories) < 1:
                 abort(404)
 
-            # Use the format_category_list utility to return a category on the
-            # format expected by the front-end
-            formatted_categories = format_category_list(categories)
             return jsonify({
                 'success': True,
                 'categories': formatted_categories,
-                'total_categories': len(categories)
+                'total_categories': len(formatted_categories)
             })
         except:
             abort(500)
 
     @app.route('/questions')
+    @read_only
+    @cached(response_cache)
+    @coalesced(single_flight)
     def retrieve_paginated_questions():
         """
         Returns trivia questions paginated by the specified QUESTIONS_PER_PAGE
         value from the utils.py file
-        Sample: curl http://127.0.0.1:5000/questions
+        The fields url parameter restricts the returned question fields.
+        Sample: curl http://127.0.0.1:5000/questions?fields=id,question
         """
-        try:
-            questions = Question.query.order_by(Question.id).all()
+        fields = requested_fields(request)
+        if fields is None:
+            abort(400)
 
-            # Get paginated questions formatted.
-            paginated_questions = paginate_questions(request, questions)
+        try:
+            # Get paginated questions formatted, only the current page is
+            # loaded from the db.
+            paginated_questions, total_questions = paginate_questions(
+                request, Question.query, fields,
+                total=question_counters.total)
             if len(paginated_questions) < 1:
                 # This mechanism is used to inform the UI if there are no
                 # questions present.
                 abort(404)
 
-            categories = Category.query.order_by(Category.id).all()
-            formatted_categories = format_category_list(categories)
+            formatted_categories = category_cache.formatted()
 
-            return jsonify({
+            return json_response({
                 'success': True,
                 'questions': paginated_questions,
-                'total_questions': len(questions),
+                'total_questions': total_questions,
                 'current_category': None,
                 'categories': formatted_categories
-            }), 200
+            }, 200)
         except:
             abort(404)
 
@@ -103,9 +252,62 @@ def create_app(test_config=None):
 
         return jsonify({
             'success': True,
-            'total_question': len(Question.query.all())
+            'total_question': question_counters.total
         }), 200
 
+    @app.route('/questions', methods=['DELETE'])
+    def delete_questions_batch():
+        """
+        Delete many questions in a single transaction, selected by a list of
+        ids or by a filter on their category and difficulty. The questions
+        are deleted by batches of batch_size questions, one statement each.
+        Returns the number of deleted questions and the result of each one.
+        Sample: curl http://127.0.0.1:5000/questions?batch_size=500 -X DELETE -H "Content-Type: application/json" -d '{
+            "filter": {"category": 4, "difficulty": 1}
+            }'
+        """
+        batch_size = request.args.get('batch_size', BULK_BATCH_SIZE, type=int)
+        if batch_size < 1:
+            abort(400)
+        try:
+            ids, filters = parse_selection(request.get_json())
+        except ValueError:
+            abort(400)
+
+        report = delete_questions(ids, filters, batch_size)
+        return jsonify(dict(
+            report.format(),
+            success=True,
+            total_questions=question_counters.total
+        )), 200
+
+    @app.route('/questions', methods=['PATCH'])
+    def update_questions_batch():
+        """
+        Set the category or difficulty of many questions in a single
+        transaction, selected like in the batch delete.
+        Sample: curl http://127.0.0.1:5000/questions -X PATCH -H "Content-Type: application/json" -d '{
+            "ids": [5, 9, 12],
+            "values": {"category": 3}
+            }'
+        """
+        batch_size = request.args.get('batch_size', BULK_BATCH_SIZE, type=int)
+        if batch_size < 1:
+            abort(400)
+        data = request.get_json()
+        try:
+            ids, filters = parse_selection(data)
+            values = parse_values(data.get('values'), category_cache)
+        except ValueError:
+            abort(400)
+
+        report = update_questions(ids, filters, values, batch_size)
+        return jsonify(dict(
+            report.format(),
+            success=True,
+            total_questions=question_counters.total
+        )), 200
+
     @app.route('/questions', methods=['POST'])
     def submit_question():
         """
@@ -119,9 +321,6 @@ def create_app(test_config=None):
             "category": "4"
             }'
         """
-        question_objects = Question.query.all()
-        questions_literals = [qn.format()['question']
-                              for qn in question_objects]
         data = request.get_json()
         question = data.get('question', '')
         answer = data.get('answer', '')
@@ -129,12 +328,26 @@ def create_app(test_config=None):
         difficulty = data.get('difficulty', '')
         if len(question) < 1 or len(answer) < 1:
             abort(400)
-        # Prevent addition of already existing questions
-        if question in questions_literals:
+        # Validated like the imported questions, before the insert.
+        try:
+            difficulty = int(difficulty)
+        except (TypeError, ValueError):
+            abort(400)
+        if difficulty not in DIFFICULTIES:
+            abort(400)
+        # Prevent addition of already existing questions. The lookup uses the
+        # unique index on the digest of the normalized question text.
+        if Question.query.filter(
+                Question.question_hash == question_digest(question)).first():
             abort(400)
         new_question_id = None
 
         try:
+            # The category is a foreign key to the categories table, the UI
+            # sends its id as a string.
+            category = int(category)
+            if category_cache.get(category) is None:
+                abort(422)
             new_question = Question(
                 question,
                 answer,
@@ -144,82 +357,257 @@ def create_app(test_config=None):
             new_question.insert()
             new_question_id = new_question.id
 
+        except IntegrityError:
+            # The same question was inserted by a concurrent request.
+            db.session.rollback()
+            abort(400)
         except:
             abort(422)
 
         return jsonify({
             'success': True,
-            'total_questions': len(Question.query.all()),
+            'total_questions': question_counters.total,
             'question_id': new_question_id
         }), 201
 
+    @app.route('/questions/import', methods=['POST'])
+    def import_questions_file():
+        """
+        Import questions in bulk from the request body, streamed as NDJSON
+        (one question object per line) or CSV with a header line. The format
+        is taken from the format url parameter or the content type.
+        Rows are validated and inserted by batches of batch_size questions,
+        invalid rows and duplicates of existing questions are skipped.
+        Sample: curl http://127.0.0.1:5000/questions/import -X POST -H "Content-Type: application/x-ndjson" --data-binary @questions.ndjson
+        """
+        format = request.args.get(
+            'format', 'csv' if request.mimetype == 'text/csv' else 'ndjson')
+        batch_size = request.args.get('batch_size', BULK_BATCH_SIZE, type=int)
+        if format not in FORMATS or batch_size < 1:
+            abort(400)
+
+        lines = io.TextIOWrapper(request.stream, encoding='utf-8',
+                                 newline='')
+        try:
+            report = import_questions(lines, format, category_cache,
+                                      batch_size)
+        except UnicodeDecodeError:
+            abort(422)
+
+        return jsonify(dict(
+            report.format(),
+            success=True,
+            total_questions=question_counters.total
+        )), 201
+
+    @app.route('/questions/export')
+    @read_only
+    def export_questions_file():
+        """
+        Stream every question as NDJSON, or CSV when the format url parameter
+        is csv. Rows are read from the db batch by batch.
+        Sample: curl http://127.0.0.1:5000/questions/export?format=csv
+        """
+        format = request.args.get('format', 'ndjson')
+        if format not in FORMATS:
+            abort(400)
+
+        return Response(
+            stream_with_context(export_questions(format)),
+            mimetype=FORMATS[format],
+            headers={'Content-Disposition':
+                     f'attachment; filename=questions.{format}'})
+
     @app.route('/search', methods=['POST'])
+    @read_only
+    @coalesced(single_flight)
     def search_for_a_question():
         """
         Search for a list of questions based on a search term.
-        Returns JSON object with paginated matching questions.
+        Returns JSON object with paginated matching questions, ranked by
+        relevance unless the ilike search backend is used.
         Sample: curl http://127.0.0.1:5000/questions -X POST -H "Content-Type: application/json" -d '{
         "searchTerm": "what"
         }'
         """
+        fields = requested_fields(request)
+        if fields is None:
+            abort(400)
+
         try:
             data = request.get_json()
             search_term = data.get('searchTerm', '')
             if len(search_term) < 1:
                 abort(422)
 
-            questions = Question.query.order_by(Question.id).filter(
-                Question.question.ilike(f'%{search_term}%')).all()
-            if len(questions) < 1:
+            formatted_questions, total_questions = search_engine.search(
+                request, search_term, fields)
+            if total_questions < 1:
                 abort(404)
-            formatted_questions = paginate_questions(request, questions)
 
-            categories = Category.query.order_by(Category.id).all()
-            formatted_categories = format_category_list(categories)
+            formatted_categories = category_cache.formatted()
         except:
             abort(404)
 
-        return jsonify({
+        return json_response({
             'success': True,
             'questions': formatted_questions,
-            'total_questions': len(questions),
+            'total_questions': total_questions,
             'categories': formatted_categories,
             'current_categroy': None
-        }), 201
+        }, 201)
+
+    @app.route('/search/suggest')
+    @read_only
+    def suggest_search_terms():
+        """
+        Completes the last word of the search term typed so far with the
+        words of the most questions, answered from memory so it can be
+        called on every keystroke.
+        Sample: curl http://127.0.0.1:5000/search/suggest?prefix=who%20dis&limit=5
+        """
+        prefix = request.args.get('prefix', '')
+        limit = request.args.get('limit', SUGGEST_LIMIT, type=int)
+        if len(prefix) < 1 or not 1 <= limit <= SUGGEST_MAX_LIMIT:
+            abort(400)
+
+        return json_response({
+            'success': True,
+            'suggestions': suggestion_index.suggest(prefix, limit)
+        })
 
     @app.route('/categories/<int:category_id>/questions', methods=["GET"])
+    @read_only
+    @cached(response_cache)
+    @coalesced(single_flight)
     def retrieve_questions_by_category(category_id):
         """
         Gets questions by category id using url parameters.
         Returns JSON object with paginated matching results.
         Sample: curl http://127.0.0.1:5000/categories/1/questions
         """
+        fields = requested_fields(request)
+        if fields is None:
+            abort(400)
+
         try:
-            category = Category.query.get(category_id).type
+            category = category_cache.get(category_id)
+            if category is None:
+                abort(404)
 
-            questions = Question.query.order_by(Question.id).filter(
-                Question.category == str(category_id)).all()
-            if len(questions) < 1:
+            questions = Question.query.filter(
+                Question.category == category_id)
+            formatted_question, total_questions = paginate_questions(
+                request, questions, fields,
+                total=question_counters.category_total(category_id))
+            if total_questions < 1:
                 # This mechanism is used to inform the UI that no questions
                 # are enlisted within this categore.
                 abort(404)
-
-            formatted_question = paginate_questions(request, questions)
         except:
             abort(404)
 
-        return jsonify({
+        return json_response({
             'success': True,
             'questions': formatted_question,
             'current_category': category,
-            'total_questions': len(questions)
+            'total_questions': total_questions
+        }, 200)
+
+    @app.route('/stats')
+    @read_only
+    def retrieve_stats():
+        """
+        Returns the number of questions, globally, per category and per
+        difficulty. Served from the question counters without counting the
+        table.
+        Sample: curl http://127.0.0.1:5000/stats
+        """
+        return jsonify({
+            'success': True,
+            'total_questions': question_counters.total,
+            'questions_per_category': question_counters.by_category(),
+            'questions_per_difficulty': question_counters.by_difficulty()
         }), 200
 
+    @app.route('/changes')
+    @read_only
+    def retrieve_changes():
+        """
+        Returns the questions and categories written after the since
+        revision, only the latest version of each row, deleted rows as
+        tombstones without data. Without since only the current revision is
+        returned, to sync from once the data is loaded.
+        Returns a 410 error if the history after since was compacted.
+        Sample: curl http://127.0.0.1:5000/changes?since=42&limit=100
+        """
+        since = request.args.get('since', None, type=int)
+        limit = request.args.get('limit', CHANGES_PAGE_SIZE, type=int)
+        if not 1 <= limit <= CHANGES_MAX_PAGE_SIZE:
+            abort(400)
+        if since is None:
+            return json_response({
+                'success': True,
+                'revision': current_revision()
+            })
+        if since < 0:
+            abort(400)
+
+        changes = read_changes(since, limit)
+        if changes is None:
+            abort(410)
+
+        return json_response(dict(changes, success=True))
+
+    @app.route('/metrics')
+    def retrieve_metrics():
+        """
+        Returns the request metrics in the Prometheus text format.
+        Sample: curl http://127.0.0.1:5000/metrics
+        """
+        return Response(metrics.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+    @app.route('/admin/profiles')
+    @app.route('/admin/profiles/<int:profile_id>')
+    @not_profiled
+    def retrieve_profiles(profile_id=None):
+        """
+        Returns the summaries of the last request profiles, newest first, or
+        the details of one of them: its slow SQL statements with their plan,
+        its repeated statements and its cProfile report. Requires the
+        PROFILE_TOKEN in the X-Profile-Token header.
+        Sample: curl http://127.0.0.1:5000/admin/profiles/3 -H "X-Profile-Token: secret"
+        """
+        if profiler.token is None:
+            abort(404)
+        if not profiler.authorized():
+            abort(403)
+        if profile_id is None:
+            return json_response({
+                'success': True,
+                'profiles': profiler.profiles()
+            })
+
+        profile = profiler.get(profile_id)
+        if profile is None:
+            abort(404)
+        return json_response({
+            'success': True,
+            'profile': profile
+        })
+
     @app.route('/quizzes', methods=['POST'])
+    @read_only
     def get_random_question():
         """
         Lets the user play a game of trivia.
         Uses JSON request parameters of category and previous questions.
+        The first call starts a round played in a random order of the
+        category's questions. The returned quiz_session is a signed token
+        holding the progress of the round: sending it back with the
+        following calls returns the next question of the round, so the
+        previous questions don't need to be sent anymore.
         Returns JSON object with random question that hasn't been provided
         before.
         Sample: curl http://127.0.0.1:5000/quizzes -X POST -H "Content-Type: application/json" -d '{
@@ -227,43 +615,182 @@ def create_app(test_config=None):
             "quiz_category": {
                 "type": "History",
                 "id": "4"
-                }
+                },
+            "quiz_session": "WzQsNSwxOCw1LDMsNywyXQ.Y5x2Nw.mN0Wc8s0..."
             }'
         """
         data = request.get_json()
-        previous_questions = data.get('previous_questions', None)
+        previous_questions = data.get('previous_questions', [])
         category = data.get('quiz_category', None)
+        token = data.get('quiz_session', None)
 
         if previous_questions is None or category is None:
             abort(400)
-        questions = None
-        question = None
-        if category['id'] == 0:  # "All" category is selected
-            questions = Question.query.all()
-        else:
-            questions = Question.query.filter(
-                Question.category == category['id']).all()
+        try:
+            category_id = int(category['id'])
+        except (KeyError, TypeError, ValueError):
+            abort(400)
+        if category_id == 0:  # "All" category is selected
+            category_id = None
+
+        state = quiz_tokens.loads(token) if token else None
+        if state is None or state.category != category_id:
+            state = start_quiz(category_id, question_snapshot)
+            if state is None:
+                # If the selected category has no questions, the UI reflects
+                # that.
+                abort(404)
 
-        if len(questions) < 1:
-            # If the selected category has no questions, the UI reflects that.
+        question = next_question(state, set(previous_questions),
+                                 question_snapshot)
+        if question is None:
+            # Every question of the category has been played.
+            return jsonify({
+                'success': True,
+                'quiz_session': quiz_tokens.dumps(state)
+            }), 201
+
+        return jsonify({
+            'success': True,
+            'question': question,
+            'quiz_session': quiz_tokens.dumps(state)
+        }), 201
+
+    @app.route('/quizzes/round', methods=['POST'])
+    @read_only
+    def get_quiz_round():
+        """
+        Returns a whole round of distinct random questions of a category,
+        sampled by a single query, so a round costs one request.
+        Uses JSON request parameters of category, size of the round (5 by
+        default) and previous questions. An optional difficulties object
+        maps difficulties to their number of questions in the round, and
+        replaces the size.
+        Sample: curl http://127.0.0.1:5000/quizzes/round -X POST -H "Content-Type: application/json" -d '{
+            "quiz_category": {
+                "type": "History",
+                "id": "4"
+                },
+            "difficulties": {"1": 1, "2": 2}
+            }'
+        """
+        try:
+            category_id, size, mix, excluded = parse_round(request.get_json())
+        except ValueError:
+            abort(400)
+
+        questions = format_round(db.session.execute(
+            round_query(category_id, size, mix, excluded,
+                        question_snapshot)))
+        if not questions:
+            # No question of the category is left to play.
             abort(404)
 
-        while True:
-            # This condition is crucial for categories with question < 5
-            if len(previous_questions) == len(questions):
-                return jsonify({
-                    'success': True
-                }), 201
-            # Get random question
-            question = questions[random.randint(0, len(questions) - 1)]
-            if question.id not in previous_questions:
-                break
+        return jsonify({
+            'success': True,
+            'questions': questions,
+            'total_questions': len(questions)
+        }), 201
+
+    @app.route('/quizzes/adaptive', methods=['POST'])
+    @read_only
+    def get_adaptive_question():
+        """
+        Lets the user play a quiz whose difficulty follows their answers.
+        The difficulty of the next question is stepped up from the one of
+        the last question when most of the recent answers were correct,
+        down when most were wrong. The question is drawn from the ids of
+        its category and difficulty held by the question snapshot, or of
+        the closest difficulty with questions left.
+        Uses JSON request parameters of category, previous questions and
+        the answers given so far, oldest first.
+        Returns JSON object with the question and the difficulty aimed at.
+        Sample: curl http://127.0.0.1:5000/quizzes/adaptive -X POST -H "Content-Type: application/json" -d '{
+            "previous_questions": [9, 5],
+            "quiz_category": {
+                "type": "History",
+                "id": "4"
+                },
+            "answers": [
+                {"difficulty": 2, "correct": true},
+                {"difficulty": 3, "correct": true}
+                ]
+            }'
+        """
+        try:
+            category_id, answers, excluded = parse_adaptive(
+                request.get_json())
+        except ValueError:
+            abort(400)
+
+        difficulty = adaptive_difficulty(answers)
+        query = adaptive_query(category_id, difficulty, excluded,
+                               question_snapshot)
+        row = db.session.execute(query).first() \
+            if query is not None else None
+        if row is None:
+            # No question of the category is left to play.
+            abort(404)
 
         return jsonify({
             'success': True,
-            'question': question.format()
+            'question': dict(zip(QUESTION_FIELDS, row)),
+            'difficulty': difficulty
         }), 201
 
+    # COMMANDS #
+    @app.cli.command('init-db')
+    def init_db():
+        """Create the tables and indexes missing from the db."""
+        db.create_all()
+        upgrade(db.engine, click.echo)
+        search_engine.prepare()
+
+    @app.cli.command('upgrade-db')
+    def upgrade_db():
+        """Bring the schema of an existing db up to date."""
+        upgrade(db.engine, click.echo)
+        search_engine.prepare()
+
+    @app.cli.command('compact-changes')
+    @click.option('--retention', type=int,
+                  default=app.config.get('CHANGES_RETENTION',
+                                         CHANGES_RETENTION),
+                  show_default=True,
+                  help='Seconds of history to keep.')
+    def compact_changes_command(retention):
+        """Drop the change feed history older than the retention."""
+        click.echo(compact_changes(retention))
+
+    @app.cli.command('import-questions')
+    @click.argument('file', type=click.File('r', encoding='utf-8'))
+    @click.option('--format', type=click.Choice(list(FORMATS)),
+                  help='Format of the file, guessed from its extension '
+                       'by default.')
+    @click.option('--batch-size', default=BULK_BATCH_SIZE, show_default=True,
+                  help='Number of questions inserted per transaction.')
+    def import_questions_command(file, format, batch_size):
+        """Import questions from a NDJSON or CSV file."""
+        if format is None:
+            format = 'csv' if file.name.endswith('.csv') else 'ndjson'
+        categories = {category_id for category_id,
+                      in db.session.query(Category.id)}
+        report = import_questions(file, format, categories, batch_size)
+        for error in report.errors:
+            click.echo(f"line {error['line']}: {error['message']}", err=True)
+        click.echo(f'Imported {report.imported} questions, skipped '
+                   f'{report.duplicates} duplicates and {report.invalid} '
+                   f'invalid rows.')
+
+    @app.cli.command('export-questions')
+    @click.argument('file', type=click.File('w', encoding='utf-8'))
+    @click.option('--format', type=click.Choice(list(FORMATS)),
+                  default='ndjson', show_default=True)
+    def export_questions_command(file, format):
+        """Export every question to a NDJSON or CSV file, - for stdout."""
+        for chunk in export_questions(format):
+            file.write(chunk)
+
     # ERROR HANDLING #
     """
     Errors are returned as JSON and are formatted in the following manner:
@@ -300,6 +827,22 @@ def create_app(test_config=None):
             'message': 'Unprocessable'
         }), 422
 
+    @app.errorhandler(403)
+    def not_allowed(error):
+        return jsonify({
+            'success': False,
+            'error': 403,
+            'message': 'Forbidden'
+        }), 403
+
+    @app.errorhandler(410)
+    def gone(error):
+        return jsonify({
+            'success': False,
+            'error': 410,
+            'message': 'Gone'
+        }), 410
+
     @app.errorhandler(400)
     def forbidden(error):
         return jsonify({
@@ -308,4 +851,8 @@ def create_app(test_config=None):
             'message': 'Bad request',
         }), 400
 
+    # Time spent creating the app, served by /metrics. Nothing above
+    # connects to the db.
+    metrics.startup_seconds = time.perf_counter() - started
+
     return app
@@ -0,0 +1,422 @@
+"""
+ASGI entry point serving the API with async database access.
+
+The quiz and search routes, which spend most of their time waiting on the
+db, are answered by coroutines querying it through SQLAlchemy's async
+engine, so a request waiting on the db doesn't hold a worker thread. Every
+other route is handed to the Flask app of create_app, run in a thread pool,
+so both entry points expose the same routes and JSON contract. The quiz
+tokens, the category cache, the question snapshot, the search backend and
+the replica router are those of the Flask app, writes made through it are
+seen by the async routes, which read from the replicas like the read-only
+routes of the Flask app.
+
+Requires the async driver of the db: asyncpg for PostgreSQL, aiosqlite for
+SQLite. Run it with:
+    uvicorn --factory flaskr.asgi:create_asgi_app
+"""
+import asyncio
+import json
+from contextlib import asynccontextmanager
+
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy import func, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from werkzeug.exceptions import HTTPException, abort
+from werkzeug.http import parse_cookie
+from werkzeug.urls import url_decode
+
+from . import create_app
+from .models import Question, engine_options, setting
+from .quiz import (QuizState, bounds_query, candidates_query,
+                   position_query, parse_round, round_query, format_round,
+                   parse_adaptive, adaptive_difficulty, adaptive_query)
+from .search import InvertedIndexSearch, _page_start
+from .utils import (QUESTIONS_PER_PAGE, QUESTION_FIELDS, orjson,
+                    question_columns, format_rows, requested_fields)
+
+# Async drivers replacing the sync ones in the database url.
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite'
+}
+ASYNC_POOL_SIZE = 20  # Connections kept open by the async engine.
+ASYNC_MAX_OVERFLOW = 20  # Connections opened above the pool size under load.
+
+ERROR_MESSAGES = {
+    400: 'Bad request',
+    404: 'Resource not found',
+    422: 'Unprocessable',
+    500: 'Internal server error'
+}
+
+RESPONSE_HEADERS = [
+    (b'content-type', b'application/json'),
+    (b'access-control-allow-origin', b'*'),
+    (b'access-control-allow-headers', b'Content-Type, Authorization, true'),
+    (b'access-control-allow-methods', b'GET, POST, PATCH, DELETE, OPTIONS')
+]
+
+
+def async_database_url(config, bind=None):
+    """
+    @param: config the config of the flask application.
+    @param: bind name of a replica bind, None for the primary db.
+    returns: the ASYNC_DATABASE_URI config value for the primary db, or the
+    url of the db with its driver replaced by the async one.
+    """
+    if bind is not None:
+        url = make_url(config['SQLALCHEMY_BINDS'][bind])
+    else:
+        url = config.get('ASYNC_DATABASE_URI')
+        if url is not None:
+            return make_url(url)
+        url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+
+class AsyncRequest:
+    """The parts of a request the async routes read."""
+
+    def __init__(self, scope, body):
+        self.args = url_decode(scope.get('query_string', b''))
+        self.cookies = parse_cookie(b'; '.join(
+            value for name, value in scope.get('headers', ())
+            if name == b'cookie'))
+        self.body = body
+
+    def get_json(self):
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+
+class AsyncTrivia:
+    """
+    ASGI application answering the quiz and search routes with async db
+    access and handing every other request to the Flask app.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.wsgi = WsgiToAsgi(app)
+        self.quiz_tokens = app.extensions['trivia']['quiz_tokens']
+        self.category_cache = app.extensions['trivia']['category_cache']
+        self.search_engine = app.extensions['trivia']['search_engine']
+        self.snapshot = app.extensions['trivia']['question_snapshot']
+        self.replica_router = app.extensions['trivia']['replica_router']
+        self.routes = {
+            ('POST', '/quizzes'): self.play_quiz,
+            ('POST', '/quizzes/round'): self.play_round,
+            ('POST', '/quizzes/adaptive'): self.play_adaptive,
+            ('POST', '/search'): self.search
+        }
+        self._engines = {}  # replica bind, None for the primary -> engine
+
+    @property
+    def engine(self):
+        """The async engine of the primary db."""
+        return self.engine_of(None)
+
+    def engine_of(self, bind):
+        """
+        @param: bind name of a replica bind, None for the primary db.
+        returns: the async engine of the db.
+        """
+        # Created on first use so the db of the app can still be changed
+        # after the app is created, as the tests do.
+        engine = self._engines.get(bind)
+        if engine is None:
+            config = self.app.config
+            url = async_database_url(config, bind)
+            options = engine_options(config, url)
+            if url.get_backend_name() != 'sqlite':
+                options.update(
+                    pool_size=setting(config, 'ASYNC_POOL_SIZE',
+                                      ASYNC_POOL_SIZE),
+                    max_overflow=setting(config, 'ASYNC_MAX_OVERFLOW',
+                                         ASYNC_MAX_OVERFLOW))
+            engine = self._engines[bind] = create_async_engine(url, **options)
+        return engine
+
+    @asynccontextmanager
+    async def connect(self, request):
+        """
+        Connect to the db answering a request: a replica picked by the
+        replica router of the app, or the primary db when there is no
+        replica or the client wrote recently, see replicas.py.
+        """
+        router = self.replica_router
+        bind = None
+        if router.binds and not router.wrote_recently(request.cookies):
+            bind = router.acquire()
+        try:
+            async with self.engine_of(bind).connect() as connection:
+                yield connection
+        finally:
+            if bind is not None:
+                router.release(bind)
+
+    async def dispose(self):
+        """Close the connections of every async engine."""
+        for engine in self._engines.values():
+            await engine.dispose()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        route = None
+        if scope['type'] == 'http':
+            route = self.routes.get((scope['method'], scope['path']))
+        if route is None:
+            return await self.wsgi(scope, receive, send)
+
+        request = AsyncRequest(scope, await _read_body(receive))
+        try:
+            status, payload = await route(request)
+        except HTTPException as error:
+            status, payload = error.code, _error(error.code)
+        except Exception:
+            self.app.logger.exception('Exception on %s', scope['path'])
+            status, payload = 500, _error(500)
+
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': RESPONSE_HEADERS})
+        await send({'type': 'http.response.body',
+                    'body': self.dumps(payload)})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def dumps(self, payload):
+        if orjson is not None and self.app.config.get('FAST_JSON', True):
+            return orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(payload).encode('utf-8')
+
+    async def run_sync(self, function, *args):
+        """
+        Run a blocking function of the Flask app components in a thread,
+        inside an app context.
+        """
+        def call():
+            with self.app.app_context():
+                return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, call)
+
+    async def categories(self):
+        if not self.category_cache.loaded:
+            return await self.run_sync(self.category_cache.formatted)
+        return self.category_cache.formatted()
+
+    async def question_snapshot(self):
+        """
+        returns: the QuestionSnapshot of the app, rebuilt in a thread if it
+        expired, or None if it is disabled.
+        """
+        if self.snapshot is not None and self.snapshot.stale:
+            await self.run_sync(self.snapshot.load)
+        return self.snapshot
+
+    async def play_quiz(self, request):
+        """Async version of POST /quizzes, see create_app."""
+        data = request.get_json()
+        if not isinstance(data, dict):
+            abort(400)
+        previous_questions = data.get('previous_questions', [])
+        category = data.get('quiz_category', None)
+        token = data.get('quiz_session', None)
+
+        if previous_questions is None or category is None:
+            abort(400)
+        try:
+            category_id = int(category['id'])
+        except (KeyError, TypeError, ValueError):
+            abort(400)
+        if category_id == 0:  # "All" category is selected
+            category_id = None
+
+        state = self.quiz_tokens.loads(token) if token else None
+        snapshot = await self.question_snapshot()
+        async with self.connect(request) as connection:
+            if state is None or state.category != category_id:
+                if snapshot is not None:
+                    first_id, last_id, count = snapshot.bounds(category_id)
+                else:
+                    first_id, last_id, count = (await connection.execute(
+                        bounds_query(category_id))).first()
+                if not count:
+                    abort(404)
+                state = QuizState.start(category_id, first_id, last_id,
+                                        count)
+
+            previous_questions = set(previous_questions)
+            question = None
+            while question is None and not state.finished:
+                if snapshot is not None:
+                    question_id = state.skip_to(snapshot, previous_questions)
+                    if question_id is None:
+                        break
+                    row = (await connection.execute(
+                        candidates_query(state, [question_id]))).first()
+                    if row is not None:
+                        question = dict(zip(QUESTION_FIELDS, row))
+                    continue
+                ids = state.candidates()
+                question = state.advance(ids, await connection.execute(
+                    candidates_query(state, ids)), previous_questions)
+                if question is None and not state.finished:
+                    question = state.advance_to((await connection.execute(
+                        position_query(state, previous_questions))).first())
+
+        payload = {'success': True}
+        if question is not None:
+            payload['question'] = question
+        payload['quiz_session'] = self.quiz_tokens.dumps(state)
+        return 201, payload
+
+    async def play_round(self, request):
+        """Async version of POST /quizzes/round, see create_app."""
+        try:
+            category_id, size, mix, excluded = parse_round(request.get_json())
+        except ValueError:
+            abort(400)
+
+        snapshot = await self.question_snapshot()
+        async with self.connect(request) as connection:
+            questions = format_round(await connection.execute(
+                round_query(category_id, size, mix, excluded, snapshot)))
+        if not questions:
+            abort(404)
+        return 201, {
+            'success': True,
+            'questions': questions,
+            'total_questions': len(questions)
+        }
+
+    async def play_adaptive(self, request):
+        """Async version of POST /quizzes/adaptive, see create_app."""
+        try:
+            category_id, answers, excluded = parse_adaptive(
+                request.get_json())
+        except ValueError:
+            abort(400)
+
+        difficulty = adaptive_difficulty(answers)
+        query = adaptive_query(category_id, difficulty, excluded,
+                               await self.question_snapshot())
+        row = None
+        if query is not None:
+            async with self.connect(request) as connection:
+                row = (await connection.execute(query)).first()
+        if row is None:
+            abort(404)
+        return 201, {
+            'success': True,
+            'question': dict(zip(QUESTION_FIELDS, row)),
+            'difficulty': difficulty
+        }
+
+    async def search(self, request):
+        """Async version of POST /search, see create_app."""
+        fields = requested_fields(request)
+        if fields is None:
+            abort(400)
+
+        try:
+            data = request.get_json()
+            search_term = data.get('searchTerm', '')
+            if len(search_term) < 1:
+                abort(422)
+
+            formatted_questions, total_questions = await self.find_questions(
+                request, search_term, fields)
+            if total_questions < 1:
+                abort(404)
+
+            formatted_categories = await self.categories()
+        except Exception:
+            abort(404)
+
+        return 201, {
+            'success': True,
+            'questions': formatted_questions,
+            'total_questions': total_questions,
+            'categories': formatted_categories,
+            'current_categroy': None
+        }
+
+    async def find_questions(self, request, term, fields):
+        """
+        Async version of the search method of the search backends.
+        returns: a tuple of the questions formatted for the current page and
+        the total number of matching questions.
+        """
+        start = _page_start(request)
+        if isinstance(self.search_engine, InvertedIndexSearch):
+            if self.search_engine.stale:
+                await self.run_sync(self.search_engine.refresh)
+            ids, total = self.search_engine.rank(
+                term, (start or 0) + QUESTIONS_PER_PAGE)
+            ids = ids[start:] if start is not None else []
+            if not ids:
+                return [], total
+            async with self.connect(request) as connection:
+                rows = {row[0]: row[1:] for row in await connection.execute(
+                    select(Question.id, *question_columns(fields)).where(
+                        Question.id.in_(ids)))}
+            return [dict(zip(fields, rows[question_id]))
+                    for question_id in ids if question_id in rows], total
+
+        condition, rank = self.search_engine.match(term)
+        page = select(*question_columns(fields)).where(condition)
+        after = request.args.get('after', None, type=int)
+        if rank is None and after is not None:
+            # Keyset pagination in id order, as in paginate_questions.
+            page = page.where(Question.id > after).order_by(Question.id)
+        elif start is not None:
+            order = [Question.id] if rank is None else [rank.desc(),
+                                                        Question.id]
+            page = page.order_by(*order).offset(start)
+        else:
+            page = None
+
+        async with self.connect(request) as connection:
+            total = await connection.scalar(
+                select(func.count(Question.id)).where(condition))
+            if page is None:
+                return [], total
+            rows = await connection.execute(page.limit(QUESTIONS_PER_PAGE))
+            return format_rows(rows, fields), total
+
+
+def _error(status):
+    return {
+        'success': False,
+        'error': status,
+        'message': ERROR_MESSAGES.get(status, ERROR_MESSAGES[500])
+    }
+
+
+async def _read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+def create_asgi_app(test_config=None):
+    """ create the ASGI app, wrapping the Flask app of create_app """
+    return AsyncTrivia(create_app(test_config))
@@ -0,0 +1,394 @@
+"""
+Streaming bulk import and export of questions, as NDJSON or CSV.
+Rows are read, validated and written batch by batch so memory use doesn't
+depend on the size of the file.
+Batch deletes and updates of the questions selected by ids or by a filter,
+run as set-based statements in a single transaction.
+"""
+import csv
+import io
+import json
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from .models import (db, Question, Change, notify_changes, question_digest,
+                     read_engine, record_revisions)
+
+BULK_BATCH_SIZE = 1000  # Rows inserted or exported per statement.
+MAX_REPORTED_ERRORS = 100  # Invalid rows listed in an import report.
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv'
+}
+EXPORT_FIELDS = ['id', 'question', 'answer', 'category', 'difficulty']
+DIFFICULTIES = range(1, 6)
+FILTER_FIELDS = ('category', 'difficulty')  # Filters of the batch writes.
+UPDATE_FIELDS = ('category', 'difficulty')  # Fields set by batch updates.
+
+
+class ImportReport:
+    """Outcome of an import, returned as JSON by the import endpoint."""
+
+    def __init__(self):
+        self.imported = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.errors = []
+
+    def error(self, line, message):
+        self.invalid += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'message': message})
+
+    def format(self):
+        return {
+            'imported': self.imported,
+            'duplicates': self.duplicates,
+            'invalid': self.invalid,
+            'errors': self.errors
+        }
+
+
+class BatchReport:
+    """Outcome of a batch write, returned as JSON by the batch endpoints."""
+
+    def __init__(self, status):
+        self.status = status  # 'deleted' or 'updated'
+        self.count = 0
+        self.not_found = 0
+        self.results = []
+
+    def add(self, ids, found):
+        """
+        @param: ids ids of the batch, in the order they were requested.
+        @param: found ids of the batch that were written.
+        """
+        for question_id in ids:
+            if question_id in found:
+                self.count += 1
+                self.results.append({'id': question_id,
+                                     'status': self.status})
+            else:
+                self.not_found += 1
+                self.results.append({'id': question_id,
+                                     'status': 'not_found'})
+
+    def format(self):
+        return {
+            self.status: self.count,
+            'not_found': self.not_found,
+            'results': self.results
+        }
+
+
+def _read_ndjson(lines):
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, None
+
+
+def _read_csv(lines):
+    reader = csv.DictReader(lines)
+    for row in reader:
+        yield reader.line_num, row
+
+
+READERS = {
+    'ndjson': _read_ndjson,
+    'csv': _read_csv
+}
+
+
+def validate(row, categories):
+    """
+    @param: row a parsed line of the imported file.
+    @param: categories ids of the existing categories.
+    returns: a tuple of the column values of the question and None, or of
+    None and an error message when the row is invalid.
+    """
+    if not isinstance(row, dict):
+        return None, 'Malformed row'
+
+    question = row.get('question')
+    answer = row.get('answer')
+    if not isinstance(question, str) or not question.strip() or \
+            not isinstance(answer, str) or not answer.strip():
+        return None, 'Question and answer are required'
+    try:
+        category = int(row.get('category'))
+        difficulty = int(row.get('difficulty'))
+    except (TypeError, ValueError):
+        return None, 'Category and difficulty must be integers'
+    if category not in categories:
+        return None, f'Unknown category {category}'
+    if difficulty not in DIFFICULTIES:
+        return None, f'Difficulty must be between 1 and {DIFFICULTIES[-1]}'
+
+    return {
+        'question': question,
+        'answer': answer,
+        'category': category,
+        'difficulty': difficulty,
+        'question_hash': question_digest(question)
+    }, None
+
+
+def import_questions(lines, format, categories, batch_size=BULK_BATCH_SIZE):
+    """
+    Insert the questions of a NDJSON or CSV file, one transaction per batch.
+    Invalid rows and duplicates of existing questions are skipped.
+    @param: lines iterable over the lines of the file.
+    @param: format 'ndjson' or 'csv'.
+    @param: categories ids of the existing categories.
+    @param: batch_size number of rows inserted per transaction.
+    returns: the ImportReport of the import.
+    """
+    report = ImportReport()
+    batch = []
+    for line, row in READERS[format](lines):
+        values, message = validate(row, categories)
+        if message is not None:
+            report.error(line, message)
+            continue
+        batch.append(values)
+        if len(batch) >= batch_size:
+            _insert_batch(batch, report)
+            batch = []
+    if batch:
+        _insert_batch(batch, report)
+
+    return report
+
+
+def _insert_batch(batch, report):
+    table = Question.__table__
+    unique = {}
+    for values in batch:
+        unique.setdefault(values['question_hash'], values)
+
+    # The batch is retried once if a concurrent write inserted one of its
+    # questions between the duplicate check and the insert.
+    for attempt in range(2):
+        try:
+            with db.engine.begin() as connection:
+                existing = {digest for digest, in connection.execute(
+                    select(table.c.question_hash).where(
+                        table.c.question_hash.in_(list(unique))))}
+                rows = [values for digest, values in unique.items()
+                        if digest not in existing]
+                changes = []
+                if rows:
+                    connection.execute(table.insert(), rows)
+                    # Read the ids back for the change feed and listeners.
+                    inserted = connection.execute(
+                        select(*(table.c[field] for field in EXPORT_FIELDS))
+                        .where(table.c.question_hash.in_(
+                            [values['question_hash'] for values in rows]))
+                    ).fetchall()
+                    changes = [Change('insert', 'questions',
+                                      dict(row._mapping), None)
+                               for row in inserted]
+                    record_revisions(connection, changes)
+            break
+        except IntegrityError:
+            if attempt:
+                raise
+
+    report.imported += len(rows)
+    report.duplicates += len(batch) - len(rows)
+    if changes:
+        notify_changes(changes)
+
+
+def export_questions(format, batch_size=BULK_BATCH_SIZE):
+    """
+    Generate the questions of the table as NDJSON or CSV chunks. Rows are
+    fetched from a server-side cursor where the driver supports it, on the
+    replica of the request if there is one.
+    @param: format 'ndjson' or 'csv'.
+    @param: batch_size number of rows per chunk.
+    """
+    table = Question.__table__
+    query = select(*(table.c[field] for field in EXPORT_FIELDS)).order_by(
+        table.c.id)
+
+    connection = read_engine().connect().execution_options(
+        stream_results=True)
+    try:
+        result = connection.execute(query)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if format == 'csv':
+            writer.writerow(EXPORT_FIELDS)
+            yield _drain(buffer)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                if format == 'csv':
+                    writer.writerow(row)
+                else:
+                    buffer.write(json.dumps(dict(zip(EXPORT_FIELDS, row))))
+                    buffer.write('\n')
+            yield _drain(buffer)
+    finally:
+        connection.close()
+
+
+def _drain(buffer):
+    chunk = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return chunk
+
+
+def _integer(value):
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError(f'{value!r} is not an integer')
+    return value
+
+
+def parse_selection(data):
+    """
+    @param: data the JSON body of a batch write, holding either a list of
+    question ids or a filter object on FILTER_FIELDS.
+    returns: a tuple of the list of ids, without duplicates, and None, or of
+    None and the dict of the filter values.
+    raises: ValueError if the selection is invalid.
+    """
+    if not isinstance(data, dict) or ('ids' in data) == ('filter' in data):
+        raise ValueError('Either ids or filter is required')
+    if 'ids' in data:
+        ids = data['ids']
+        if not isinstance(ids, list) or not ids:
+            raise ValueError('ids must be a non empty list')
+        return list(dict.fromkeys(_integer(value) for value in ids)), None
+
+    filters = data['filter']
+    if not isinstance(filters, dict) or not filters or \
+            not filters.keys() <= set(FILTER_FIELDS):
+        raise ValueError(f'filter must be on {", ".join(FILTER_FIELDS)}')
+    return None, {field: _integer(value) for field, value in filters.items()}
+
+
+def parse_values(values, categories):
+    """
+    @param: values the object of the fields set by a batch update.
+    @param: categories ids of the existing categories.
+    returns: the dict of the new values.
+    raises: ValueError if the values are invalid.
+    """
+    if not isinstance(values, dict) or not values or \
+            not values.keys() <= set(UPDATE_FIELDS):
+        raise ValueError(f'values must set {", ".join(UPDATE_FIELDS)}')
+    values = {field: _integer(value) for field, value in values.items()}
+    if 'category' in values and values['category'] not in categories:
+        raise ValueError(f'Unknown category {values["category"]}')
+    if 'difficulty' in values and values['difficulty'] not in DIFFICULTIES:
+        raise ValueError(
+            f'Difficulty must be between 1 and {DIFFICULTIES[-1]}')
+    return values
+
+
+def _selected_batches(connection, ids, filters, batch_size):
+    """
+    Generate the selected questions batch by batch, locking their rows
+    until the end of the transaction.
+    yields: tuples of the ids of the batch and of a dict mapping the ids
+    found to their rows, as dicts of the EXPORT_FIELDS.
+    """
+    table = Question.__table__
+    query = select(*(table.c[field] for field in EXPORT_FIELDS))
+    if ids is not None:
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            rows = connection.execute(query.where(
+                table.c.id.in_(batch)).with_for_update())
+            yield batch, {row[0]: dict(zip(EXPORT_FIELDS, row))
+                          for row in rows}
+        return
+
+    # Keyset pagination in id order, rows already written are skipped even
+    # when they don't match the filter anymore.
+    query = query.where(*(table.c[field] == value
+                          for field, value in filters.items()))
+    after = None
+    while True:
+        page = query if after is None else query.where(table.c.id > after)
+        rows = connection.execute(page.order_by(table.c.id).limit(
+            batch_size).with_for_update()).fetchall()
+        if not rows:
+            return
+        after = rows[-1][0]
+        yield [row[0] for row in rows], {
+            row[0]: dict(zip(EXPORT_FIELDS, row)) for row in rows}
+
+
+def delete_questions(ids, filters, batch_size=BULK_BATCH_SIZE):
+    """
+    Delete the selected questions in a single transaction, with one DELETE
+    statement per batch.
+    @param: ids, filters the selection returned by parse_selection.
+    @param: batch_size number of questions deleted per statement.
+    returns: the BatchReport of the deletes.
+    """
+    table = Question.__table__
+    report = BatchReport('deleted')
+    changes = []
+    with db.engine.begin() as connection:
+        for batch, found in _selected_batches(connection, ids, filters,
+                                              batch_size):
+            if found:
+                connection.execute(
+                    table.delete().where(table.c.id.in_(list(found))))
+            report.add(batch, found)
+            deleted = [Change('delete', 'questions', row, None)
+                       for row in found.values()]
+            record_revisions(connection, deleted)
+            changes.extend(deleted)
+
+    # The listeners are notified once, after the commit.
+    if changes:
+        notify_changes(changes)
+    return report
+
+
+def update_questions(ids, filters, values, batch_size=BULK_BATCH_SIZE):
+    """
+    Set the same values on the selected questions in a single transaction,
+    with one UPDATE statement per batch.
+    @param: ids, filters the selection returned by parse_selection.
+    @param: values dict returned by parse_values.
+    @param: batch_size number of questions updated per statement.
+    returns: the BatchReport of the updates.
+    """
+    table = Question.__table__
+    report = BatchReport('updated')
+    changes = []
+    with db.engine.begin() as connection:
+        for batch, found in _selected_batches(connection, ids, filters,
+                                              batch_size):
+            if found:
+                connection.execute(table.update().where(
+                    table.c.id.in_(list(found))).values(**values))
+            report.add(batch, found)
+            updated = []
+            for row in found.values():
+                previous = {field: row[field] for field, value
+                            in values.items() if row[field] != value}
+                if previous:
+                    updated.append(Change('update', 'questions',
+                                          dict(row, **values), previous))
+            record_revisions(connection, updated)
+            changes.extend(updated)
+
+    if changes:
+        notify_changes(changes)
+    return report
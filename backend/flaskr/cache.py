@@ -0,0 +1,292 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, current_app, g, request
+from sqlalchemy.exc import SQLAlchemyError
+
+from .feed import current_revision
+from .models import db, Category, on_primary
+from .utils import format_category_list
+
+RESPONSE_CACHE_SIZE = 512  # Response bodies kept in memory, 0 disables it.
+RESPONSE_CACHE_TTL = 60  # Seconds before the ETags roll over.
+CATEGORY_CACHE_TTL = 60  # Seconds before the category list is reloaded.
+CATEGORY_MISS_INTERVAL = 1  # Minimum seconds between the reloads on a miss.
+COALESCE_TIMEOUT = 5  # Seconds a request waits for an identical one, 0 disables it.
+
+
+class CategoryCache:
+    """
+    In-process cache of the category list, formatted the way the UI expects
+    it. Loaded from the db on first use, invalidated whenever a Category
+    row is committed by this process and reloaded every `ttl` seconds. A
+    lookup of a missing category reloads the list first, at most once every
+    CATEGORY_MISS_INTERVAL seconds, so the categories created by other
+    processes are found right away. The version number is bumped on every
+    invalidation so it can be used to build ETags.
+    """
+
+    def __init__(self, ttl=CATEGORY_CACHE_TTL):
+        self.ttl = ttl
+        self.version = 0
+        self._categories = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._categories is not None and self._age() <= self.ttl
+
+    def _age(self):
+        return time.monotonic() - self._loaded_at
+
+    def formatted(self):
+        """
+        returns: a dict mapping the category ids to their type. The dict is
+        shared by every caller and must not be modified.
+        """
+        categories = self._categories
+        if categories is None or self._age() > self.ttl:
+            with self._lock:
+                if self._categories is None or self._age() > self.ttl:
+                    with on_primary():
+                        self._categories = format_category_list(
+                            Category.query.order_by(Category.id).all())
+                    self._loaded_at = time.monotonic()
+                categories = self._categories
+        return categories
+
+    def get(self, category_id):
+        """
+        @param: category_id id of a category.
+        returns: the type of the category, or None if it doesn't exist.
+        """
+        category = self.formatted().get(category_id)
+        if category is None and self._age() > CATEGORY_MISS_INTERVAL:
+            # The category may have been created by another process.
+            self.invalidate()
+            category = self.formatted().get(category_id)
+        return category
+
+    def __contains__(self, category_id):
+        return self.get(category_id) is not None
+
+    def invalidate(self):
+        with self._lock:
+            self._categories = None
+            self.version += 1
+
+    def on_changes(self, changes):
+        """Listener invalidating the cache when a category is written."""
+        if any(change.table == 'categories' for change in changes):
+            self.invalidate()
+
+
+class ResponseCache:
+    """
+    ETags of the cacheable read endpoints, and a bounded LRU of their
+    serialized bodies keyed by ETag.
+    The data version of the ETags is the last revision recorded by the
+    writes, see record_revisions, read from the db answering the request, so
+    every worker process sees the writes of the others. Writes made outside
+    of the app record no revision and are only noticed once the ETags roll
+    over, every `ttl` seconds, so the ETags also hold the current period.
+    """
+
+    def __init__(self, size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._bodies = OrderedDict()
+        self._lock = threading.Lock()
+
+    def etag(self, key, bind=None):
+        """
+        @param: key the route and arguments of the request.
+        @param: bind the replica bind answering the request, None for the
+        primary db.
+        returns: the ETag of the response to the request for the current
+        data version, None if the version can't be read from the db.
+        """
+        try:
+            revision = current_revision()
+        except SQLAlchemyError:
+            db.session.rollback()
+            return None
+        period = int(time.time() // self.ttl)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        return f'{period}.{revision}.{bind or "primary"}.{digest}'
+
+    def get(self, etag):
+        """
+        returns: the (body, status, mimetype, compressed) stored for the
+        ETag, compressed being a dict mapping encodings to the compressed
+        body, filled by the Compressor.
+        """
+        with self._lock:
+            entry = self._bodies.get(etag)
+            if entry is not None:
+                self._bodies.move_to_end(etag)
+            return entry
+
+    def put(self, etag, entry):
+        if self.size < 1:
+            return
+        with self._lock:
+            self._bodies[etag] = entry
+            while len(self._bodies) > self.size:
+                self._bodies.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._bodies.clear()
+
+    def on_changes(self, changes):
+        """
+        Listener dropping the bodies of the former data version on question
+        or category writes, which can't be requested anymore.
+        """
+        if any(change.table in ('questions', 'categories')
+               for change in changes):
+            self.invalidate()
+
+
+def cached(response_cache, max_age=0):
+    """
+    Decorator making a GET endpoint answer conditional requests.
+    The ETag of the response is computed from the data version before the
+    endpoint runs: requests with a matching If-None-Match get a 304 and
+    stored bodies are returned without running the endpoint at all, along
+    with their compressed variants. The ETag also tells the db answering
+    the request apart, and the bodies read from a replica, which may lag
+    behind the data version, aren't stored: a client reading its own writes
+    from the primary never gets them.
+    @param: response_cache the ResponseCache of the app.
+    @param: max_age seconds clients may reuse the response without
+    revalidating it.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            bind = g.get('db_replica')
+            etag = response_cache.etag(request.full_path, bind)
+            if etag is None:
+                # The endpoint reports the db failure itself.
+                return view(*args, **kwargs)
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                entry = response_cache.get(etag)
+                if entry is not None:
+                    body, status, mimetype, compressed = entry
+                    response = Response(body, status, mimetype=mimetype)
+                    response.compressed = compressed
+                else:
+                    response = current_app.make_response(
+                        view(*args, **kwargs))
+                    if response.status_code == 200 and bind is None:
+                        response.compressed = {}
+                        response_cache.put(etag, (response.get_data(),
+                                                  response.status_code,
+                                                  response.mimetype,
+                                                  response.compressed))
+            response.set_etag(etag)
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+            return response
+        return wrapper
+    return decorator
+
+
+class _Flight:
+    """A computation in progress and, once done, its result or error."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces the identical computations running concurrently in the
+    threads of a process: the first caller of a key runs it, the callers
+    arriving while it is in flight wait for it and get its result, or its
+    exception raised again. A caller that waited `timeout` seconds runs the
+    computation itself, so a stuck computation doesn't hold the others.
+    The computations in flight when a Question or Category row is committed
+    aren't joined anymore, the callers arriving after the write must see it.
+    """
+
+    def __init__(self, timeout=COALESCE_TIMEOUT):
+        self.timeout = timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, compute):
+        """
+        @param: key hashable identifying the computation.
+        @param: compute function running the computation.
+        returns: the result of compute, run by this caller or by another.
+        """
+        if self.timeout <= 0:
+            return compute()
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            if not flight.done.wait(self.timeout):
+                return compute()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = compute()
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def on_changes(self, changes):
+        """Listener detaching the flights on question or category writes."""
+        if any(change.table in ('questions', 'categories')
+               for change in changes):
+            with self._lock:
+                self._flights.clear()
+
+
+def coalesced(single_flight):
+    """
+    Decorator sharing the response of an endpoint between the identical
+    requests it is serving concurrently, see SingleFlight. Requests are
+    identical when they have the same method, path, url parameters and
+    body, and are answered by the same db, the primary or the replicas.
+    The response is shared serialized, as its (body, status, mimetype).
+    @param: single_flight the SingleFlight of the app.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = (request.method, request.full_path, request.get_data(),
+                   'db_replica' in g)
+
+            def compute():
+                response = current_app.make_response(view(*args, **kwargs))
+                return (response.get_data(), response.status_code,
+                        response.mimetype)
+
+            body, status, mimetype = single_flight.do(key, compute)
+            return Response(body, status, mimetype=mimetype)
+        return wrapper
+    return decorator
@@ -0,0 +1,139 @@
+"""
+Compression of the responses, negotiated with the Accept-Encoding header of
+the requests. Brotli is preferred when the brotli package is installed,
+gzip otherwise. Bodies smaller than COMPRESS_MIN_SIZE are sent as they are,
+the header and the CPU would cost more than the bytes saved. Streamed
+responses, like the exports, are compressed chunk by chunk as they are
+sent, each chunk being flushed so the client can decode it on arrival.
+
+The compressed bodies of the cacheable endpoints are stored next to their
+raw body in the ResponseCache, see `cached`, so hot pages are compressed
+once per encoding instead of on every hit.
+"""
+import zlib
+from functools import partial
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from flask import request
+
+COMPRESS_MIN_SIZE = 1024  # Smallest body compressed, in bytes.
+GZIP_LEVEL = 6  # Compression level of gzip, from 1 to 9.
+BROTLI_QUALITY = 4  # Quality of brotli, from 0 to 11.
+
+# MIME types of the compressible bodies.
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'text/csv',
+                'text/plain', 'text/html')
+
+
+def encodings():
+    """returns: the supported encodings, the preferred one first"""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def compress(body, encoding, level=None):
+    """
+    @param: body the bytes to compress.
+    @param: encoding br or gzip.
+    @param: level quality of brotli or level of gzip, their default if None.
+    returns: the compressed bytes.
+    """
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY
+                               if level is None else level)
+    compressor = zlib.compressobj(GZIP_LEVEL if level is None else level,
+                                  zlib.DEFLATED, 31)
+    return compressor.compress(body) + compressor.flush()
+
+
+def compress_stream(chunks, encoding, level=None):
+    """
+    Compress the chunks of a streamed body as they are produced.
+    @param: chunks iterable of the bytes or str of the body.
+    returns: a generator of the compressed chunks.
+    """
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY
+                                       if level is None else level)
+        process, flush = compressor.process, compressor.flush
+        finish = compressor.finish
+    else:
+        compressor = zlib.compressobj(
+            GZIP_LEVEL if level is None else level, zlib.DEFLATED, 31)
+        process = compressor.compress
+        flush = partial(compressor.flush, zlib.Z_SYNC_FLUSH)
+        finish = compressor.flush
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = process(chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+class Compressor:
+    """Compresses the responses of an app for the clients accepting it."""
+
+    def __init__(self, min_size=COMPRESS_MIN_SIZE, gzip_level=GZIP_LEVEL,
+                 brotli_quality=BROTLI_QUALITY):
+        self.min_size = min_size
+        self.levels = {'gzip': gzip_level, 'br': brotli_quality}
+
+    def init_app(self, app):
+        app.after_request(self._compress)
+
+    def negotiate(self):
+        """
+        returns: the encoding of the response to the request, None if it
+        accepts none of the supported encodings.
+        """
+        return request.accept_encodings.best_match(encodings())
+
+    def _compress(self, response):
+        if response.mimetype not in COMPRESSIBLE or \
+                not 200 <= response.status_code < 300 or \
+                response.status_code == 204 or request.method == 'HEAD' or \
+                response.direct_passthrough or \
+                'Content-Encoding' in response.headers:
+            return response
+
+        # Caches must keep the encodings of the response apart.
+        response.vary.add('Accept-Encoding')
+        encoding = self.negotiate()
+        if encoding is None:
+            return response
+        level = self.levels[encoding]
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding,
+                                                level)
+            response.headers.pop('Content-Length', None)
+        else:
+            # Compressed bodies of the cached responses, see `cached`.
+            variants = getattr(response, 'compressed', None)
+            body = variants.get(encoding) if variants is not None else None
+            if body is None:
+                data = response.get_data()
+                if len(data) < self.min_size:
+                    return response
+                body = compress(data, encoding, level)
+                if variants is not None:
+                    variants[encoding] = body
+            response.set_data(body)
+
+        response.headers['Content-Encoding'] = encoding
+        # The compressed body differs from the one of the ETag, the ETag
+        # becomes weak as it still identifies the same content.
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag(etag, weak=True)
+        return response
@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import func
+
+from .models import db, Question, on_primary
+
+COUNTERS_TTL = 60  # Seconds before the counters are reloaded from the db.
+
+
+def _as_key(value):
+    """
+    Category ids and difficulties are sent as ints or strings by the UI.
+    returns: the value as an int when possible.
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+class QuestionCounters:
+    """
+    Question totals, globally, per category and per difficulty.
+    Loaded with a single grouped COUNT query and then maintained from the
+    committed question changes, so writes don't need to count the table.
+    Writes made by other processes are picked up when the counters are
+    reloaded, every `ttl` seconds.
+    With a QuestionSnapshot the totals are read from it instead, so they
+    are shared by the worker processes and never counted by the db.
+    """
+
+    def __init__(self, ttl=COUNTERS_TTL, snapshot=None):
+        self.ttl = ttl
+        self.snapshot = snapshot
+        self._counts = None  # (category, difficulty) -> number of questions
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Count the questions of the table, on the primary db."""
+        with on_primary():
+            rows = db.session.query(
+                Question.category, Question.difficulty,
+                func.count(Question.id)
+            ).group_by(Question.category, Question.difficulty).all()
+        counts = Counter()
+        for category, difficulty, count in rows:
+            counts[_as_key(category), _as_key(difficulty)] += count
+        with self._lock:
+            self._counts = counts
+            self._loaded_at = time.monotonic()
+
+    def _current(self):
+        if self.snapshot is not None:
+            return self.snapshot.counts()
+        if self._counts is None or \
+                time.monotonic() - self._loaded_at > self.ttl:
+            self.load()
+        return self._counts
+
+    @property
+    def total(self):
+        return sum(self._current().values())
+
+    def by_category(self):
+        """returns: a dict mapping the category ids to their totals"""
+        totals = Counter()
+        for (category, _), count in self._current().items():
+            totals[category] += count
+        return {category: count for category, count in totals.items()
+                if count > 0}
+
+    def by_difficulty(self):
+        """returns: a dict mapping the difficulties to their totals"""
+        totals = Counter()
+        for (_, difficulty), count in self._current().items():
+            totals[difficulty] += count
+        return {difficulty: count for difficulty, count in totals.items()
+                if count > 0}
+
+    def category_total(self, category):
+        """returns: the number of questions of the category"""
+        return self.by_category().get(_as_key(category), 0)
+
+    def on_changes(self, changes):
+        """Listener applying committed question changes to the totals."""
+        with self._lock:
+            if self._counts is None or self.snapshot is not None:
+                return
+            for change in changes:
+                if change.table != 'questions':
+                    continue
+                row = change.row
+                key = (_as_key(row['category']), _as_key(row['difficulty']))
+                if change.op == 'insert':
+                    self._counts[key] += 1
+                elif change.op == 'delete':
+                    self._counts[key] -= 1
+                elif change.previous.keys() & {'category', 'difficulty'}:
+                    previous = dict(row, **change.previous)
+                    self._counts[_as_key(previous['category']),
+                                 _as_key(previous['difficulty'])] -= 1
+                    self._counts[key] += 1
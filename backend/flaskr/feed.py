@@ -0,0 +1,94 @@
+"""
+Change feed of the questions and categories, read from the revisions table
+recorded by the writes, see record_revisions.
+
+A client reads the current revision, loads the data, and then asks for the
+changes after the revision it synced, getting back the latest version of
+each row written since and tombstones for the deleted ones. Compaction
+drops the history older than the retention period: revisions superseded by
+a later revision of the same row, which changes no answer, and tombstones,
+after which clients that synced before them have to reload.
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import exists, func, select
+
+from .models import db, Revision, Compaction
+
+CHANGES_PAGE_SIZE = 1000  # Revisions read per request by default.
+CHANGES_MAX_PAGE_SIZE = 10000  # Maximum number of revisions of a request.
+CHANGES_RETENTION = 7 * 24 * 3600  # Seconds of history kept by compaction.
+
+
+def current_revision():
+    """returns: the last recorded revision, 0 if there is none"""
+    return db.session.execute(
+        select(func.max(Revision.revision))).scalar() or 0
+
+
+def read_changes(since, limit=CHANGES_PAGE_SIZE):
+    """
+    @param: since the last revision synced by the client.
+    @param: limit maximum number of revisions read.
+    returns: a dict of the changes made after since, only the latest one of
+    each row, of the revision to ask the next changes from and of whether
+    more changes follow it. None if since is below the compaction horizon.
+    """
+    horizon = db.session.execute(
+        select(func.max(Compaction.horizon))).scalar()
+    if horizon is not None and since < horizon:
+        return None
+
+    revisions = Revision.query.filter(Revision.revision > since).order_by(
+        Revision.revision).limit(limit + 1).all()
+    more = len(revisions) > limit
+    revisions = revisions[:limit]
+
+    # Rows written several times are sent once, at their last revision.
+    latest = {}
+    for revision in revisions:
+        key = (revision.table_name, revision.row_id)
+        latest.pop(key, None)
+        latest[key] = revision
+
+    return {
+        'changes': [revision.format() for revision in latest.values()],
+        'revision': revisions[-1].revision if revisions else since,
+        'more': more
+    }
+
+
+def compact_changes(retention=CHANGES_RETENTION):
+    """
+    Drop the revisions older than the retention period that were superseded
+    by a later revision of the same row, and the older tombstones.
+    @param: retention seconds of history to keep.
+    returns: a message describing the changes.
+    """
+    table = Revision.__table__
+    cutoff = datetime.utcnow() - timedelta(seconds=retention)
+    with db.engine.begin() as connection:
+        last = connection.scalar(select(func.max(table.c.revision)).where(
+            table.c.created_at < cutoff))
+        if last is None:
+            return 'nothing to compact'
+
+        later = table.alias('later')
+        superseded = connection.execute(table.delete().where(
+            table.c.revision <= last,
+            exists().where(later.c.table_name == table.c.table_name,
+                           later.c.row_id == table.c.row_id,
+                           later.c.revision > table.c.revision))).rowcount
+
+        tombstones = table.c.revision <= last, table.c.op == 'delete'
+        horizon = connection.scalar(
+            select(func.max(table.c.revision)).where(*tombstones))
+        dropped = 0
+        if horizon is not None:
+            dropped = connection.execute(
+                table.delete().where(*tombstones)).rowcount
+            connection.execute(Compaction.__table__.insert().values(
+                horizon=horizon, compacted_at=datetime.utcnow()))
+
+    return f'removed {superseded} superseded revisions and {dropped} ' \
+        f'tombstones'
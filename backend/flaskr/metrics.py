@@ -0,0 +1,173 @@
+"""
+Request instrumentation exposed in the Prometheus text format.
+Records per endpoint latency, and the number of SQL statements, the time
+spent in SQL and the number of rows loaded by every request, as ORM
+instances or as the plain tuples of the formatted questions.
+"""
+import bisect
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .models import db
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, 250, 1000, 10000)
+
+
+class Histogram:
+    """Cumulative histogram over fixed buckets, as defined by Prometheus."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield f'{name}_bucket', dict(labels, le=str(bound)), cumulative
+        yield f'{name}_sum', labels, self.sum
+        yield f'{name}_count', labels, self.count
+
+
+HISTOGRAMS = {
+    'trivia_request_duration_seconds': (
+        'Time spent handling requests.', LATENCY_BUCKETS),
+    'trivia_request_sql_statements': (
+        'SQL statements executed per request.', COUNT_BUCKETS),
+    'trivia_request_sql_duration_seconds': (
+        'Time spent executing SQL statements per request.', LATENCY_BUCKETS),
+    'trivia_request_rows_loaded': (
+        'ORM rows loaded per request.', COUNT_BUCKETS),
+}
+
+
+def _labels(labels):
+    return ','.join(f'{key}="{value}"' for key, value in labels.items())
+
+
+class Metrics:
+    """Collects the measures of the requests handled by an app."""
+
+    def __init__(self):
+        self._requests = {}  # (endpoint, method, status) -> requests
+        self._histograms = {}  # (name, endpoint) -> Histogram
+        self._lock = threading.Lock()
+        self.startup_seconds = None  # Time spent creating the app.
+
+    def init_app(self, app):
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+
+    def _start_request(self):
+        g.metrics = {'start': time.perf_counter(), 'statements': 0,
+                     'sql_duration': 0, 'rows': 0}
+
+    def _end_request(self, response):
+        measures = g.pop('metrics', None)
+        if measures is None:
+            return response
+
+        endpoint = request.endpoint or 'none'
+        values = {
+            'trivia_request_duration_seconds':
+                time.perf_counter() - measures['start'],
+            'trivia_request_sql_statements': measures['statements'],
+            'trivia_request_sql_duration_seconds': measures['sql_duration'],
+            'trivia_request_rows_loaded': measures['rows'],
+        }
+        key = (endpoint, request.method, response.status_code)
+        with self._lock:
+            self._requests[key] = self._requests.get(key, 0) + 1
+            for name, value in values.items():
+                histogram = self._histograms.get((name, endpoint))
+                if histogram is None:
+                    histogram = Histogram(HISTOGRAMS[name][1])
+                    self._histograms[name, endpoint] = histogram
+                histogram.observe(value)
+        return response
+
+    def render(self):
+        """returns: the metrics in the Prometheus text exposition format"""
+        lines = [
+            '# HELP trivia_requests_total Requests handled.',
+            '# TYPE trivia_requests_total counter'
+        ]
+        with self._lock:
+            for (endpoint, method, status), count in sorted(
+                    self._requests.items()):
+                labels = _labels({'endpoint': endpoint, 'method': method,
+                                  'status': status})
+                lines.append(f'trivia_requests_total{{{labels}}} {count}')
+
+            for name, (description, _) in HISTOGRAMS.items():
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} histogram')
+                for (histogram_name, endpoint), histogram in sorted(
+                        self._histograms.items(), key=lambda item: item[0]):
+                    if histogram_name != name:
+                        continue
+                    for sample, labels, value in histogram.samples(
+                            name, {'endpoint': endpoint}):
+                        lines.append(f'{sample}{{{_labels(labels)}}} {value}')
+
+        if self.startup_seconds is not None:
+            lines += [
+                '# HELP trivia_app_startup_seconds Time spent creating the '
+                'app.',
+                '# TYPE trivia_app_startup_seconds gauge',
+                f'trivia_app_startup_seconds {self.startup_seconds}'
+            ]
+
+        return '\n'.join(lines) + '\n'
+
+
+def _request_measures():
+    if has_request_context():
+        return g.get('metrics')
+    return None
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_statement(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['metrics_start'].pop()
+    measures = _request_measures()
+    if measures is not None:
+        measures['statements'] += 1
+        measures['sql_duration'] += duration
+
+
+@event.listens_for(db.Model, 'load', propagate=True)
+def _count_row(instance, context):
+    measures = _request_measures()
+    if measures is not None:
+        measures['rows'] += 1
+
+
+def count_rows(count):
+    """
+    Count rows selected as plain tuples, which the ORM load event misses,
+    in the measures of the current request.
+    @param: count number of rows read.
+    """
+    measures = _request_measures()
+    if measures is not None:
+        measures['rows'] += count
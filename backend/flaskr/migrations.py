@@ -0,0 +1,159 @@
+"""
+Schema migrations for databases created before a column or an index was
+added to the models. Every migration is idempotent and runs in its own
+transaction, `flask upgrade-db` applies them in order.
+"""
+from sqlalchemy import Integer, inspect, text
+
+from .models import Revision, Compaction, question_digest
+
+BACKFILL_BATCH_SIZE = 1000  # Rows updated per statement by the backfills.
+
+
+def _columns(connection, table):
+    return {column['name'] for column in inspect(connection).get_columns(table)}
+
+
+def _indexes(connection, table):
+    return {index['name'] for index in inspect(connection).get_indexes(table)}
+
+
+def add_question_hash(connection):
+    '''
+    adds the question_hash column, backfills it and creates its unique index.
+    When existing questions are duplicates of each other only the oldest one
+    gets a hash, the others are reported and left without one.
+    @param: connection: connection to the db, inside a transaction.
+    returns: a message describing the changes.
+    '''
+    changes = []
+    if 'question_hash' not in _columns(connection, 'questions'):
+        connection.execute(text(
+            'ALTER TABLE questions ADD COLUMN question_hash VARCHAR(64)'))
+        changes.append('added column')
+
+    seen = {digest for digest, in connection.execute(text(
+        'SELECT question_hash FROM questions '
+        'WHERE question_hash IS NOT NULL'))}
+    select = text('SELECT id, question FROM questions '
+                  'WHERE question_hash IS NULL AND id > :last_id '
+                  'ORDER BY id LIMIT :limit')
+    update = text('UPDATE questions SET question_hash = :digest '
+                  'WHERE id = :id')
+    backfilled, duplicates, last_id = 0, [], -1
+    while True:
+        rows = connection.execute(
+            select, last_id=last_id, limit=BACKFILL_BATCH_SIZE).fetchall()
+        if not rows:
+            break
+        updates = []
+        for question_id, question in rows:
+            digest = question_digest(question)
+            if digest in seen:
+                duplicates.append(question_id)
+                continue
+            seen.add(digest)
+            updates.append({'id': question_id, 'digest': digest})
+        if updates:
+            connection.execute(update, updates)
+        backfilled += len(updates)
+        last_id = rows[-1][0]
+    if backfilled:
+        changes.append(f'backfilled {backfilled} rows')
+    if duplicates:
+        changes.append(f'left duplicate questions {duplicates} without hash')
+
+    if 'ix_questions_question_hash' not in _indexes(connection, 'questions'):
+        connection.execute(text(
+            'CREATE UNIQUE INDEX ix_questions_question_hash '
+            'ON questions (question_hash)'))
+        changes.append('created unique index')
+
+    return ', '.join(changes)
+
+
+def convert_question_category(connection):
+    '''
+    turns questions.category into an integer foreign key to categories.id,
+    and creates the composite indexes of the category listing and quizzes.
+    Categories that aren't the id of an existing category are set to NULL,
+    the way the foreign key treats deleted categories.
+    SQLite can't alter the type of a column: there the column keeps the
+    type it was created with and only the indexes are added.
+    @param: connection: connection to the db, inside a transaction.
+    returns: a message describing the changes.
+    '''
+    changes = []
+    column = next(column for column in
+                  inspect(connection).get_columns('questions')
+                  if column['name'] == 'category')
+    if connection.dialect.name == 'postgresql':
+        if not isinstance(column['type'], Integer):
+            orphans = connection.execute(text(
+                "UPDATE questions SET category = NULL "
+                "WHERE CASE WHEN category ~ '^[0-9]{1,9}$' "
+                "THEN category::integer NOT IN (SELECT id FROM categories) "
+                "ELSE category IS NOT NULL END")).rowcount
+            if orphans:
+                changes.append(f'cleared {orphans} unknown categories')
+            connection.execute(text(
+                'ALTER TABLE questions ALTER COLUMN category TYPE integer '
+                'USING category::integer'))
+            changes.append('converted column to integer')
+        foreign_keys = inspect(connection).get_foreign_keys('questions')
+        if not any(key['constrained_columns'] == ['category']
+                   for key in foreign_keys):
+            connection.execute(text(
+                'ALTER TABLE questions ADD CONSTRAINT category '
+                'FOREIGN KEY (category) REFERENCES categories (id) '
+                'ON UPDATE CASCADE ON DELETE SET NULL'))
+            changes.append('added foreign key')
+    elif not isinstance(column['type'], Integer):
+        changes.append(f'kept {column["type"]} column on '
+                       f'{connection.dialect.name}')
+
+    indexes = _indexes(connection, 'questions')
+    for name, columns in (('ix_questions_category_id', 'category, id'),
+                          ('ix_questions_category_difficulty',
+                           'category, difficulty')):
+        if name not in indexes:
+            connection.execute(text(
+                f'CREATE INDEX {name} ON questions ({columns})'))
+            changes.append(f'created index {name}')
+
+    return ', '.join(changes)
+
+
+def add_revisions(connection):
+    '''
+    creates the revisions and compactions tables of the change feed. The
+    history starts with the first write after the upgrade.
+    @param: connection: connection to the db, inside a transaction.
+    returns: a message describing the changes.
+    '''
+    changes = []
+    tables = set(inspect(connection).get_table_names())
+    for model in (Revision, Compaction):
+        if model.__tablename__ not in tables:
+            model.__table__.create(connection)
+            changes.append(f'created table {model.__tablename__}')
+    return ', '.join(changes)
+
+
+MIGRATIONS = [
+    add_question_hash,
+    convert_question_category,
+    add_revisions,
+]
+
+
+def upgrade(engine, echo=print):
+    '''
+    applies every migration to the db.
+    @param: engine: SQLAlchemy engine of the db.
+    @param: echo: callable receiving a progress message per migration.
+    '''
+    for migration in MIGRATIONS:
+        with engine.begin() as connection:
+            message = migration(connection)
+        echo(f'{migration.__name__}: {message or "up to date"}')
@@ -1,40 +1,182 @@
-from sqlalchemy import Column, String, Integer
-from sqlalchemy.engine.url import URL
-from flask_sqlalchemy import SQLAlchemy
+import hashlib
+import os
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import current_app, g, has_app_context
+from sqlalchemy import (Column, String, Integer, DateTime, JSON, ForeignKey,
+                        Index, event, inspect, orm, text)
+from sqlalchemy.engine.url import URL, make_url
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 
 from dotenv import dotenv_values
 
-config = dotenv_values('.env')
+# Connection pool of every worker process. With N gunicorn workers the db
+# sees up to N * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections.
+DB_POOL_SIZE = 5  # Connections kept open per process.
+DB_MAX_OVERFLOW = 10  # Connections opened above the pool size under load.
+DB_POOL_TIMEOUT = 30  # Seconds to wait for a free connection.
+DB_POOL_RECYCLE = 1800  # Seconds before a connection is replaced.
+DB_POOL_PRE_PING = True  # Test connections when they leave the pool.
+
+REPLICA_BIND_PREFIX = 'replica_'  # Binds of the read replicas.
+REVISIONS_LOCK = 7321  # PostgreSQL advisory lock of the revision writers.
+
+
+class RoutingSession(SignallingSession):
+    '''
+    Session sending the queries of read-only requests to the replica bind
+    picked for the request, see replicas.py. Flushes, and the queries of
+    every other request, go to the primary db.
+    '''
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = _request_replica()
+        if replica is not None and not self._flushing:
+            return self.db.get_engine(self.app, bind=replica)
+        return super().get_bind(mapper, clause)
+
 
-# URI for the local db. The values should be retrieved from the environment variables
-# existing in the .env file.
-DB_URI = {
-    'drivername': config['DRIVER_NAME'],
-    'username': config['USERNAME'],
-    'password': config['PASSWORD'],
-    'host': config['HOST'],
-    'port': config['DB_PORT'],
-    'database': config['DB_NAME']
-}
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
 
-# Create the db path
-database_path = URL(**DB_URI)
 
 # Create and instance of the db
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+
+def _request_replica():
+    return g.get('db_replica') if has_app_context() else None
+
+
+def read_engine():
+    '''
+    returns: the engine of the replica the current request reads from, or
+    the one of the primary db. Used by reads bypassing the session.
+    '''
+    return db.get_engine(bind=_request_replica())
+
+
+@contextmanager
+def on_primary():
+    '''
+    sends the queries of the block to the primary db, for the reads that
+    must see every committed write, such as the loads of the in-process
+    indexes maintained from the change notifications.
+    '''
+    replica = g.pop('db_replica', None) if has_app_context() else None
+    try:
+        yield
+    finally:
+        if replica is not None:
+            g.db_replica = replica
+
+
+def environment():
+    '''
+    returns: the values of the .env file, if there is one, overridden by the
+    environment variables.
+    '''
+    return dict(dotenv_values('.env'), **os.environ)
 
 
-def setup_db(app, database_path=database_path):
+def database_url(values):
     '''
-    binds a flask application and a SQLAlchemy service
+    builds the url of the db.
+    @param: values: mapping holding the DRIVER_NAME, USERNAME, PASSWORD,
+    HOST, DB_PORT and DB_NAME values, as in the .env file.
+    '''
+    return URL.create(
+        drivername=values.get('DRIVER_NAME') or 'postgresql',
+        username=values.get('USERNAME') or None,
+        password=values.get('PASSWORD') or None,
+        host=values.get('HOST') or None,
+        port=int(values['DB_PORT']) if values.get('DB_PORT') else None,
+        database=values.get('DB_NAME') or None)
+
+
+def setting(config, key, default):
+    '''
+    returns: the value of a setting, from the app config, the environment or
+    the default, converted to the type of the default.
+    @param: config: config of the flask application.
+    @param: key: name of the setting.
+    @param: default: value used when the setting isn't set.
+    '''
+    value = config.get(key, os.environ.get(key))
+    if value is None:
+        return default
+    if isinstance(default, bool) and isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return type(default)(value)
+
+
+def engine_options(config, url):
+    '''
+    returns: the create_engine options of the pool, from the DB_POOL_*
+    settings.
+    @param: config: config of the flask application.
+    @param: url: url of the db.
+    '''
+    options = {
+        'pool_pre_ping': setting(config, 'DB_POOL_PRE_PING',
+                                 DB_POOL_PRE_PING),
+        'pool_recycle': setting(config, 'DB_POOL_RECYCLE', DB_POOL_RECYCLE)
+    }
+    # SQLite connections aren't pooled by size.
+    if make_url(url).get_backend_name() != 'sqlite':
+        options.update(
+            pool_size=setting(config, 'DB_POOL_SIZE', DB_POOL_SIZE),
+            max_overflow=setting(config, 'DB_MAX_OVERFLOW', DB_MAX_OVERFLOW),
+            pool_timeout=setting(config, 'DB_POOL_TIMEOUT', DB_POOL_TIMEOUT))
+    return options
+
+
+def setup_db(app, database_path=None):
+    '''
+    binds a flask application and a SQLAlchemy service. Nothing connects to
+    the db here, the engine and its pool are created on first use and the
+    tables by the init-db command.
     @param: app: instance of the flask application.
-    @param: database_path: a path for the local db.
+    @param: database_path: url of the db. Taken from the
+    SQLALCHEMY_DATABASE_URI config value or built from the environment by
+    default.
     '''
+    if database_path is None:
+        database_path = app.config.get('SQLALCHEMY_DATABASE_URI') or \
+            database_url(environment())
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # Read replicas, listed by the DB_REPLICA_URIS config value or a comma
+    # separated environment variable, become binds of the db.
+    replicas = app.config.get('DB_REPLICA_URIS',
+                              os.environ.get('DB_REPLICA_URIS', ''))
+    if isinstance(replicas, str):
+        replicas = [url for url in replicas.split(',') if url]
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    binds.update((f'{REPLICA_BIND_PREFIX}{number}', url)
+                 for number, url in enumerate(replicas))
+    app.config["SQLALCHEMY_BINDS"] = binds
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(
+        app.config, database_path)
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+
+def question_digest(question):
+    '''
+    returns: the sha256 hex digest of the question text, ignoring case and
+    whitespace differences. Used to detect duplicate questions.
+    @param: question: text of the question.
+    '''
+    normalized = ' '.join((question or '').split()).casefold()
+    return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
 
 
 '''
@@ -45,12 +187,23 @@ Creates a db model fro the questions table.
 
 class Question(db.Model):
     __tablename__ = 'questions'
+    # The category listing is served by (category, id) in id order and the
+    # quizzes pick their questions through (category, difficulty).
+    __table_args__ = (
+        Index('ix_questions_category_id', 'category', 'id'),
+        Index('ix_questions_category_difficulty', 'category', 'difficulty'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey(
+        'categories.id', name='category', onupdate='CASCADE',
+        ondelete='SET NULL'))
     difficulty = Column(Integer)
+    # Digest of the normalized question text, kept in sync by the set event
+    # below. The unique index rejects duplicate questions atomically.
+    question_hash = Column(String(64), unique=True, index=True)
 
     def __init__(self, question, answer, category, difficulty):
         self.question = question
@@ -79,6 +232,11 @@ class Question(db.Model):
         }
 
 
+@event.listens_for(Question.question, 'set')
+def _update_question_hash(question, value, oldvalue, initiator):
+    question.question_hash = question_digest(value)
+
+
 '''
 Category
 Creates a db model for the categories table.
@@ -93,3 +251,169 @@ class Category(db.Model):
 
     def __init__(self, type):
         self.type = type
+
+    def format(self):
+        return {
+            'id': self.id,
+            'type': self.type
+        }
+
+
+'''
+Revision
+Creates a db model for the revisions table, the change feed of the
+questions and categories. Every committed write of a row is recorded with a
+new revision number, deletes as tombstones without data.
+'''
+
+
+class Revision(db.Model):
+    __tablename__ = 'revisions'
+    # Compaction looks up the later revisions of each row. Without
+    # AUTOINCREMENT SQLite reuses the number of the last revision once
+    # compaction deleted it.
+    __table_args__ = (
+        Index('ix_revisions_row', 'table_name', 'row_id', 'revision'),
+        {'sqlite_autoincrement': True},
+    )
+
+    revision = Column(Integer, primary_key=True)
+    table_name = Column(String(32), nullable=False)
+    row_id = Column(Integer, nullable=False)
+    op = Column(String(8), nullable=False)
+    data = Column(JSON)  # The row after the write, None for deletes.
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def format(self):
+        return {
+            'revision': self.revision,
+            'table': self.table_name,
+            'id': self.row_id,
+            'op': self.op,
+            'row': self.data
+        }
+
+
+'''
+Compaction
+Creates a db model for the compactions of the revisions table. Clients
+that synced up to a revision below the horizon of the last compaction
+missed tombstones and have to reload.
+'''
+
+
+class Compaction(db.Model):
+    __tablename__ = 'compactions'
+
+    id = Column(Integer, primary_key=True)
+    horizon = Column(Integer, nullable=False)
+    compacted_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+'''
+Change notifications
+Question and Category writes are collected whenever the session flushes and
+handed to the listeners registered on the app once the transaction commits.
+In-process indexes use them to stay up to date without rescanning the tables.
+'''
+
+# op is one of 'insert', 'update' or 'delete', row is the formatted row and
+# previous holds the old values of the columns changed by an update.
+Change = namedtuple('Change', ['op', 'table', 'row', 'previous'])
+
+
+def add_change_listener(app, listener):
+    '''
+    registers a callable receiving the list of committed changes.
+    @param: app: instance of the flask application.
+    @param: listener: callable taking a list of Change tuples.
+    '''
+    app.extensions.setdefault('trivia_change_listeners', []).append(listener)
+
+
+def notify_changes(changes):
+    '''
+    hands committed changes to the listeners of the current app. Used by the
+    session events below, and directly by writes bypassing the ORM session.
+    @param: changes: list of Change tuples.
+    '''
+    if has_app_context():
+        app = current_app
+    elif db.app is not None:
+        app = db.app
+    else:
+        return
+    # The changes are committed: a failing listener is logged and doesn't
+    # fail the write or keep the next listeners from running.
+    for listener in app.extensions.get('trivia_change_listeners', []):
+        try:
+            listener(changes)
+        except Exception:
+            app.logger.exception('Change listener %r failed', listener)
+
+
+def record_revisions(connection, changes):
+    '''
+    records committed changes in the revisions table. Must run in the
+    transaction of the writes so the revisions commit with them.
+    On PostgreSQL the writers recording revisions are serialized until they
+    commit, so revisions become visible in increasing order and a client
+    syncing up to a revision can't miss a lower one committed later.
+    @param: connection: connection to the db, inside a transaction.
+    @param: changes: list of Change tuples.
+    '''
+    if not changes:
+        return
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('SELECT pg_advisory_xact_lock(:key)'),
+                           {'key': REVISIONS_LOCK})
+    created_at = datetime.utcnow()
+    connection.execute(Revision.__table__.insert(), [{
+        'table_name': change.table,
+        'row_id': change.row['id'],
+        'op': change.op,
+        'data': None if change.op == 'delete' else change.row,
+        'created_at': created_at
+    } for change in changes])
+
+
+def _changed_values(instance):
+    previous = {}
+    for attr in inspect(instance).attrs:
+        history = attr.history
+        if history.has_changes() and history.deleted:
+            previous[attr.key] = history.deleted[0]
+    return previous
+
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_changes(session, flush_context):
+    changes = []
+    for op, instances in (('insert', session.new),
+                          ('update', session.dirty),
+                          ('delete', session.deleted)):
+        for instance in instances:
+            if not isinstance(instance, (Question, Category)):
+                continue
+            previous = None
+            if op == 'update':
+                previous = _changed_values(instance)
+                if not previous:
+                    continue
+            changes.append(Change(op, instance.__tablename__,
+                                  instance.format(), previous))
+    if changes:
+        record_revisions(session.connection(), changes)
+        session.info.setdefault('trivia_changes', []).extend(changes)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _dispatch_changes(session):
+    changes = session.info.pop('trivia_changes', None)
+    if changes:
+        notify_changes(changes)
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _discard_changes(session, previous_transaction):
+    session.info.pop('trivia_changes', None)
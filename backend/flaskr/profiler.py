@@ -0,0 +1,215 @@
+"""
+On-demand profiling of requests.
+A request is profiled when it sends the PROFILE_TOKEN in its X-Profile-Token
+header, or when it is drawn by the PROFILE_SAMPLE_RATE. The handler runs
+under cProfile, the SQL statements slower than SLOW_QUERY_SECONDS are
+recorded with their EXPLAIN plan and the statements repeated at least
+REPEATED_STATEMENTS times, the mark of N+1 queries, are flagged. The
+profiles are kept in a bounded ring buffer browsed at /admin/profiles.
+Requests that aren't profiled only pay for a random draw and a header
+lookup.
+"""
+import cProfile
+import hmac
+import io
+import itertools
+import pstats
+import random
+import threading
+import time
+from collections import deque
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+
+from .models import db
+from .replicas import replica_binds
+
+PROFILE_SAMPLE_RATE = 0  # Fraction of the requests profiled at random.
+PROFILE_BUFFER_SIZE = 100  # Profiles kept in memory.
+SLOW_QUERY_SECONDS = 0.1  # Statements at least this slow are explained.
+REPEATED_STATEMENTS = 5  # Executions of a statement flagged as N+1 queries.
+PROFILE_FUNCTIONS = 30  # Functions listed by a profile, by cumulative time.
+MAX_SLOW_QUERIES = 20  # Slow statements recorded per profile.
+MAX_STATEMENT_LENGTH = 2000  # Characters of a statement kept in a profile.
+
+TOKEN_HEADER = 'X-Profile-Token'
+PROFILE_HEADER = 'X-Profile-Id'
+
+# Prefixes of the EXPLAIN statements, which don't run the statement.
+EXPLAIN = {
+    'postgresql': 'EXPLAIN ',
+    'sqlite': 'EXPLAIN QUERY PLAN '
+}
+
+
+def not_profiled(view):
+    """Marks an endpoint whose requests are never profiled."""
+    view.not_profiled = True
+    return view
+
+
+def _truncate(statement):
+    statement = ' '.join(statement.split())
+    if len(statement) > MAX_STATEMENT_LENGTH:
+        return statement[:MAX_STATEMENT_LENGTH] + '...'
+    return statement
+
+
+class Profiler:
+    """Profiles the requests of an app and keeps their last profiles."""
+
+    def __init__(self, token=None, sample_rate=PROFILE_SAMPLE_RATE,
+                 size=PROFILE_BUFFER_SIZE, slow_query=SLOW_QUERY_SECONDS,
+                 repeated=REPEATED_STATEMENTS):
+        self.token = token
+        self.sample_rate = sample_rate
+        self.slow_query = slow_query
+        self.repeated = repeated
+        self._profiles = deque(maxlen=size)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.before_request(self._start_request)
+        app.after_request(self._end_request)
+        # Only the statements of the app's engines are measured.
+        for bind in [None] + replica_binds(app):
+            engine = db.get_engine(app, bind=bind)
+            event.listen(engine, 'before_cursor_execute', _start_statement)
+            event.listen(engine, 'after_cursor_execute', _end_statement)
+
+    def authorized(self):
+        """returns: whether the request sent the profiling token"""
+        return self.token is not None and hmac.compare_digest(
+            request.headers.get(TOKEN_HEADER, '').encode('utf-8'),
+            self.token.encode('utf-8'))
+
+    def _start_request(self):
+        if not (self.sample_rate and random.random() < self.sample_rate) \
+                and not self.authorized():
+            return
+        view = current_app.view_functions.get(request.endpoint)
+        if getattr(view, 'not_profiled', False):
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler is already active in this thread.
+            profile = None
+        g.profile = {'start': time.perf_counter(), 'profile': profile,
+                     'statements': {}, 'slow_queries': [], 'sql_duration': 0,
+                     'slow_query': self.slow_query}
+
+    def _end_request(self, response):
+        measures = g.pop('profile', None)
+        if measures is None:
+            return response
+
+        duration = time.perf_counter() - measures['start']
+        functions = None
+        if measures['profile'] is not None:
+            measures['profile'].disable()
+            stream = io.StringIO()
+            pstats.Stats(measures['profile'], stream=stream).sort_stats(
+                'cumulative').print_stats(PROFILE_FUNCTIONS)
+            functions = stream.getvalue()
+
+        statements = measures['statements']
+        record = {
+            'id': next(self._ids),
+            'time': time.time(),
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'duration': duration,
+            'sql_statements': sum(count for count, _ in statements.values()),
+            'sql_duration': measures['sql_duration'],
+            'slow_queries': measures['slow_queries'],
+            'repeated_statements': [
+                {'statement': statement, 'count': count,
+                 'duration': total}
+                for statement, (count, total) in sorted(
+                    statements.items(), key=lambda item: -item[1][0])
+                if count >= self.repeated],
+            'profile': functions
+        }
+        with self._lock:
+            self._profiles.append(record)
+        response.headers[PROFILE_HEADER] = str(record['id'])
+        return response
+
+    def profiles(self):
+        """
+        returns: the profiles in the buffer without their details, newest
+        first.
+        """
+        with self._lock:
+            profiles = list(self._profiles)
+        return [{key: value for key, value in profile.items()
+                 if key not in ('slow_queries', 'repeated_statements',
+                                'profile')}
+                for profile in reversed(profiles)]
+
+    def get(self, profile_id):
+        """returns: the profile with the id, or None if it left the buffer"""
+        with self._lock:
+            return next((profile for profile in self._profiles
+                         if profile['id'] == profile_id), None)
+
+
+def _request_profile():
+    if has_request_context():
+        return g.get('profile')
+    return None
+
+
+def _explain(conn, statement, parameters):
+    """
+    returns: the lines of the plan of a SELECT statement, run on a cursor of
+    its own so the results of the profiled statement aren't consumed.
+    """
+    prefix = EXPLAIN.get(conn.dialect.name)
+    if prefix is None or \
+            not statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+        return None
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        # The plan is the only column on PostgreSQL, the last on SQLite.
+        return [str(row[-1]) for row in cursor.fetchall()]
+    except Exception as error:
+        return [f'EXPLAIN failed: {error}']
+    finally:
+        cursor.close()
+
+
+def _start_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    # The start is kept on the execution context, which is dropped with the
+    # statement even when it fails and after_cursor_execute never fires.
+    if context is not None and _request_profile() is not None:
+        context.profile_start = time.perf_counter()
+
+
+def _end_statement(conn, cursor, statement, parameters, context, executemany):
+    measures = _request_profile()
+    start = getattr(context, 'profile_start', None)
+    if measures is None or start is None:
+        return
+    duration = time.perf_counter() - start
+    measures['sql_duration'] += duration
+    key = _truncate(statement)
+    count, total = measures['statements'].get(key, (0, 0))
+    measures['statements'][key] = (count + 1, total + duration)
+
+    if duration >= measures['slow_query'] and not executemany and \
+            len(measures['slow_queries']) < MAX_SLOW_QUERIES:
+        measures['slow_queries'].append({
+            'statement': key,
+            'parameters': repr(parameters)[:MAX_STATEMENT_LENGTH],
+            'duration': duration,
+            'plan': _explain(conn, statement, parameters)
+        })
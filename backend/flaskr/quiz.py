@@ -0,0 +1,432 @@
+import bisect
+import itertools
+import math
+import random
+
+from itsdangerous import BadData, URLSafeTimedSerializer
+from sqlalchemy import BigInteger, and_, cast, func, or_, select
+
+from .bulk import DIFFICULTIES
+from .models import db, Question
+from .utils import QUESTION_FIELDS, question_columns, format_rows
+
+QUIZ_SESSION_TTL = 30 * 60  # Seconds a quiz token stays valid.
+QUIZ_PROBES = 4  # Expected questions found per candidate batch.
+QUIZ_BATCH_LIMIT = 256  # Maximum number of candidate ids per query.
+QUIZ_ROUND_SIZE = 5  # Questions of a round, as played by the UI.
+QUIZ_ROUND_LIMIT = 50  # Maximum number of questions of a round.
+ADAPTIVE_WINDOW = 3  # Recent answers weighed to pick the next difficulty.
+ADAPTIVE_FIRST_DIFFICULTY = 2  # Difficulty of the first adaptive question.
+ADAPTIVE_RAISE = 2 / 3  # Share of correct recent answers raising it.
+ADAPTIVE_LOWER = 1 / 3  # Share of correct recent answers lowering it.
+
+
+class QuizState:
+    """
+    Progress of a quiz round, held by the client as a signed token so the
+    server keeps no quiz state.
+    Questions are played in the order of a pseudo-random permutation of the
+    id range of the category when the round started: position k of the
+    permutation is the id first_id + (step * k + offset) % size, step being
+    coprime with size. Ids that were deleted or belong to other categories
+    are skipped, questions created after the start aren't played. The state
+    is made of the permutation and of the cursor, the number of positions
+    already played, so its size is constant and the questions already
+    played are known in constant time.
+    A category holding few of the ids of its range would take many
+    positions to find its next question: once a batch of positions found
+    none, the next question is the one of the category with the lowest
+    position left, found among the ids of the category alone.
+    """
+
+    def __init__(self, category, first_id, size, step, offset, count,
+                 cursor=0):
+        self.category = category  # None for the "All" category.
+        self.first_id = first_id
+        self.size = size
+        self.step = step
+        self.offset = offset
+        self.count = count  # Questions of the category at the start.
+        self.cursor = cursor
+
+    @classmethod
+    def start(cls, category, first_id, last_id, count):
+        """
+        Shuffle the ids of a category.
+        @param: category id of the category, None for every category.
+        @param: first_id, last_id bounds of the ids of the category.
+        @param: count number of questions of the category.
+        """
+        size = last_id - first_id + 1
+        step = random.randrange(1, size) if size > 1 else 1
+        while math.gcd(step, size) != 1:
+            step = random.randrange(1, size)
+        return cls(category, first_id, size, step, random.randrange(size),
+                   count)
+
+    @property
+    def finished(self):
+        return self.cursor >= self.size
+
+    def question_id(self, position):
+        return self.first_id + (self.step * position + self.offset) % \
+            self.size
+
+    def position(self, question_id):
+        """returns: the position of the id in the permutation"""
+        return (question_id - self.first_id - self.offset) * \
+            pow(self.step, -1, self.size) % self.size
+
+    def played(self, question_id):
+        """returns: whether the question was played in this round"""
+        return self.first_id <= question_id < self.first_id + self.size \
+            and self.position(question_id) < self.cursor
+
+    def candidates(self):
+        """
+        returns: the ids of the next positions of the permutation, enough of
+        them to expect QUIZ_PROBES questions of the category.
+        """
+        batch = math.ceil(QUIZ_PROBES * self.size / max(self.count, 1))
+        end = min(self.size, self.cursor + min(batch, QUIZ_BATCH_LIMIT))
+        return [self.question_id(position)
+                for position in range(self.cursor, end)]
+
+    def advance(self, ids, rows, excluded=()):
+        """
+        Move the cursor past the first candidate found in the db.
+        @param: ids the candidates, in the order of the permutation.
+        @param: rows the questions of the candidates found in the db, as
+        tuples of the QUESTION_FIELDS columns.
+        @param: excluded ids of questions not to play.
+        returns: the formatted question, or None if no candidate was found.
+        """
+        found = {row[0]: row for row in rows}
+        for number, question_id in enumerate(ids, 1):
+            row = found.get(question_id)
+            if row is not None and question_id not in excluded:
+                self.cursor += number
+                return dict(zip(QUESTION_FIELDS, row))
+        self.cursor += len(ids)
+        return None
+
+    def advance_to(self, row):
+        """
+        Move the cursor past the question found by position_query.
+        @param: row the question as a tuple of the QUESTION_FIELDS columns
+        followed by its position, None if no question is left.
+        returns: the formatted question, or None once every question was
+        played.
+        """
+        if row is None:
+            self.cursor = self.size
+            return None
+        self.cursor = row[-1] + 1
+        return dict(zip(QUESTION_FIELDS, row[:-1]))
+
+    def skip_to(self, snapshot, excluded=()):
+        """
+        Move the cursor past the next question of the category, found in the
+        QuestionSnapshot instead of the db.
+        returns: the id of the question, or None once every question was
+        played.
+        """
+        sections = snapshot.sections(self.category)
+        for _ in range(QUIZ_BATCH_LIMIT):
+            if self.finished:
+                return None
+            question_id = self.question_id(self.cursor)
+            self.cursor += 1
+            if question_id not in excluded and \
+                    any(_contains(ids, question_id) for ids in sections):
+                return question_id
+        if self.finished:
+            return None
+
+        # The lowest position left among the ids of the category.
+        inverse = pow(self.step, -1, self.size)
+        last_id = self.first_id + self.size - 1
+        best = next_id = None
+        for question_id in itertools.chain.from_iterable(sections):
+            if question_id > last_id or question_id < self.first_id or \
+                    question_id in excluded:
+                continue
+            position = (question_id - self.first_id - self.offset) * \
+                inverse % self.size
+            if position >= self.cursor and (best is None or position < best):
+                best, next_id = position, question_id
+        self.cursor = self.size if best is None else best + 1
+        return next_id
+
+    def dump(self):
+        return [self.category, self.first_id, self.size, self.step,
+                self.offset, self.count, self.cursor]
+
+
+class QuizTokens:
+    """Signs the quiz states sent to the clients and checks them back."""
+
+    def __init__(self, secret_key, ttl=QUIZ_SESSION_TTL):
+        self.ttl = ttl
+        self._serializer = URLSafeTimedSerializer(secret_key,
+                                                  salt='quiz-state')
+
+    def dumps(self, state):
+        return self._serializer.dumps(state.dump())
+
+    def loads(self, token):
+        """
+        returns: the state of the token, or None if it is invalid or
+        expired.
+        """
+        try:
+            return QuizState(*self._serializer.loads(token, max_age=self.ttl))
+        except (BadData, TypeError):
+            return None
+
+
+def bounds_query(category):
+    """
+    @param: category id of a category, None for every category.
+    returns: the query of the lowest id, highest id and number of questions
+    of the category, answered from the (category, id) index.
+    """
+    query = select(func.min(Question.id), func.max(Question.id),
+                   func.count(Question.id))
+    if category is not None:
+        query = query.where(Question.category == category)
+    return query
+
+
+def candidates_query(state, ids):
+    """returns: the query of the candidate questions of the category"""
+    query = select(*question_columns(QUESTION_FIELDS)).where(
+        Question.id.in_(ids))
+    if state.category is not None:
+        query = query.where(Question.category == state.category)
+    return query
+
+
+def position_query(state, excluded=()):
+    """
+    returns: the query of the question of the category with the lowest
+    position left in the permutation of the round, as a tuple of the
+    QUESTION_FIELDS columns followed by its position. It reads the
+    (category, id) index of the category instead of walking its id range.
+    """
+    # The ids of the range minus offset, plus size, are positive.
+    position = (cast(Question.id, BigInteger) -
+                (state.first_id + state.offset - state.size)) * \
+        pow(state.step, -1, state.size) % state.size
+    query = select(*question_columns(QUESTION_FIELDS), position).where(
+        Question.id.between(state.first_id, state.first_id + state.size - 1),
+        position >= state.cursor)
+    if state.category is not None:
+        query = query.where(Question.category == state.category)
+    if excluded:
+        query = query.where(Question.id.notin_(list(excluded)))
+    return query.order_by(position).limit(1)
+
+
+def start_quiz(category, snapshot=None):
+    """
+    @param: category id of a category, None for every category.
+    @param: snapshot QuestionSnapshot answering instead of the db.
+    returns: the state of a new round, or None if the category has no
+    questions.
+    """
+    if snapshot is not None:
+        first_id, last_id, count = snapshot.bounds(category)
+    else:
+        first_id, last_id, count = db.session.execute(
+            bounds_query(category)).first()
+    if not count:
+        return None
+    return QuizState.start(category, first_id, last_id, count)
+
+
+def next_question(state, excluded=(), snapshot=None):
+    """
+    Advance a round to its next question.
+    @param: state the QuizState of the round.
+    @param: excluded ids of questions not to play.
+    @param: snapshot QuestionSnapshot picking the question, which is then
+    loaded by its primary key.
+    returns: the formatted question, or None once every question was played.
+    """
+    if snapshot is not None:
+        while not state.finished:
+            question_id = state.skip_to(snapshot, excluded)
+            if question_id is None:
+                return None
+            # The question may have been deleted since the snapshot was
+            # published.
+            row = db.session.execute(
+                candidates_query(state, [question_id])).first()
+            if row is not None:
+                return dict(zip(QUESTION_FIELDS, row))
+        return None
+
+    if state.finished:
+        return None
+    ids = state.candidates()
+    question = state.advance(
+        ids, db.session.execute(candidates_query(state, ids)), excluded)
+    if question is not None or state.finished:
+        return question
+    return state.advance_to(db.session.execute(
+        position_query(state, excluded)).first())
+
+
+def parse_round(data):
+    """
+    @param: data the JSON body of a round request.
+    returns: a tuple of the category id, None for every category, the
+    number of questions of the round, the number of questions wanted per
+    difficulty or None, and the ids of the questions not to play.
+    raises: ValueError if the request is invalid.
+    """
+    try:
+        category = int(data['quiz_category']['id'])
+        mix = data.get('difficulties')
+        if mix is not None:
+            mix = {int(difficulty): int(count)
+                   for difficulty, count in mix.items()}
+            if min(mix.values(), default=-1) < 0:
+                raise ValueError('Negative number of questions')
+            mix = {difficulty: count for difficulty, count in mix.items()
+                   if count}
+            size = sum(mix.values())
+        else:
+            size = int(data.get('size', QUIZ_ROUND_SIZE))
+        excluded = {int(question_id)
+                    for question_id in data.get('previous_questions', [])}
+    except (KeyError, TypeError, AttributeError) as error:
+        raise ValueError('Malformed round request') from error
+    if not 1 <= size <= QUIZ_ROUND_LIMIT:
+        raise ValueError(f'A round has 1 to {QUIZ_ROUND_LIMIT} questions')
+    return category or None, size, mix, excluded
+
+
+def round_query(category, size, mix=None, excluded=(), snapshot=None):
+    """
+    Samples a round of distinct random questions in a single query.
+    With a difficulty mix the questions are numbered in a random order
+    within each difficulty, and the first ones wanted of each are kept.
+    @param: category id of a category, None for every category.
+    @param: size number of questions of the round.
+    @param: mix dict mapping difficulties to their number of questions.
+    @param: excluded ids of questions not to play.
+    @param: snapshot QuestionSnapshot drawing the questions, the query then
+    only loads them by their primary keys.
+    returns: the query of the questions, as tuples of the QUESTION_FIELDS
+    columns.
+    """
+    columns = question_columns(QUESTION_FIELDS)
+    if snapshot is not None:
+        return select(*columns).where(Question.id.in_(
+            snapshot.sample(category, size, mix, excluded)))
+
+    conditions = []
+    if category is not None:
+        conditions.append(Question.category == category)
+    if excluded:
+        conditions.append(Question.id.notin_(excluded))
+    if not mix:
+        return select(*columns).where(and_(True, *conditions)).order_by(
+            func.random()).limit(size)
+
+    conditions.append(Question.difficulty.in_(list(mix)))
+    draw = func.row_number().over(partition_by=Question.difficulty,
+                                  order_by=func.random())
+    sample = select(*columns, draw.label('draw')).where(
+        and_(*conditions)).subquery()
+    return select(*(sample.c[field] for field in QUESTION_FIELDS)).where(
+        or_(*(and_(sample.c.difficulty == difficulty, sample.c.draw <= count)
+              for difficulty, count in mix.items())))
+
+
+def format_round(rows):
+    """returns: the formatted questions of a round, in a random order"""
+    questions = format_rows(rows, QUESTION_FIELDS)
+    # The questions of a mix come grouped by difficulty.
+    random.shuffle(questions)
+    return questions
+
+
+def parse_adaptive(data):
+    """
+    @param: data the JSON body of an adaptive quiz request.
+    returns: a tuple of the category id, None for every category, the
+    recent answers of the player, oldest first, as (difficulty, correct)
+    tuples, and the ids of the questions not to play.
+    raises: ValueError if the request is invalid.
+    """
+    try:
+        category = int(data['quiz_category']['id'])
+        answers = [(int(answer['difficulty']), answer['correct'])
+                   for answer in data.get('answers', [])]
+        excluded = {int(question_id)
+                    for question_id in data.get('previous_questions', [])}
+    except (KeyError, TypeError, AttributeError) as error:
+        raise ValueError('Malformed adaptive quiz request') from error
+    if any(difficulty not in DIFFICULTIES or not isinstance(correct, bool)
+           for difficulty, correct in answers):
+        raise ValueError('Invalid answer')
+    return category or None, answers, excluded
+
+
+def adaptive_difficulty(answers):
+    """
+    Steps the difficulty of the last question up when most of the recent
+    answers were correct, down when most were wrong.
+    @param: answers the recent answers of the player, oldest first, as
+    (difficulty, correct) tuples.
+    returns: the difficulty of the next question.
+    """
+    if not answers:
+        return ADAPTIVE_FIRST_DIFFICULTY
+    recent = answers[-ADAPTIVE_WINDOW:]
+    difficulty = recent[-1][0]
+    score = sum(correct for _, correct in recent) / len(recent)
+    if score >= ADAPTIVE_RAISE:
+        difficulty += 1
+    elif score <= ADAPTIVE_LOWER:
+        difficulty -= 1
+    return min(max(difficulty, DIFFICULTIES[0]), DIFFICULTIES[-1])
+
+
+def adaptive_query(category, difficulty, excluded=(), snapshot=None):
+    """
+    Picks a random question of the difficulty, or of the closest difficulty
+    with questions left.
+    @param: category id of a category, None for every category.
+    @param: difficulty the difficulty wanted.
+    @param: excluded ids of questions not to play.
+    @param: snapshot QuestionSnapshot drawing the question from its
+    (category, difficulty) ids, the query then loads it by its primary key.
+    returns: the query of the question, as a tuple of the QUESTION_FIELDS
+    columns, or None if the snapshot has no question left to play.
+    """
+    difficulties = sorted(DIFFICULTIES, key=lambda candidate: (
+        abs(candidate - difficulty), candidate))
+    columns = question_columns(QUESTION_FIELDS)
+    if snapshot is not None:
+        question_id = snapshot.pick(category, difficulties, excluded)
+        if question_id is None:
+            return None
+        return select(*columns).where(Question.id == question_id)
+
+    conditions = []
+    if category is not None:
+        conditions.append(Question.category == category)
+    if excluded:
+        conditions.append(Question.id.notin_(excluded))
+    return select(*columns).where(and_(True, *conditions)).order_by(
+        func.abs(Question.difficulty - difficulty), Question.difficulty,
+        func.random()).limit(1)
+
+
+def _contains(ids, question_id):
+    position = bisect.bisect_left(ids, question_id)
+    return position < len(ids) and ids[position] == question_id
@@ -0,0 +1,104 @@
+"""
+Routing of the read-only endpoints to read replicas of the db.
+The replicas are binds of the db, see setup_db. The queries of a request to
+an endpoint marked with read_only go to the replica picked for the request,
+every other query goes to the primary db. A client that wrote something
+reads from the primary for a short while after, so it sees its own writes
+even when the replicas lag behind.
+"""
+import itertools
+import math
+import threading
+import time
+
+from flask import current_app, g, request
+
+from .models import REPLICA_BIND_PREFIX
+
+REPLICA_POLICY = 'round_robin'  # One of round_robin or least_connections.
+READ_YOUR_WRITES = 5  # Seconds a client reads from the primary after a write.
+STICKY_COOKIE = 'trivia_primary_until'
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+
+def read_only(view):
+    """Marks an endpoint whose queries can be answered by a replica."""
+    view.read_only = True
+    return view
+
+
+def replica_binds(app):
+    """returns: the sorted names of the replica binds of the app"""
+    return sorted(bind for bind in app.config.get('SQLALCHEMY_BINDS') or {}
+                  if bind.startswith(REPLICA_BIND_PREFIX))
+
+
+class ReplicaRouter:
+    """
+    Picks the replica answering each read-only request, in turn or the one
+    with the fewest requests in progress.
+    """
+
+    def __init__(self, binds, policy=REPLICA_POLICY,
+                 read_your_writes=READ_YOUR_WRITES):
+        if policy not in ('round_robin', 'least_connections'):
+            raise ValueError(f'Unknown replica policy {policy}')
+        self.binds = binds
+        self.policy = policy
+        self.read_your_writes = read_your_writes
+        self._in_progress = dict.fromkeys(binds, 0)
+        self._turns = itertools.cycle(binds)
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.before_request(self._route_request)
+        app.after_request(self._track_writes)
+        app.teardown_request(self._end_request)
+
+    def acquire(self):
+        """returns: the replica bind answering a new request"""
+        with self._lock:
+            if self.policy == 'least_connections':
+                bind = min(self.binds, key=self._in_progress.get)
+            else:
+                bind = next(self._turns)
+            self._in_progress[bind] += 1
+        return bind
+
+    def release(self, bind):
+        with self._lock:
+            self._in_progress[bind] -= 1
+
+    def _read_only(self):
+        view = current_app.view_functions.get(request.endpoint)
+        return getattr(view, 'read_only', False)
+
+    def wrote_recently(self, cookies):
+        """
+        @param: cookies the cookies of the request.
+        returns: whether the client wrote recently and reads from the
+        primary db.
+        """
+        try:
+            until = float(cookies.get(STICKY_COOKIE, 0))
+        except ValueError:
+            return False
+        return until > time.time()
+
+    def _route_request(self):
+        if self._read_only() and not self.wrote_recently(request.cookies):
+            g.db_replica = self.acquire()
+
+    def _track_writes(self, response):
+        if request.method in WRITE_METHODS and response.status_code < 400 \
+                and not self._read_only():
+            response.set_cookie(
+                STICKY_COOKIE, str(time.time() + self.read_your_writes),
+                max_age=math.ceil(self.read_your_writes), httponly=True,
+                samesite='Lax')
+        return response
+
+    def _end_request(self, exception):
+        bind = g.pop('db_replica', None)
+        if bind is not None:
+            self.release(bind)
@@ -0,0 +1,507 @@
+import bisect
+import heapq
+import math
+import re
+import threading
+import time
+from collections import Counter
+
+from flask import current_app
+from sqlalchemy import func, literal_column
+from sqlalchemy.engine import make_url
+
+from .models import db, Question, add_change_listener, on_primary
+from .utils import (QUESTIONS_PER_PAGE, QUESTION_FIELDS, paginate_questions,
+                    question_columns, format_rows, load_questions)
+
+SEARCH_BACKEND = 'auto'  # One of auto, fulltext, trigram, memory or ilike.
+SEARCH_INDEX_TTL = 60  # Seconds before the in-process indexes are reloaded.
+SUGGEST_LIMIT = 10  # Suggestions returned by default.
+SUGGEST_MAX_LIMIT = 50  # Maximum number of suggestions of a request.
+SUGGEST_MAX_TOKENS = 100000  # Distinct words kept by the suggestion index.
+SUGGEST_CACHED_PREFIX = 2  # Completions of prefixes up to this long are cached.
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+# Text search configuration used by the full-text backend. 'simple' keeps
+# stop words such as "what" searchable, like the original substring search.
+FTS_CONFIG = literal_column("'simple'::regconfig")
+
+
+def tokenize(text):
+    """
+    @param: text a question or a search term.
+    returns: the list of lower cased words of the text.
+    """
+    return TOKEN_PATTERN.findall((text or '').lower())
+
+
+def _page_start(request):
+    """returns: the offset of the requested page, or None if it is invalid"""
+    page = request.args.get('page', 1, type=int)
+    return (page - 1) * QUESTIONS_PER_PAGE if page >= 1 else None
+
+
+class IlikeSearch:
+    """
+    Case insensitive substring match on the question text.
+    Cannot use an index, every search scans the questions table.
+    """
+    name = 'ilike'
+
+    def prepare(self):
+        pass
+
+    def match(self, term):
+        """
+        @param: term the search term.
+        returns: a tuple of the condition selecting the matching questions
+        and the expression they are ranked by, None to keep the id order.
+        """
+        return Question.question.ilike(f'%{term}%'), None
+
+    def search(self, request, term, fields=QUESTION_FIELDS):
+        """
+        @param: request sent from the front-end.
+        @param: term the search term.
+        @param: fields names of the question fields to return.
+        returns: a tuple of the questions formatted for the current page and
+        the total number of matching questions.
+        """
+        condition, _ = self.match(term)
+        return paginate_questions(
+            request, Question.query.filter(condition), fields)
+
+
+class FullTextSearch:
+    """
+    PostgreSQL full-text search on a GIN indexed tsvector of the question
+    text. Results are ranked with ts_rank.
+    """
+    name = 'fulltext'
+
+    def prepare(self):
+        """Create the expression index the search queries are planned on."""
+        db.session.execute(
+            'CREATE INDEX IF NOT EXISTS ix_questions_question_fts '
+            'ON questions USING GIN '
+            "(to_tsvector('simple'::regconfig, question))")
+        db.session.commit()
+
+    def match(self, term):
+        vector = func.to_tsvector(FTS_CONFIG, Question.question)
+        query = func.plainto_tsquery(FTS_CONFIG, term)
+        return vector.op('@@')(query), func.ts_rank(vector, query)
+
+    def search(self, request, term, fields=QUESTION_FIELDS):
+        condition, rank = self.match(term)
+        return _paginate_ranked(
+            request, Question.query.filter(condition), rank, fields)
+
+
+class TrigramSearch:
+    """
+    PostgreSQL pg_trgm search. Keeps the substring semantics of the ilike
+    backend but answers it from a GIN trigram index, ranked by similarity.
+    """
+    name = 'trigram'
+
+    def prepare(self):
+        db.session.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        db.session.execute(
+            'CREATE INDEX IF NOT EXISTS ix_questions_question_trgm '
+            'ON questions USING GIN (question gin_trgm_ops)')
+        db.session.commit()
+
+    def match(self, term):
+        return (Question.question.ilike(f'%{term}%'),
+                func.similarity(Question.question, term))
+
+    def search(self, request, term, fields=QUESTION_FIELDS):
+        condition, rank = self.match(term)
+        return _paginate_ranked(
+            request, Question.query.filter(condition), rank, fields)
+
+
+def _paginate_ranked(request, questions, rank, fields):
+    total = questions.with_entities(func.count(Question.id)).scalar()
+    start = _page_start(request)
+    if start is None:
+        return [], total
+
+    page = questions.with_entities(*question_columns(fields)).order_by(
+        rank.desc(), Question.id).offset(start).limit(QUESTIONS_PER_PAGE)
+    return format_rows(page, fields), total
+
+
+class InvertedIndexSearch:
+    """
+    In-process inverted index of the question words, for databases without
+    full-text support. Built from the table on first use and then kept up to
+    date from the committed question changes. Writes made by other processes
+    are picked up when it is reloaded, every `ttl` seconds.
+    Matches questions containing every word of the term, ranked by tf-idf.
+    """
+    name = 'memory'
+
+    def __init__(self, ttl=SEARCH_INDEX_TTL):
+        self.ttl = ttl
+        self._postings = {}  # word -> {question id: occurrences}
+        self._words = {}  # question id -> distinct words of the question
+        self._loaded = False
+        self._loaded_at = 0
+        self._pending = None  # changes committed during a reload
+        self._lock = threading.RLock()
+        self._load_lock = threading.Lock()
+
+    def prepare(self):
+        pass
+
+    def __len__(self):
+        return len(self._words)
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    @property
+    def stale(self):
+        """returns: whether the next search loads or reloads the index"""
+        return not self._loaded or \
+            time.monotonic() - self._loaded_at > self.ttl
+
+    def load(self):
+        """
+        Index every question of the table, read from the primary db. The
+        searches keep using the previous index while the new one is built,
+        the changes committed meanwhile are applied to both.
+        """
+        with self._lock:
+            self._pending = []
+        postings, words = {}, {}
+        try:
+            with on_primary():
+                rows = Question.query.with_entities(
+                    Question.id, Question.question).yield_per(1000)
+                for question_id, text in rows:
+                    _index(postings, words, question_id, text)
+        finally:
+            with self._lock:
+                pending, self._pending = self._pending, None
+        with self._lock:
+            self._postings, self._words = postings, words
+            # Applying a change twice is harmless, a row is removed before
+            # being indexed again.
+            self._apply(pending)
+            self._loaded = True
+            self._loaded_at = time.monotonic()
+
+    def refresh(self):
+        """
+        Load the index if it isn't loaded, or reload it in the background
+        if it expired, see _refresh.
+        returns: the thread reloading the index, None if it isn't reloaded.
+        """
+        return _refresh(self)
+
+    def on_changes(self, changes):
+        """Listener applying committed question changes to the index."""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.extend(changes)
+            if self._loaded:
+                self._apply(changes)
+
+    def _apply(self, changes):
+        for change in changes:
+            if change.table != 'questions':
+                continue
+            if change.op == 'update' and 'question' not in change.previous:
+                continue
+            _unindex(self._postings, self._words, change.row['id'])
+            if change.op != 'delete':
+                _index(self._postings, self._words, change.row['id'],
+                       change.row['question'])
+
+    def rank(self, term, limit):
+        """
+        @param: term the search term.
+        @param: limit number of best matches to return.
+        returns: a tuple of the ids of the best matches, best first, and the
+        total number of matches.
+        """
+        self.refresh()
+        with self._lock:
+            postings = [self._postings.get(word, {})
+                        for word in set(tokenize(term))]
+            if not postings or not all(postings):
+                return [], 0
+
+            postings.sort(key=len)
+            if len(postings) == 1:
+                scores = postings[0]
+            else:
+                # Score the matches by tf-idf, only the rarest word's
+                # postings are iterated.
+                rarest, others = postings[0], postings[1:]
+                weights = [math.log(len(self._words) / len(p)) + 1
+                           for p in postings]
+                scores = {}
+                for question_id, count in rarest.items():
+                    score = count * weights[0]
+                    for p, weight in zip(others, weights[1:]):
+                        if question_id not in p:
+                            break
+                        score += p[question_id] * weight
+                    else:
+                        scores[question_id] = score
+
+            best = heapq.nsmallest(
+                limit, ((-score, question_id)
+                        for question_id, score in scores.items()))
+
+        return [question_id for _, question_id in best], len(scores)
+
+    def search(self, request, term, fields=QUESTION_FIELDS):
+        start = _page_start(request)
+        ids, total = self.rank(term, (start or 0) + QUESTIONS_PER_PAGE)
+        ids = ids[start:] if start is not None else []
+        if not ids:
+            return [], total
+
+        # Only the questions of the current page are loaded from the db.
+        return load_questions(ids, fields), total
+
+
+def _refresh(index):
+    """
+    Load an index on first use, or reload it once it expired. The first
+    load is made by the calling thread, which needs the index. A reload is
+    made by a background thread, unless one is running, while the requests
+    keep using the loaded index, so no request waits for the table to be
+    read.
+    returns: the thread reloading the index, None if it isn't reloaded.
+    """
+    if not index._loaded:
+        with index._load_lock:
+            if not index._loaded:
+                index.load()
+        return None
+    if not index.stale or not index._load_lock.acquire(blocking=False):
+        return None
+
+    app = current_app._get_current_object()
+
+    def reload():
+        try:
+            with app.app_context():
+                index.load()
+        except Exception:
+            # The next request past the ttl tries again.
+            app.logger.exception('Reloading the %s failed',
+                                 type(index).__name__)
+        finally:
+            index._load_lock.release()
+
+    thread = threading.Thread(target=reload, daemon=True)
+    thread.start()
+    return thread
+
+
+def _index(postings, words, question_id, text):
+    """Add a question to the postings and words of an inverted index."""
+    question_words = tokenize(text)
+    for word in question_words:
+        counts = postings.setdefault(word, {})
+        counts[question_id] = counts.get(question_id, 0) + 1
+    words[question_id] = frozenset(question_words)
+
+
+def _unindex(postings, words, question_id):
+    """Remove a question from the postings and words of an inverted index."""
+    for word in words.pop(question_id, ()):
+        counts = postings[word]
+        del counts[question_id]
+        if not counts:
+            del postings[word]
+
+
+class SuggestionIndex:
+    """
+    In-process index completing the last word of a search term, for search
+    as you type. Holds the sorted array of the distinct words of the
+    questions, the words starting with a prefix being a slice of it found by
+    bisection, and the number of questions containing each word, by which
+    the completions are ranked.
+    Built from the table on first use and then kept up to date from the
+    committed question changes, and reloaded every `ttl` seconds to pick up
+    the writes of other processes. At most `max_tokens` words are kept, the
+    most frequent ones when it is loaded: once it is full, new words are
+    left out until it is reloaded. The completions of the shortest prefixes,
+    which match the most words, are cached until the next change.
+    """
+
+    def __init__(self, max_tokens=SUGGEST_MAX_TOKENS, ttl=SEARCH_INDEX_TTL):
+        self.max_tokens = max_tokens
+        self.ttl = ttl
+        self._tokens = []  # sorted distinct words
+        self._counts = {}  # word -> number of questions containing it
+        self._cached = {}  # (prefix, limit) -> best completions
+        self._loaded = False
+        self._loaded_at = 0
+        self._pending = None  # changes committed during a reload
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._tokens)
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    @property
+    def stale(self):
+        """returns: whether the next suggestion loads or reloads the index"""
+        return not self._loaded or \
+            time.monotonic() - self._loaded_at > self.ttl
+
+    def load(self):
+        """
+        Count the words of every question, read from the primary db. The
+        suggestions keep using the previous counts while they are read, the
+        changes committed meanwhile are applied to the new counts. Those
+        also read by the load are counted twice until the next reload,
+        which only shifts the ranking of their words.
+        """
+        with self._lock:
+            self._pending = []
+        counts = Counter()
+        try:
+            with on_primary():
+                rows = Question.query.with_entities(
+                    Question.question).yield_per(1000)
+                for text, in rows:
+                    counts.update(set(tokenize(text)))
+        finally:
+            with self._lock:
+                pending, self._pending = self._pending, None
+        counts = dict(counts.most_common(self.max_tokens))
+        with self._lock:
+            self._counts = counts
+            self._tokens = sorted(counts)
+            self._apply(pending)
+            self._cached = {}
+            self._loaded = True
+            self._loaded_at = time.monotonic()
+
+    def refresh(self):
+        """
+        Load the index if it isn't loaded, or reload it in the background
+        if it expired, see _refresh.
+        returns: the thread reloading the index, None if it isn't reloaded.
+        """
+        return _refresh(self)
+
+    def on_changes(self, changes):
+        """Listener applying committed question changes to the index."""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.extend(changes)
+            if self._loaded:
+                self._apply(changes)
+
+    def _apply(self, changes):
+        for change in changes:
+            if change.table != 'questions':
+                continue
+            if change.op == 'update':
+                if 'question' not in change.previous:
+                    continue
+                self._remove(change.previous['question'])
+            self._cached = {}
+            if change.op == 'delete':
+                self._remove(change.row['question'])
+            else:
+                self._add(change.row['question'])
+
+    def _add(self, text):
+        for token in set(tokenize(text)):
+            if token in self._counts:
+                self._counts[token] += 1
+            elif len(self._tokens) < self.max_tokens:
+                self._counts[token] = 1
+                bisect.insort(self._tokens, token)
+
+    def _remove(self, text):
+        for token in set(tokenize(text)):
+            count = self._counts.get(token)
+            if count is None:
+                continue
+            if count > 1:
+                self._counts[token] = count - 1
+                continue
+            del self._counts[token]
+            del self._tokens[bisect.bisect_left(self._tokens, token)]
+
+    def suggest(self, prefix, limit=SUGGEST_LIMIT):
+        """
+        @param: prefix the search term typed so far.
+        @param: limit number of suggestions to return.
+        returns: the search terms completing the last word of the prefix
+        with the words found in the most questions, most frequent first.
+        """
+        self.refresh()
+        words = tokenize(prefix)
+        # Nothing is completed once the last word is over.
+        if not words or not TOKEN_PATTERN.fullmatch(prefix[-1]):
+            return []
+
+        start = ' '.join(words[:-1] + [''])
+        last = words[-1]
+        with self._lock:
+            best = self._cached.get((last, limit))
+            if best is None:
+                low = bisect.bisect_left(self._tokens, last)
+                high = bisect.bisect_left(self._tokens, last + '\U0010ffff',
+                                          low)
+                best = heapq.nsmallest(
+                    limit, self._tokens[low:high],
+                    key=lambda token: (-self._counts[token], token))
+                if len(last) <= SUGGEST_CACHED_PREFIX:
+                    self._cached[last, limit] = best
+        return [start + token for token in best]
+
+
+SEARCH_BACKENDS = {
+    backend.name: backend for backend in
+    (IlikeSearch, FullTextSearch, TrigramSearch, InvertedIndexSearch)
+}
+
+
+def create_search_engine(app):
+    """
+    Create the search backend selected by the SEARCH_BACKEND config value.
+    'auto' picks the trigram backend on PostgreSQL and the ilike backend on
+    other databases, which both match the term as a substring like the
+    original search. The word matching fulltext and memory backends are
+    opt-in. The db isn't queried, the indexes
+    of the backend are created by its prepare method, which the init-db
+    and upgrade-db commands call.
+    @param: app: instance of the flask application bound to the db.
+    returns: the search backend.
+    """
+    name = app.config.get('SEARCH_BACKEND', SEARCH_BACKEND)
+    if name == 'auto':
+        dialect = make_url(
+            app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name()
+        name = 'trigram' if dialect == 'postgresql' else 'ilike'
+
+    if name == InvertedIndexSearch.name:
+        engine = InvertedIndexSearch(
+            ttl=app.config.get('SEARCH_INDEX_TTL', SEARCH_INDEX_TTL))
+        add_change_listener(app, engine.on_changes)
+    else:
+        engine = SEARCH_BACKENDS[name]()
+
+    return engine
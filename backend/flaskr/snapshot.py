@@ -0,0 +1,545 @@
+"""
+Snapshot of the question ids by category and difficulty, shared by the
+worker processes of a server.
+
+The snapshot is a file mapped in memory by every worker: the quiz picks its
+questions and the counters read their totals from it without querying the
+db, and the pages of the file are shared by the workers instead of each one
+holding its own copy. The file holds a header, a directory of sections and
+an array of 32-bit ids:
+
+    header      magic, generation, build time, number of questions and of
+                sections
+    sections    category, difficulty, start and length of the ids of each
+                (category, difficulty) pair, sorted by category and difficulty
+    ids         the ids of every section, each sorted
+
+The file is never modified once written. A new generation is written to a
+temporary file which then replaces it, and each worker maps the new file on
+its next read while reads in progress finish on the old one.
+
+Committed question changes are appended to the log of the generation, a
+file of (insert, category, difficulty, id) records written by the process
+that made them under a file lock, so a write costs its own changes instead
+of a copy of the snapshot. Each worker reads the records appended since its
+last read and merges them into the sections they touch. Once the log holds
+`log_size` records they are merged into a new generation with an empty log.
+The snapshot is rebuilt from the db every `ttl` seconds, to pick up writes
+made outside of the app.
+"""
+import bisect
+import copy
+import hashlib
+import heapq
+import mmap
+import os
+import random
+import struct
+import tempfile
+import threading
+import time
+from array import array
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows, where the writers only lock per process.
+    fcntl = None
+
+from sqlalchemy import select
+
+from .models import db, Question, on_primary
+
+QUESTION_SNAPSHOT_TTL = 300  # Seconds before the snapshot is rebuilt from the db.
+QUESTION_SNAPSHOT_LOG_SIZE = 4096  # Logged changes before a new generation.
+
+MAGIC = b'TRIVIDX2'
+HEADER = struct.Struct('=8sQdII')
+SECTION = struct.Struct('=iiII')
+LOG_MAGIC = b'TRIVLOG1'
+LOG_HEADER = struct.Struct('=8sQ')  # Magic, generation of the log.
+RECORD = struct.Struct('=iiii')  # Insert, category, difficulty, id.
+NO_CATEGORY = -1  # Category of the questions whose category was deleted.
+NO_DIFFICULTY = -1  # Difficulty of the questions without a valid one.
+EMPTY = array('i')
+
+O_NOFOLLOW = getattr(os, 'O_NOFOLLOW', 0)  # Missing on Windows.
+
+
+def snapshot_path(app):
+    """
+    returns: the QUESTION_SNAPSHOT_PATH config value, or a file of the
+    instance folder of the app named after the db, shared by the apps
+    serving it. The instance folder is created readable by its owner only.
+    """
+    path = app.config.get('QUESTION_SNAPSHOT_PATH')
+    if path is None:
+        digest = hashlib.sha1(
+            app.config['SQLALCHEMY_DATABASE_URI'].encode('utf-8')).hexdigest()
+        os.makedirs(app.instance_path, mode=0o700, exist_ok=True)
+        path = os.path.join(app.instance_path,
+                            f'questions-{digest[:12]}.snapshot')
+    return path
+
+
+class _Generation:
+    """
+    A generation of the snapshot as mapped by this process, with the
+    changes of its log read so far. It isn't modified once read, the
+    changes read later make a new _Generation sharing the mapped ids.
+    """
+
+    def __init__(self, stat, buffer):
+        self.stat = (stat.st_ino, stat.st_mtime_ns)
+        view = memoryview(buffer)
+        magic, self.number, self.built_at, total, count = \
+            HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError('Not a question snapshot')
+        offset = HEADER.size + count * SECTION.size
+        ids = view[offset:offset + 4 * total].cast('i')
+        self._mapped = {}
+        offset = HEADER.size
+        for _ in range(count):
+            category, difficulty, start, length = SECTION.unpack_from(
+                view, offset)
+            self._mapped[category, difficulty] = ids[start:start + length]
+            offset += SECTION.size
+        self.keys = frozenset(self._mapped)
+        self.log = None  # Inode and end of the records of the log read.
+        self._added = {}
+        self._removed = {}
+        self._sections = {}
+        self._counts = None
+        self._difficulties = None
+
+    def with_changes(self, log, records):
+        """
+        @param: log inode and end of the records of the log read.
+        @param: records the (insert, category, difficulty, id) records read
+        from the log since this generation.
+        returns: a generation holding the changes of both.
+        """
+        generation = copy.copy(self)
+        generation.log = log
+        added, removed = dict(self._added), dict(self._removed)
+        touched = set()
+        for insert, category, difficulty, question_id in records:
+            key = (category, difficulty)
+            if key not in touched:
+                touched.add(key)
+                added[key] = set(added.get(key, ()))
+                removed[key] = set(removed.get(key, ()))
+            # Rows may already be in a snapshot built after their commit.
+            mapped = _contains(self._mapped.get(key, EMPTY), question_id)
+            if insert:
+                removed[key].discard(question_id)
+                if not mapped:
+                    added[key].add(question_id)
+            else:
+                added[key].discard(question_id)
+                if mapped:
+                    removed[key].add(question_id)
+        if touched:
+            generation.keys = self.keys | touched
+            generation._added, generation._removed = added, removed
+            generation._sections = {
+                key: ids for key, ids in self._sections.items()
+                if key not in touched}
+            generation._counts = generation._difficulties = None
+        return generation
+
+    def section(self, category, difficulty):
+        """
+        returns: the sorted ids of a section, the mapped ones merged with
+        the changes of the log on first use.
+        """
+        key = (category, difficulty)
+        ids = self._sections.get(key)
+        if ids is None:
+            ids = self._mapped.get(key, EMPTY)
+            added, removed = self._added.get(key), self._removed.get(key)
+            if added or removed:
+                kept = ids if not removed else (
+                    question_id for question_id in ids
+                    if question_id not in removed)
+                ids = array('i', heapq.merge(kept, sorted(added or ())))
+            self._sections[key] = ids
+        return ids
+
+    def sections_of(self, category=None, difficulty=None):
+        """returns: the id arrays of the sections of a category, difficulty"""
+        return [self.section(*key) for key in self.keys
+                if category in (None, key[0])
+                and difficulty in (None, key[1])]
+
+    def bucket(self, category, difficulty):
+        """
+        returns: the id arrays of the questions of a difficulty and of a
+        category, of every category if None. The arrays of every category
+        are grouped by difficulty on first use.
+        """
+        if category is not None:
+            return [self.section(category, difficulty)]
+        if self._difficulties is None:
+            difficulties = {}
+            for key in self.keys:
+                difficulties.setdefault(key[1], []).append(
+                    self.section(*key))
+            self._difficulties = difficulties
+        return self._difficulties.get(difficulty, [])
+
+    def counts(self):
+        if self._counts is None:
+            counts = Counter()
+            for category, difficulty in self.keys:
+                length = len(self.section(category, difficulty))
+                if length:
+                    counts[None if category == NO_CATEGORY else category,
+                           None if difficulty == NO_DIFFICULTY
+                           else difficulty] = length
+            self._counts = counts
+        return self._counts
+
+
+class QuestionSnapshot:
+    """
+    Array backed snapshot of the (id, category, difficulty) of every
+    question, published to the worker processes through a memory-mapped
+    file, see the module docstring.
+    """
+
+    def __init__(self, path, ttl=QUESTION_SNAPSHOT_TTL,
+                 log_size=QUESTION_SNAPSHOT_LOG_SIZE):
+        self.path = path
+        self.log_path = path + '.log'
+        self.ttl = ttl
+        self.log_size = log_size
+        self._generation = None
+        self._lock = threading.Lock()
+
+    @property
+    def stale(self):
+        """
+        returns: whether the next read rebuilds the snapshot from the db.
+        """
+        try:
+            built_at = self._current(rebuild=False).built_at
+        except (FileNotFoundError, ValueError):
+            return True
+        return time.time() - built_at > self.ttl
+
+    def load(self):
+        """
+        Rebuild the snapshot from the primary db, unless another process
+        just did.
+        """
+        with self._writing():
+            try:
+                generation = self._current(rebuild=False)
+                if time.time() - generation.built_at <= self.ttl:
+                    return
+                number = generation.number + 1
+            except (FileNotFoundError, ValueError):
+                number = 1
+            with on_primary():
+                rows = db.session.execute(select(
+                    Question.category, Question.difficulty, Question.id)
+                    .order_by(Question.category, Question.difficulty,
+                              Question.id)).all()
+            sections = {}
+            for category, difficulty, question_id in rows:
+                sections.setdefault(_section_key(category, difficulty),
+                                    array('i')).append(question_id)
+            # The invalid difficulties share a section, sorted by value.
+            for key, ids in sections.items():
+                if key[1] == NO_DIFFICULTY:
+                    sections[key] = array('i', sorted(ids))
+            self._publish(sections, number, time.time())
+
+    def _current(self, rebuild=True):
+        """
+        returns: the latest generation, mapping it if it changed, and
+        rebuilding it from the db first if it expired or was written by
+        another version of the app.
+        raises: FileNotFoundError if the snapshot wasn't built, ValueError
+        if it was written by another version, and rebuild is False.
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            if not rebuild:
+                raise
+            self.load()
+            return self._current(rebuild=False)
+
+        generation = self._generation
+        if generation is None or \
+                generation.stat != (stat.st_ino, stat.st_mtime_ns):
+            try:
+                with open(self.path, 'rb') as file:
+                    buffer = mmap.mmap(file.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+                    generation = _Generation(os.fstat(file.fileno()), buffer)
+            except ValueError:
+                if not rebuild:
+                    raise
+                self.load()
+                return self._current(rebuild=False)
+        generation = self._generation = self._read_log(generation)
+        if rebuild and time.time() - generation.built_at > self.ttl:
+            self.load()
+            return self._current(rebuild=False)
+        return generation
+
+    def _read_log(self, generation):
+        """
+        returns: the generation with the records appended to its log since
+        it was last read.
+        """
+        try:
+            stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            return generation
+        inode, end = generation.log or (None, 0)
+        if stat.st_ino == inode and stat.st_size == end:
+            return generation
+        with open(self.log_path, 'rb') as file:
+            stat = os.fstat(file.fileno())
+            if stat.st_ino != inode:
+                # The log of another generation, the next one is mapped
+                # on the next read.
+                if inode is not None:
+                    return generation
+                header = file.read(LOG_HEADER.size)
+                if len(header) < LOG_HEADER.size or \
+                        LOG_HEADER.unpack(header) != (LOG_MAGIC,
+                                                      generation.number):
+                    return generation
+                end = LOG_HEADER.size
+            file.seek(end)
+            data = file.read(stat.st_size - end)
+        # A record being appended is read once complete.
+        data = data[:len(data) - len(data) % RECORD.size]
+        return generation.with_changes((stat.st_ino, end + len(data)),
+                                       RECORD.iter_unpack(data))
+
+    @contextmanager
+    def _writing(self):
+        """Lock out the other threads and processes writing the snapshot."""
+        with self._lock:
+            lock = os.open(self.path + '.lock',
+                           os.O_RDWR | os.O_CREAT | O_NOFOLLOW, 0o600)
+            try:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(lock)
+
+    def _publish(self, sections, number, built_at):
+        """
+        Write a new generation of the snapshot, with an empty log.
+        @param: sections dict mapping (category, difficulty) pairs to sorted
+        arrays of ids.
+        """
+        sections = {key: ids for key, ids in sorted(sections.items())
+                    if len(ids)}
+        directory = bytearray()
+        start = 0
+        for (category, difficulty), ids in sections.items():
+            directory += SECTION.pack(category, difficulty, start, len(ids))
+            start += len(ids)
+        # The generation replaces the old one first, the workers ignore the
+        # old log until the new one replaces it.
+        _replace(self.path, [
+            HEADER.pack(MAGIC, number, built_at, start, len(sections)),
+            directory, *sections.values()])
+        self._start_log(number)
+
+    def _start_log(self, number):
+        """Replace the log by an empty log of the generation number."""
+        _replace(self.log_path, [LOG_HEADER.pack(LOG_MAGIC, number)])
+
+    # READS #
+    def counts(self):
+        """
+        returns: a Counter mapping the (category, difficulty) pairs to their
+        number of questions, the category of questions without one is None.
+        It is shared by every caller and must not be modified.
+        """
+        return self._current().counts()
+
+    def bounds(self, category=None):
+        """
+        @param: category id of a category, None for every category.
+        returns: the lowest id, highest id and number of questions of the
+        category, the ids being None if it has no questions.
+        """
+        ids = [section for section in self._current().sections_of(category)
+               if len(section)]
+        if not ids:
+            return None, None, 0
+        return (min(section[0] for section in ids),
+                max(section[-1] for section in ids),
+                sum(len(section) for section in ids))
+
+    def sections(self, category=None):
+        """
+        returns: the sorted id arrays of the questions of a category, every
+        category if None, all read from the same generation so many lookups
+        check the snapshot files once.
+        """
+        return self._current().sections_of(category)
+
+    def contains(self, category, question_id):
+        """
+        returns: whether the question belongs to the category, any category
+        if it is None.
+        """
+        return any(_contains(ids, question_id)
+                   for ids in self._current().sections_of(category))
+
+    def sample(self, category, size, mix=None, excluded=()):
+        """
+        Draw random questions of a category.
+        @param: category id of a category, None for every category.
+        @param: size number of questions to draw.
+        @param: mix dict mapping difficulties to their number of questions,
+        replacing size.
+        @param: excluded ids of questions not to draw.
+        returns: the ids of the distinct questions drawn, fewer than asked
+        if the category hasn't enough of them.
+        """
+        generation = self._current()
+        if not mix:
+            return _draw(generation.sections_of(category), size, excluded)
+        return [question_id for difficulty, count in mix.items()
+                for question_id in _draw(
+                    generation.sections_of(category, difficulty), count,
+                    excluded)]
+
+    def pick(self, category, difficulties, excluded=()):
+        """
+        Draw a random question of the first difficulty with questions left.
+        The question is picked from the ids of its (category, difficulty)
+        pair, the cost of a draw only depends on the number of excluded ids.
+        @param: category id of a category, None for every category.
+        @param: difficulties the difficulties to draw from, by preference.
+        @param: excluded ids of questions not to draw.
+        returns: the id of the question, None if every question of the
+        difficulties is excluded.
+        """
+        generation = self._current()
+        for difficulty in difficulties:
+            drawn = _draw(generation.bucket(category, difficulty), 1,
+                          excluded)
+            if drawn:
+                return drawn[0]
+        return None
+
+    # WRITES #
+    def on_changes(self, changes):
+        """
+        Listener appending the committed question changes to the log of the
+        snapshot, merged into a new generation once the log is full. The
+        snapshot is left to be built on first read if it doesn't exist yet.
+        """
+        records = b''.join(_records(change) for change in changes
+                           if change.table == 'questions')
+        if not records or not os.path.exists(self.path):
+            return
+        with self._writing():
+            try:
+                generation = self._current(rebuild=False)
+            except ValueError:  # Rebuilt on the next read.
+                return
+            if generation.log is None:
+                self._start_log(generation.number)
+            log = os.open(self.log_path, os.O_WRONLY | os.O_APPEND |
+                          O_NOFOLLOW)
+            try:
+                os.write(log, records)
+            finally:
+                os.close(log)
+            generation = self._current(rebuild=False)
+            if generation.log[1] - LOG_HEADER.size >= \
+                    self.log_size * RECORD.size:
+                self._publish({key: generation.section(*key)
+                               for key in generation.keys},
+                              generation.number + 1, generation.built_at)
+
+
+def _replace(path, chunks):
+    """Atomically replace the file by the chunks of bytes."""
+    handle, temporary = tempfile.mkstemp(
+        dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as file:
+            for chunk in chunks:
+                file.write(chunk)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+def _records(change):
+    """returns: the log records of a question change"""
+    row = change.row
+    if change.op == 'update':
+        if not change.previous.keys() & {'category', 'difficulty'}:
+            return b''
+        return _record(False, dict(row, **change.previous)) + \
+            _record(True, row)
+    return _record(change.op != 'delete', row)
+
+
+def _record(insert, row):
+    return RECORD.pack(insert,
+                       *_section_key(row['category'], row['difficulty']),
+                       row['id'])
+
+
+def _section_key(category, difficulty):
+    """
+    returns: the (category, difficulty) key of the section of a question, a
+    missing category or invalid difficulty being kept apart so a bad row
+    can't break the snapshot.
+    """
+    try:
+        difficulty = int(difficulty)
+    except (TypeError, ValueError):
+        difficulty = NO_DIFFICULTY
+    return NO_CATEGORY if category is None else int(category), difficulty
+
+
+def _contains(ids, question_id):
+    position = bisect.bisect_left(ids, question_id)
+    return position < len(ids) and ids[position] == question_id
+
+
+def _draw(sections, count, excluded):
+    """
+    returns: up to count distinct random ids of the sections, leaving out
+    the excluded ids.
+    """
+    ends = []
+    total = 0
+    for ids in sections:
+        total += len(ids)
+        ends.append(total)
+    # Enough positions are drawn to make up for the excluded ids.
+    positions = random.sample(range(total), min(total,
+                                                count + len(excluded)))
+    drawn = []
+    for position in positions:
+        index = bisect.bisect_right(ends, position)
+        start = ends[index - 1] if index else 0
+        question_id = sections[index][position - start]
+        if question_id not in excluded:
+            drawn.append(question_id)
+            if len(drawn) == count:
+                break
+    return drawn
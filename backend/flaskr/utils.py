@@ -1,5 +1,19 @@
+from flask import current_app, jsonify
+from sqlalchemy import func
+
+from .metrics import count_rows
+from .models import Question
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, jsonify is used without it.
+    orjson = None
+
 QUESTIONS_PER_PAGE = 10  # Number of questions to be used in pagination.
 
+# Fields of a formatted question, in the order of Question.format.
+QUESTION_FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+
 
 def format_category_list(categories):
     """
@@ -13,17 +27,104 @@ def format_category_list(categories):
     return cats
 
 
-def paginate_questions(request, questions):
+def requested_fields(request):
     """
-    A helper method to return questions paginated.
+    Sparse fieldsets: the `fields` url parameter lists the question fields
+    to return, separated by commas.
     @param: request sent from the front-end.
-    @param: questions retrieved from the db and sent from the controller.
-    returns: questions paginated for the current page.
+    returns: a tuple of the requested fields, every field by default, or None
+    if an unknown field is requested.
+    """
+    fields = request.args.get('fields', None)
+    if fields is None:
+        return QUESTION_FIELDS
+    fields = set(fields.split(','))
+    if not fields <= set(QUESTION_FIELDS):
+        return None
+    return tuple(field for field in QUESTION_FIELDS if field in fields)
+
+
+def question_columns(fields):
     """
-    page = request.args.get('page', 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-    current_questions = [question.format()
-                         for question in questions][start:end]
+    @param: fields names of question fields.
+    returns: the matching columns of the Question model.
+    """
+    return [getattr(Question, field) for field in fields]
+
+
+def format_rows(rows, fields):
+    """
+    Formats question rows selected as plain tuples, without building ORM
+    instances.
+    @param: rows tuples of the question columns listed by fields.
+    @param: fields names of the selected fields.
+    returns: a list of question dicts.
+    """
+    questions = [dict(zip(fields, row)) for row in rows]
+    count_rows(len(questions))
+    return questions
+
+
+def load_questions(ids, fields):
+    """
+    @param: ids ids of the questions to load.
+    @param: fields names of the fields to return.
+    returns: the formatted questions, in the order of ids.
+    """
+    rows = {row[0]: row[1:] for row in Question.query.with_entities(
+        Question.id, *question_columns(fields)).filter(Question.id.in_(ids))}
+    count_rows(len(rows))
+    return [dict(zip(fields, rows[question_id])) for question_id in ids
+            if question_id in rows]
+
+
+def json_response(payload, status=200):
+    """
+    Serializes a payload with orjson when it is installed and the FAST_JSON
+    config value isn't False, with jsonify otherwise.
+    @param: payload the JSON serializable response content.
+    @param: status the status code of the response.
+    returns: a response with the JSON payload.
+    """
+    if orjson is not None and current_app.config.get('FAST_JSON', True):
+        return current_app.response_class(
+            orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS),
+            status=status, mimetype='application/json')
+    return jsonify(payload), status
+
+
+def paginate_questions(request, query, fields=QUESTION_FIELDS, total=None):
+    """
+    A helper method to return questions paginated inside the db.
+    Only the rows of the current page are loaded and formatted, the total is
+    computed with a separate COUNT query.
+    When the `after` url parameter is present keyset pagination is used
+    instead of OFFSET, so deep pages cost the same as the first one.
+    @param: request sent from the front-end.
+    @param: query a Question query with its filters applied.
+    @param: fields names of the question fields to return, only their
+    columns are selected.
+    @param: total number of questions matching the query when already known,
+    the COUNT query is skipped when it is given.
+    returns: a tuple of the questions formatted for the current page and the
+    total number of questions matching the query.
+    """
+    if total is None:
+        total = query.order_by(None).with_entities(
+            func.count(Question.id)).scalar()
+
+    page_query = query.order_by(None).order_by(Question.id)
+    after = request.args.get('after', None, type=int)
+    if after is not None:
+        page_query = page_query.filter(Question.id > after)
+    else:
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            return [], total
+        page_query = page_query.offset((page - 1) * QUESTIONS_PER_PAGE)
+
+    current_questions = format_rows(
+        page_query.with_entities(*question_columns(fields)).limit(
+            QUESTIONS_PER_PAGE), fields)
 
-    return current_questions
+    return current_questions, total
@@ -1,10 +1,28 @@
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import zlib
 import json
-from flask_sqlalchemy import SQLAlchemy
+from asgiref.testing import ApplicationCommunicator
+from sqlalchemy import event, exc, text
+from sqlalchemy.engine import make_url
 from dotenv import dotenv_values
 
 from flaskr import create_app
-from flaskr.models import setup_db, Question
+from flaskr.asgi import AsyncTrivia
+from flaskr.cache import CATEGORY_MISS_INTERVAL
+from flaskr.compression import brotli
+from flaskr.models import (db, Question, Category, add_change_listener,
+                           environment)
+from flaskr.quiz import QuizTokens
+from flaskr.replicas import ReplicaRouter
+from flaskr.snapshot import QuestionSnapshot
 
 
 class TriviaTestCase(unittest.TestCase):
@@ -13,11 +31,14 @@ class TriviaTestCase(unittest.TestCase):
     def setUp(self):
         """Define test variables and initialize app."""
         config = dotenv_values('.env')
-        self.app = create_app()
-        self.client = self.app.test_client
         self.database_name = config['TEST_DB_NAME']
         self.database_path = config['TEST_DB_PATH']
-        setup_db(self.app, self.database_path)
+        self.snapshot_directory = tempfile.mkdtemp()
+        self.app = create_app({
+            'SQLALCHEMY_DATABASE_URI': self.database_path,
+            'QUESTION_SNAPSHOT_PATH': f'{self.snapshot_directory}/questions'
+        })
+        self.client = self.app.test_client
 
         # sample question for use in tests
         self.new_question = {
@@ -27,16 +48,95 @@ class TriviaTestCase(unittest.TestCase):
             'category': '4'
         }
 
-        # binds the app to the current context
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            # create all tables
-            self.db.create_all()
-
     def tearDown(self):
         """Executed after each test"""
-        pass
+        shutil.rmtree(self.snapshot_directory)
+
+    def test_retrieve_categories_after_category_write(self):
+        """Tests the cached categories are refreshed by category writes"""
+
+        # load the categories once so that they are cached
+        response = self.client().get('/categories')
+        total_before = json.loads(response.data)['total_categories']
+
+        # add a category
+        with self.app.app_context():
+            category = Category('Music')
+            db.session.add(category)
+            db.session.commit()
+            category_id = category.id
+
+        # check the new category is returned
+        response = self.client().get('/categories')
+        data = json.loads(response.data)
+        self.assertEqual(data['total_categories'], total_before + 1)
+        self.assertEqual(data['categories'][str(category_id)], 'Music')
+
+        # remove the category
+        with self.app.app_context():
+            db.session.delete(Category.query.get(category_id))
+            db.session.commit()
+
+        response = self.client().get('/categories')
+        data = json.loads(response.data)
+        self.assertEqual(data['total_categories'], total_before)
+
+    def test_category_created_by_another_worker(self):
+        """Tests categories written by another process are accepted"""
+
+        # load the categories once so that they are cached
+        self.client().get('/categories')
+
+        # add a category through a second app, as another worker would
+        worker = create_app({
+            'SQLALCHEMY_DATABASE_URI': self.database_path,
+            'QUESTION_SNAPSHOT_PATH': f'{self.snapshot_directory}/questions'
+        })
+        with worker.app_context():
+            category = Category('Music')
+            db.session.add(category)
+            db.session.commit()
+            category_id = category.id
+
+        # check a question of the new category is accepted once a reload on
+        # a miss is allowed
+        time.sleep(CATEGORY_MISS_INTERVAL)
+        response = self.client().post('/questions', json=dict(
+            self.new_question, category=str(category_id)))
+        self.assertEqual(response.status_code, 201)
+        question_id = json.loads(response.data)['question_id']
+
+        # check the batch update accepts it too
+        response = self.client().patch('/questions', json={
+            'ids': [question_id], 'values': {'category': category_id}})
+        self.assertEqual(response.status_code, 200)
+
+        # remove the question and the category
+        self.client().delete(f'/questions/{question_id}')
+        with self.app.app_context():
+            db.session.delete(Category.query.get(category_id))
+            db.session.commit()
+
+    def test_startup_without_db(self):
+        """Tests the app is created without a .env file or a reachable db"""
+
+        # import flaskr from a directory without .env
+        with tempfile.TemporaryDirectory() as directory:
+            result = subprocess.run(
+                [sys.executable, '-c', 'import flaskr'], cwd=directory,
+                env=dict(os.environ, PYTHONPATH=os.getcwd()),
+                capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, result.stderr)
+
+            # create an app bound to a db that doesn't exist
+            app = create_app({'SQLALCHEMY_DATABASE_URI':
+                              f'sqlite:///{directory}/missing/trivia.db'})
+
+        # check the startup time is reported and requests fail cleanly
+        metrics = app.test_client().get('/metrics').data.decode()
+        self.assertIn('trivia_app_startup_seconds ', metrics)
+        response = app.test_client().get('/questions')
+        self.assertEqual(response.status_code, 404)
 
     def test_retrieve_paginated_questions(self):
         """Tests success of question pagination"""
@@ -67,12 +167,151 @@ class TriviaTestCase(unittest.TestCase):
         # check error message value.
         self.assertEqual(data['message'], 'Resource not found')
 
+    def test_retrieve_questions_after_cursor(self):
+        """Tests keyset pagination matches offset pagination"""
+
+        # get the first two pages using the page parameter
+        first_page = json.loads(self.client().get('/questions').data)
+        second_page = json.loads(self.client().get('/questions?page=2').data)
+
+        # get the second page using the id of the last question as a cursor
+        last_id = first_page['questions'][-1]['id']
+        response = self.client().get(f'/questions?after={last_id}')
+        data = json.loads(response.data)
+
+        # check status code and that both pages are identical
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['questions'], second_page['questions'])
+        self.assertEqual(data['total_questions'],
+                         first_page['total_questions'])
+
+    def test_conditional_get_questions(self):
+        """Tests ETags are honored until a question is written"""
+
+        response = self.client().get('/questions')
+        etag = response.headers['ETag']
+
+        # another worker process serving the same db
+        worker = create_app({
+            'SQLALCHEMY_DATABASE_URI': self.database_path,
+            'QUESTION_SNAPSHOT_PATH': f'{self.snapshot_directory}/questions'
+        }).test_client()
+        worker_etag = worker.get('/questions').headers['ETag']
+
+        # check a request with the same ETag gets a 304 without a body
+        response = self.client().get('/questions',
+                                     headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        # create a question
+        response = self.client().post('/questions', json={
+            'question': 'How many strings does a violin have?',
+            'answer': 'Four',
+            'difficulty': 1,
+            'category': '2'
+        })
+        question_id = json.loads(response.data)['question_id']
+
+        # check the ETag changed and the new total is returned
+        response = self.client().get('/questions',
+                                     headers={'If-None-Match': etag})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(data['total_questions'], Question.query.count())
+
+        # check the other worker noticed the write as well
+        response = worker.get('/questions',
+                              headers={'If-None-Match': worker_etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['total_questions'],
+                         data['total_questions'])
+
+        self.client().delete(f'/questions/{question_id}')
+
+    def test_compressed_responses(self):
+        """Tests responses are compressed for the clients accepting gzip"""
+
+        def decompress(data):
+            return zlib.decompress(data, 31)
+
+        gzip = {'Accept-Encoding': 'gzip'}
+        path = '/questions?page=1&fields=id,question,answer,category'
+
+        # check the raw page is sent to clients not accepting gzip
+        raw = self.client().get(path)
+        self.assertEqual(raw.status_code, 200)
+        self.assertNotIn('Content-Encoding', raw.headers)
+        self.assertIn('Accept-Encoding', raw.headers['Vary'])
+
+        # check the cached page is compressed, its ETag becoming weak
+        first = self.client().get(path, headers=gzip)
+        second = self.client().get(path, headers=gzip)
+        self.assertEqual(first.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(decompress(first.data), raw.data)
+        self.assertLess(len(first.data), len(raw.data))
+        self.assertEqual(second.data, first.data)
+        self.assertTrue(first.headers['ETag'].startswith('W/'))
+
+        # check the weak ETag still revalidates the page
+        response = self.client().get(path, headers=dict(
+            gzip, **{'If-None-Match': first.headers['ETag']}))
+        self.assertEqual(response.status_code, 304)
+
+        # check small bodies are left alone
+        response = self.client().get('/categories', headers=gzip)
+        self.assertNotIn('Content-Encoding', response.headers)
+
+        # check streamed exports are compressed as they are sent
+        raw = self.client().get('/questions/export?format=csv')
+        response = self.client().get('/questions/export?format=csv',
+                                     headers=gzip)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(decompress(response.data), raw.data)
+
+    @unittest.skipIf(brotli is None, 'brotli is not installed')
+    def test_brotli_responses(self):
+        """Tests brotli is preferred by the clients accepting it"""
+
+        headers = {'Accept-Encoding': 'gzip, br'}
+        path = '/questions?page=1&fields=id,question,answer,difficulty'
+
+        # check the page is compressed with brotli
+        raw = self.client().get(path)
+        response = self.client().get(path, headers=headers)
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(response.data), raw.data)
+
+        # check streamed exports are compressed with brotli as they are sent
+        raw = self.client().get('/questions/export?format=ndjson')
+        response = self.client().get('/questions/export?format=ndjson',
+                                     headers=headers)
+        self.assertEqual(response.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(response.data), raw.data)
+
+    def test_retrieve_questions_sparse_fields(self):
+        """Tests the fields parameter restricts the question fields"""
+
+        response = self.client().get('/questions?fields=id,question')
+        data = json.loads(response.data)
+
+        # check status code and the fields of every question
+        self.assertEqual(response.status_code, 200)
+        for question in data['questions']:
+            self.assertEqual(set(question), {'id', 'question'})
+
+        # check unknown fields are rejected
+        response = self.client().get('/questions?fields=id,secret')
+        self.assertEqual(response.status_code, 400)
+
     def test_delete_question_success(self):
         """Tests question deletion success"""
 
-        # create a new question to be deleted
+        # create a new question to be deleted, questions are unique so its
+        # text differs from the one created by test_create_new_question
         question = Question(
-            question=self.new_question['question'],
+            question='Who led the Egyptian revolution of 1919?',
             answer=self.new_question['answer'],
             category=self.new_question['category'],
             difficulty=self.new_question['difficulty']
@@ -141,6 +380,27 @@ class TriviaTestCase(unittest.TestCase):
         question = Question.query.get(data['question_id'])
         self.assertIsNotNone(question)
 
+    def test_400_if_question_is_duplicate(self):
+        """Tests creating a question differing only by case and spacing"""
+
+        # create a question, then the same one with another case and spacing
+        question = {
+            'question': 'Which river flows through Cairo?',
+            'answer': 'The Nile',
+            'difficulty': 1,
+            'category': '3'
+        }
+        self.client().post('/questions', json=question)
+        questions_before = Question.query.count()
+        response = self.client().post('/questions', json=dict(
+            question, question='  which RIVER flows  through cairo? '))
+        data = json.loads(response.data)
+
+        # check status code, success value and that nothing was inserted
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(Question.query.count(), questions_before)
+
     def test_400_if_question_creation_fails(self):
         """Tests question creation failure 400"""
 
@@ -164,6 +424,110 @@ class TriviaTestCase(unittest.TestCase):
         # check if questions_after and questions_before are equal
         self.assertTrue(len(questions_after) == len(questions_before))
 
+        # check a question without a valid difficulty isn't inserted
+        for difficulty in (None, 'hard', 9):
+            response = self.client().post('/questions', json=dict(
+                self.new_question, difficulty=difficulty))
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(Question.query.count(), len(questions_before))
+
+    def test_import_and_export_questions(self):
+        """Tests bulk import skips invalid rows and duplicates"""
+
+        lines = [
+            {'question': 'Who wrote Cairo Trilogy?', 'answer': 'Mahfouz',
+             'category': 4, 'difficulty': 3},
+            {'question': 'Where is Petra?', 'answer': 'Jordan',
+             'category': '3', 'difficulty': 2},
+            # duplicate of the first row
+            {'question': 'who wrote cairo trilogy?', 'answer': 'Mahfouz',
+             'category': 4, 'difficulty': 3},
+            # invalid row without an answer
+            {'question': 'Who is missing an answer?', 'category': 4,
+             'difficulty': 1}
+        ]
+        body = '\n'.join(json.dumps(line) for line in lines)
+        response = self.client().post(
+            '/questions/import?batch_size=2', data=body,
+            content_type='application/x-ndjson')
+        data = json.loads(response.data)
+
+        # check status code and the import report
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(data['imported'], 2)
+        self.assertEqual(data['duplicates'], 1)
+        self.assertEqual(data['invalid'], 1)
+        self.assertEqual(data['errors'][0]['line'], 4)
+
+        # check the imported questions are exported
+        response = self.client().get('/questions/export')
+        exported = [json.loads(line)
+                    for line in response.data.decode().splitlines()]
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(exported), Question.query.count())
+        imported = [question for question in exported
+                    if question['question'] in ('Who wrote Cairo Trilogy?',
+                                                'Where is Petra?')]
+        self.assertEqual(len(imported), 2)
+
+        # delete the imported questions
+        for question in imported:
+            self.client().delete(f"/questions/{question['id']}")
+
+    def test_batch_update_and_delete_questions(self):
+        """Tests batch writes report each question and notify per batch"""
+
+        # create a category and questions to moderate
+        category = Category('Moderation')
+        db.session.add(category)
+        db.session.commit()
+        category_id = category.id
+        ids = []
+        for number in range(3):
+            question = Question(f'Moderated question {number}?', 'Yes', 1, 1)
+            question.insert()
+            ids.append(question.id)
+        notifications = []
+        add_change_listener(self.app, notifications.append)
+
+        # move them to the new category, along with a missing question
+        response = self.client().patch('/questions?batch_size=2', json={
+            'ids': ids + [999999],
+            'values': {'category': category_id, 'difficulty': 5}
+        })
+        data = json.loads(response.data)
+
+        # check status code, the per question results and a single
+        # notification for every batch
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['updated'], 3)
+        self.assertEqual(data['not_found'], 1)
+        self.assertEqual(data['results'][-1],
+                         {'id': 999999, 'status': 'not_found'})
+        self.assertEqual([len(changes) for changes in notifications], [3])
+
+        # delete them by filter
+        total_before = data['total_questions']
+        response = self.client().delete('/questions', json={
+            'filter': {'category': category_id}})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(result['id'] for result in data['results']),
+                         ids)
+        self.assertEqual(data['total_questions'], total_before - 3)
+        self.assertEqual(Question.query.filter(Question.id.in_(ids)).count(),
+                         0)
+
+        # check an invalid selection is rejected
+        response = self.client().delete('/questions', json={'ids': ['1']})
+        self.assertEqual(response.status_code, 400)
+
+        # remove the category
+        with self.app.app_context():
+            db.session.delete(Category.query.get(category_id))
+            db.session.commit()
+        self.assertIsNone(Category.query.get(category_id))
+
     def test_search_questions(self):
         """Tests search questions success"""
 
@@ -200,6 +564,180 @@ class TriviaTestCase(unittest.TestCase):
         # check error message.
         self.assertEqual(data['message'], 'Resource not found')
 
+    def test_search_matches_substrings(self):
+        """Tests the default search backend matches parts of words"""
+
+        # send post request with the start of a word
+        response = self.client().post('/search', json={'searchTerm': 'Tit'})
+        data = json.loads(response.data)
+
+        # check the questions containing it anywhere are found
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual({question['id'] for question in data['questions']},
+                         {5, 6})
+
+    def test_search_index_reloads_writes_of_other_workers(self):
+        """Tests the in-process index picks up writes of other processes"""
+
+        # a worker searching with the in-process index
+        worker = create_app({
+            'SQLALCHEMY_DATABASE_URI': self.database_path,
+            'SEARCH_BACKEND': 'memory',
+            'SEARCH_INDEX_TTL': 3600
+        })
+        search = {'searchTerm': 'Zanzibar'}
+        response = worker.test_client().post('/search', json=search)
+        self.assertEqual(response.status_code, 404)
+
+        # create a question through another worker
+        response = self.client().post('/questions', json={
+            'question': 'Which island of Zanzibar is known as Pemba?',
+            'answer': 'The green island',
+            'difficulty': 3,
+            'category': '3'
+        })
+        question_id = json.loads(response.data)['question_id']
+
+        # check the worker sees it once its index expired and was reloaded
+        # in the background
+        response = worker.test_client().post('/search', json=search)
+        self.assertEqual(response.status_code, 404)
+        engine = worker.extensions['trivia']['search_engine']
+        engine.ttl = 0
+        with worker.app_context():
+            engine.refresh().join()
+        engine.ttl = 3600
+        response = worker.test_client().post('/search', json=search)
+        data = json.loads(response.data)
+        self.assertEqual([question['id'] for question in data['questions']],
+                         [question_id])
+
+        self.client().delete(f'/questions/{question_id}')
+
+    def test_search_reflects_writes(self):
+        """Tests search results follow question creation and deletion"""
+
+        # search once so that in-process indexes are built
+        search = {'searchTerm': 'Zanzibar'}
+        response = self.client().post('/search', json=search)
+        self.assertEqual(response.status_code, 404)
+
+        # create a question matching the search term
+        response = self.client().post('/questions', json={
+            'question': 'What is the largest island of Zanzibar?',
+            'answer': 'Unguja',
+            'difficulty': 3,
+            'category': '3'
+        })
+        question_id = json.loads(response.data)['question_id']
+
+        # check the new question is found
+        response = self.client().post('/search', json=search)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([question['id'] for question in data['questions']],
+                         [question_id])
+
+        # check the question is not found anymore once deleted
+        self.client().delete(f'/questions/{question_id}')
+        response = self.client().post('/search', json=search)
+        self.assertEqual(response.status_code, 404)
+
+    def test_search_suggestions(self):
+        """Tests search suggestions complete the last word and follow writes"""
+
+        # complete the last word of the term
+        response = self.client().get('/search/suggest?prefix=Who%20disc')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('who discovered', data['suggestions'])
+
+        # check an inserted question is suggested, and no more once deleted
+        question = Question('Where do Zanzibarians live?', 'Zanzibar', 3, 1)
+        question.insert()
+        response = self.client().get('/search/suggest?prefix=zanzib')
+        self.assertEqual(json.loads(response.data)['suggestions'],
+                         ['zanzibarians'])
+        question.delete()
+        response = self.client().get('/search/suggest?prefix=zanzib')
+        self.assertEqual(json.loads(response.data)['suggestions'], [])
+
+        # check a question created by another worker is suggested once the
+        # index expired
+        worker = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path})
+        response = worker.test_client().post('/questions', json={
+            'question': 'Where do Zanzibarians live?',
+            'answer': 'Zanzibar',
+            'difficulty': 3,
+            'category': '1'
+        })
+        question_id = json.loads(response.data)['question_id']
+        response = self.client().get('/search/suggest?prefix=zanzib')
+        self.assertEqual(json.loads(response.data)['suggestions'], [])
+        index = self.app.extensions['trivia']['suggestion_index']
+        index.ttl = 0
+        with self.app.app_context():
+            index.refresh().join()
+        index.ttl = 3600
+        response = self.client().get('/search/suggest?prefix=zanzib')
+        self.assertEqual(json.loads(response.data)['suggestions'],
+                         ['zanzibarians'])
+        self.client().delete(f'/questions/{question_id}')
+
+        # check a missing prefix is rejected
+        response = self.client().get('/search/suggest')
+        self.assertEqual(response.status_code, 400)
+
+    def test_identical_requests_are_coalesced(self):
+        """Tests concurrent identical reads share a single computation"""
+
+        def slow_statement(conn, cursor, statement, *args):
+            # slow the queries of the page down so that the requests
+            # overlap, the data version of the ETags is read by each one
+            if 'revisions' in statement:
+                return
+            statements.append(threading.get_ident())
+            time.sleep(0.2)
+
+        def get(path, responses):
+            barrier.wait()
+            response = self.client().get(path)
+            responses.append((response.status_code, response.data))
+
+        def get_concurrently(path):
+            responses = []
+            threads = [threading.Thread(target=get, args=(path, responses))
+                       for _ in range(barrier.parties)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return responses
+
+        # warm the category cache and the question totals up
+        path = '/categories/1/questions?fields=id,question,answer'
+        self.client().get('/categories/1/questions?fields=id')
+
+        with self.app.app_context():
+            engine = db.engine
+        statements = []
+        barrier = threading.Barrier(4)
+        event.listen(engine, 'before_cursor_execute', slow_statement)
+        try:
+            responses = get_concurrently(path)
+        finally:
+            event.remove(engine, 'before_cursor_execute', slow_statement)
+
+        # check every request got the same page, queried by a single thread
+        self.assertEqual(len(responses), 4)
+        self.assertEqual({status for status, _ in responses}, {200})
+        self.assertEqual(len({body for _, body in responses}), 1)
+        self.assertEqual(len(set(statements)), 1)
+
+        # check errors are returned to every request
+        responses = get_concurrently('/categories/1000/questions?fields=id')
+        self.assertEqual([status for status, _ in responses], [404] * 4)
+
     def test_get_questions_by_category(self):
         """Tests getting questions by category success"""
 
@@ -232,6 +770,222 @@ class TriviaTestCase(unittest.TestCase):
         # check error message.
         self.assertEqual(data['message'], 'Resource not found')
 
+    def test_category_queries_use_indexes(self):
+        """Tests the category listing and quiz queries scan the indexes"""
+
+        with self.app.app_context():
+            # the queries of the category listing and of a new quiz
+            queries = {
+                'ix_questions_category_id': Question.query.filter(
+                    Question.category == 4).order_by(Question.id).limit(10),
+                'ix_questions_category_difficulty':
+                    Question.query.with_entities(Question.id).filter(
+                        Question.category == 4, Question.difficulty == 2)
+            }
+            connection = db.session.connection()
+            if db.engine.dialect.name == 'postgresql':
+                # the test table is too small for the planner to prefer
+                # the indexes on its own
+                connection.execute(text('SET LOCAL enable_seqscan = off'))
+                explain = 'EXPLAIN '
+            else:
+                explain = 'EXPLAIN QUERY PLAN '
+            for index, query in queries.items():
+                statement = query.statement.compile(
+                    db.engine, compile_kwargs={'literal_binds': True})
+                plan = ' '.join(
+                    str(row[-1]) for row in connection.execute(
+                        text(explain + str(statement))))
+
+                # check the query is answered through the index
+                self.assertIn(index, plan)
+            db.session.rollback()
+
+    def test_stats_follow_writes(self):
+        """Tests the question totals are updated by writes"""
+
+        stats_before = json.loads(self.client().get('/stats').data)
+
+        # create a new question in the Art category
+        response = self.client().post('/questions', json={
+            'question': 'Who painted the Starry Night?',
+            'answer': 'Van Gogh',
+            'difficulty': 2,
+            'category': '2'
+        })
+        data = json.loads(response.data)
+        question_id = data['question_id']
+
+        # check totals returned by the creation and the stats endpoint
+        response = self.client().get('/stats')
+        stats = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['total_questions'],
+                         stats_before['total_questions'] + 1)
+        self.assertEqual(stats['total_questions'], data['total_questions'])
+        self.assertEqual(stats['questions_per_category']['2'],
+                         stats_before['questions_per_category']['2'] + 1)
+        self.assertEqual(stats['questions_per_difficulty']['2'],
+                         stats_before['questions_per_difficulty']['2'] + 1)
+
+        # check totals are back to their previous values after deletion
+        response = self.client().delete(f'/questions/{question_id}')
+        self.assertEqual(json.loads(response.data)['total_question'],
+                         stats_before['total_questions'])
+        stats = json.loads(self.client().get('/stats').data)
+        self.assertEqual(stats, stats_before)
+
+    def test_failing_change_listener(self):
+        """Tests a failing change listener doesn't fail committed writes"""
+
+        # a listener failing before every other one
+        def fail(changes):
+            raise RuntimeError('listener failed')
+        listeners = self.app.extensions['trivia_change_listeners']
+        listeners.insert(0, fail)
+        total = json.loads(self.client().get('/stats').data)[
+            'total_questions']
+
+        # create a question, the failure is logged
+        with self.assertLogs('flaskr', 'ERROR') as logs:
+            response = self.client().post('/questions', json=dict(
+                self.new_question, question='Who built the Great Pyramid?'))
+        data = json.loads(response.data)
+        self.assertIn('listener failed', '\n'.join(logs.output))
+
+        # check the write succeeded and the next listeners ran
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(data['total_questions'], total + 1)
+
+        listeners.remove(fail)
+        self.client().delete(f'/questions/{data["question_id"]}')
+
+    def test_change_feed(self):
+        """Tests the change feed returns the latest change of each row"""
+
+        # read the current revision
+        response = self.client().get('/changes')
+        head = json.loads(response.data)['revision']
+
+        # create, update and delete a question, and create a category
+        question = Question('Which river crosses Baghdad?', 'Tigris', 3, 2)
+        question.insert()
+        question_id = question.id
+        self.client().patch('/questions', json={
+            'ids': [question_id], 'values': {'difficulty': 3}})
+        response = self.client().post('/questions/import', data=json.dumps(
+            {'question': 'Which river crosses Mosul?', 'answer': 'Tigris',
+             'category': 3, 'difficulty': 2}),
+            content_type='application/x-ndjson')
+        self.assertEqual(json.loads(response.data)['imported'], 1)
+        self.client().delete(f'/questions/{question_id}')
+
+        # check the first question is sent once, as a tombstone
+        response = self.client().get(f'/changes?since={head}')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['more'], False)
+        self.assertEqual(len(data['changes']), 2)
+        self.assertEqual(data['changes'][0]['row']['question'],
+                         'Which river crosses Mosul?')
+        self.assertEqual(data['changes'][1], {
+            'revision': data['revision'], 'table': 'questions',
+            'id': question_id, 'op': 'delete', 'row': None})
+
+        # check clients that synced before compacted tombstones must reload
+        result = self.app.test_cli_runner().invoke(
+            args=['compact-changes', '--retention', '0'])
+        self.assertIn('tombstones', result.output)
+        response = self.client().get(f'/changes?since={head}')
+        self.assertEqual(response.status_code, 410)
+        response = self.client().get(f"/changes?since={data['revision']}")
+        self.assertEqual(json.loads(response.data)['changes'], [])
+
+        # delete the imported question
+        self.client().delete(f"/questions/{data['changes'][0]['id']}")
+
+    def test_metrics(self):
+        """Tests request metrics are exposed in the Prometheus format"""
+
+        # load the categories so that only the questions are counted
+        self.client().get('/categories')
+        self.client().get('/categories/1/questions')
+        response = self.client().get('/metrics')
+        metrics = response.data.decode()
+
+        # check status code and the recorded measures
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('trivia_requests_total{endpoint='
+                      '"retrieve_questions_by_category",method="GET",'
+                      'status="200"} 1', metrics)
+        self.assertIn('trivia_request_sql_statements_count{endpoint='
+                      '"retrieve_questions_by_category"} 1', metrics)
+        self.assertNotIn('trivia_request_sql_statements_bucket{endpoint='
+                         '"retrieve_questions_by_category",le="0"} 1',
+                         metrics)
+        # the questions are selected as tuples, not as ORM instances
+        self.assertIn('trivia_request_rows_loaded_sum{endpoint='
+                      '"retrieve_questions_by_category"} 3', metrics)
+
+    def test_request_profiler(self):
+        """Tests requests sending the token are profiled"""
+
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': self.database_path,
+            'QUESTION_SNAPSHOT_PATH': f'{self.snapshot_directory}/questions',
+            'PROFILE_TOKEN': 'secret',
+            'SLOW_QUERY_SECONDS': 0,
+            'REPEATED_STATEMENTS': 1
+        })
+        client = app.test_client()
+        headers = {'X-Profile-Token': 'secret'}
+
+        # only the request sending the token is profiled
+        response = client.get('/questions')
+        self.assertNotIn('X-Profile-Id', response.headers)
+        response = client.get('/questions?page=2', headers=headers)
+        profile_id = response.headers['X-Profile-Id']
+
+        # check the profiles can only be browsed with the token
+        response = client.get('/admin/profiles')
+        self.assertEqual(response.status_code, 403)
+        response = client.get('/admin/profiles', headers=headers)
+        profiles = json.loads(response.data)['profiles']
+        self.assertEqual([profile['id'] for profile in profiles],
+                         [int(profile_id)])
+
+        # check the profile holds the explained statements, the repeated
+        # ones and the report of cProfile
+        response = client.get(f'/admin/profiles/{profile_id}',
+                              headers=headers)
+        profile = json.loads(response.data)['profile']
+        self.assertEqual(profile['path'], '/questions?page=2')
+        self.assertGreater(profile['sql_statements'], 0)
+        self.assertTrue(profile['slow_queries'][0]['plan'])
+        self.assertTrue(profile['repeated_statements'])
+        self.assertIn('retrieve_paginated_questions', profile['profile'])
+
+        # profile a request running a failing statement, and one on an
+        # engine of another app
+        other = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+        with app.test_request_context('/questions', headers=headers):
+            app.preprocess_request()
+            with db.engine.connect() as connection:
+                with self.assertRaises(exc.OperationalError):
+                    connection.execute(text('SELECT * FROM missing'))
+                connection.execute(text('SELECT 1'))
+            with db.get_engine(other).connect() as connection:
+                connection.execute(text('SELECT 2'))
+            response = app.process_response(app.response_class())
+        profile_id = response.headers['X-Profile-Id']
+
+        # check only the statement of the app that succeeded is measured
+        response = client.get(f'/admin/profiles/{profile_id}',
+                              headers=headers)
+        profile = json.loads(response.data)['profile']
+        self.assertEqual(profile['sql_statements'], 1)
+        self.assertEqual(profile['slow_queries'][0]['statement'], 'SELECT 1')
+
     def test_play_quiz_game(self):
         """Tests playing quiz game success"""
 
@@ -260,6 +1014,112 @@ class TriviaTestCase(unittest.TestCase):
         self.assertNotEqual(data['question']['id'], 5)
         self.assertNotEqual(data['question']['id'], 12)
 
+    def test_play_quiz_session_until_exhausted(self):
+        """Tests a quiz session never repeats a question"""
+
+        quiz = {'previous_questions': [],
+                'quiz_category': {'type': 'Science', 'id': 1}}
+        played = []
+        for _ in range(100):
+            response = self.client().post('/quizzes', json=quiz)
+            data = json.loads(response.data)
+
+            # check response status code and the session id.
+            self.assertEqual(response.status_code, 201)
+            self.assertTrue(data['quiz_session'])
+            if 'question' not in data:
+                break
+            played.append(data['question']['id'])
+            quiz['quiz_session'] = data['quiz_session']
+
+        # every question of the category was played exactly once
+        category_questions = Question.query.filter(
+            Question.category == '1').all()
+        self.assertEqual(sorted(played),
+                         sorted(question.id for question in category_questions))
+
+    def test_quiz_of_sparse_category(self):
+        """Tests a category spread over a large id range is played once"""
+
+        # import many Science questions, then one of History, so the ids of
+        # History span the Science ones
+        body = '\n'.join(json.dumps({
+            'question': f'Sparse question {number}?', 'answer': 'Yes',
+            'category': 1, 'difficulty': 1}) for number in range(1000))
+        self.client().post('/questions/import', data=body,
+                           content_type='application/x-ndjson')
+        response = self.client().post('/questions', json=dict(
+            self.new_question, question='When was Cairo founded?',
+            category='4'))
+        question_id = json.loads(response.data)['question_id']
+        with self.app.app_context():
+            history = sorted(question.id for question in
+                             Question.query.filter(Question.category == 4))
+
+        # play History with and without the question snapshot
+        without_snapshot = create_app({
+            'SQLALCHEMY_DATABASE_URI': self.database_path,
+            'QUESTION_SNAPSHOT': False
+        })
+        for client in (self.client(), without_snapshot.test_client()):
+            quiz = {'quiz_category': {'type': 'History', 'id': 4}}
+            played = []
+            while True:
+                data = json.loads(client.post('/quizzes', json=quiz).data)
+                quiz['quiz_session'] = data['quiz_session']
+                if 'question' not in data:
+                    break
+                played.append(data['question']['id'])
+
+            # check every question was played once
+            self.assertEqual(sorted(played), history)
+
+        with self.app.app_context():
+            ids = [question.id for question in Question.query.filter(
+                Question.question.like('Sparse question %'))]
+        self.client().delete('/questions', json={'ids': ids})
+        self.client().delete(f'/questions/{question_id}')
+
+    def test_quiz_token_is_compact_and_signed(self):
+        """Tests the quiz token keeps its size and can't be forged"""
+
+        # play the "All" category without sending the previous questions
+        quiz = {'quiz_category': {'type': 'click', 'id': 0}}
+        played, sizes = [], set()
+        while True:
+            response = self.client().post('/quizzes', json=quiz)
+            data = json.loads(response.data)
+            self.assertEqual(response.status_code, 201)
+            quiz['quiz_session'] = data['quiz_session']
+            sizes.add(len(data['quiz_session']))
+            if 'question' not in data:
+                break
+            played.append(data['question']['id'])
+
+        # check every question was played once with a constant size token
+        self.assertEqual(sorted(played),
+                         sorted(question.id for question in Question.query))
+        self.assertLessEqual(max(sizes) - min(sizes), 4)
+
+        # check the token knows the played questions
+        tokens = self.app.extensions['trivia']['quiz_tokens']
+        state = tokens.loads(quiz['quiz_session'])
+        self.assertTrue(all(state.played(question_id)
+                            for question_id in played))
+
+        # check a token signed with another key starts a new round
+        forged = QuizTokens('another key').dumps(state)
+        self.assertIsNone(tokens.loads(forged))
+        response = self.client().post('/quizzes', json=dict(
+            quiz, quiz_session=forged))
+        self.assertIn('question', json.loads(response.data))
+
+        # check an app without SECRET_KEY warns its tokens are per process
+        if 'SECRET_KEY' not in environment():
+            with self.assertLogs('flaskr', 'WARNING') as logs:
+                create_app({'SQLALCHEMY_DATABASE_URI': self.database_path})
+            self.assertIn('SECRET_KEY is not set', logs.output[0])
+
     def test_play_quiz_fails(self):
         """Tests playing quiz game failure 400"""
 
@@ -274,6 +1134,325 @@ class TriviaTestCase(unittest.TestCase):
         # check error message.
         self.assertEqual(data['message'], 'Bad request')
 
+    def test_play_adaptive_quiz(self):
+        """Tests the adaptive quiz follows the answers and the writes"""
+
+        def play(answers, previous_questions=(), client=None):
+            response = (client or self.client()).post(
+                '/quizzes/adaptive', json={
+                    'quiz_category': {'type': 'Art', 'id': 2},
+                    'previous_questions': list(previous_questions),
+                    'answers': [{'difficulty': difficulty, 'correct': correct}
+                                for difficulty, correct in answers]
+                })
+            return response.status_code, json.loads(response.data)
+
+        # check the first question has the starting difficulty
+        status, data = play([])
+        self.assertEqual(status, 201)
+        self.assertEqual(data['difficulty'], 2)
+        self.assertEqual(data['question']['difficulty'], 2)
+        self.assertEqual(data['question']['category'], 2)
+
+        # check correct answers raise the difficulty and wrong ones lower it
+        status, data = play([(2, True)])
+        self.assertEqual(data['question']['difficulty'], 3)
+        status, data = play([(2, True), (3, False), (3, False)])
+        self.assertEqual(data['question']['difficulty'], 2)
+
+        # check the closest difficulty is played when none is left
+        status, data = play([(4, True)])
+        self.assertEqual(data['difficulty'], 5)
+        self.assertEqual(data['question']['difficulty'], 4)
+
+        # check a new question is drawn as soon as it is created
+        response = self.client().post('/questions', json={
+            'question': 'Which painter cut off part of his left ear?',
+            'answer': 'Van Gogh',
+            'difficulty': 5,
+            'category': '2'
+        })
+        question_id = json.loads(response.data)['question_id']
+        status, data = play([(4, True)])
+        self.assertEqual(data['question']['id'], question_id)
+
+        # check it isn't drawn anymore once deleted
+        self.client().delete(f'/questions/{question_id}')
+        status, data = play([(4, True)])
+        self.assertEqual(data['question']['difficulty'], 4)
+
+        # check the db answers when the snapshot is disabled
+        client = create_app({
+            'SQLALCHEMY_DATABASE_URI': self.database_path,
+            'QUESTION_SNAPSHOT': False
+        }).test_client()
+        status, data = play([(2, True)], client=client)
+        self.assertEqual(data['question']['difficulty'], 3)
+
+        # check a 404 once every question was played, and a 400 on a bad
+        # answer
+        with self.app.app_context():
+            played = [question.id for question in
+                      Question.query.filter(Question.category == 2)]
+        for client in (self.client(), client):
+            status, data = play([], played, client)
+            self.assertEqual(status, 404)
+        status, data = play([(6, True)])
+        self.assertEqual(status, 400)
+
+    def test_play_quiz_round(self):
+        """Tests a quiz round is sampled by a single query"""
+
+        # count the statements run by the round request, once the question
+        # snapshot is built
+        self.client().post('/quizzes/round', json={'quiz_category': {'id': 0}})
+        statements = []
+        with self.app.app_context():
+            engine = db.engine
+
+        def count(*args):
+            statements.append(args[2])
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            response = self.client().post('/quizzes/round', json={
+                'quiz_category': {'id': 0},
+                'difficulties': {'1': 1, '2': 2},
+                'previous_questions': [5]
+            })
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        data = json.loads(response.data)
+
+        # check response status code and the single query.
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(statements), 1)
+        # check the round is made of distinct questions of the mix.
+        ids = [question['id'] for question in data['questions']]
+        self.assertEqual(data['total_questions'], 3)
+        self.assertEqual(len(set(ids)), 3)
+        self.assertNotIn(5, ids)
+        self.assertEqual(sorted(question['difficulty']
+                                for question in data['questions']), [1, 2, 2])
+
+        # check the size of a round is bounded
+        response = self.client().post('/quizzes/round', json={
+            'quiz_category': {'id': 1}, 'size': 1000})
+        self.assertEqual(response.status_code, 400)
+
+    def test_question_snapshot_shared_by_workers(self):
+        """Tests the question snapshot is shared and follows the writes"""
+
+        # another worker maps the snapshot built by the app
+        snapshot = self.app.extensions['trivia']['question_snapshot']
+        worker = QuestionSnapshot(snapshot.path)
+        response = self.client().get('/stats')
+        data = json.loads(response.data)
+        self.assertEqual(sum(worker.counts().values()),
+                         data['total_questions'])
+
+        # add a question through the app, its text differs from the one
+        # created by test_create_new_question
+        response = self.client().post('/questions', json=dict(
+            self.new_question, question='When did the Egyptian revolution '
+                                        '"25th of January" occur?'))
+        question_id = json.loads(response.data)['question_id']
+
+        # check the other worker reads the new generation without the db
+        with self.app.app_context():
+            self.assertEqual(worker.counts()[4, 2],
+                             Question.query.filter_by(category=4,
+                                                      difficulty=2).count())
+        self.assertTrue(worker.contains(4, question_id))
+        self.assertFalse(worker.contains(1, question_id))
+        self.assertIn(question_id, worker.sample(4, 100, mix={2: 100}))
+
+        # check the write was appended to the log, not to a new generation
+        inode = os.stat(snapshot.path).st_ino
+        self.assertGreater(os.path.getsize(snapshot.log_path), 16)
+
+        # check a deleted question leaves the snapshot
+        self.client().delete(f'/questions/{question_id}')
+        self.assertFalse(worker.contains(None, question_id))
+        self.assertEqual(os.stat(snapshot.path).st_ino, inode)
+
+        # check a full log is merged into a new generation
+        snapshot.log_size = 1
+        response = self.client().post('/questions', json=dict(
+            self.new_question, question='Who wrote "The Cairo Trilogy"?'))
+        question_id = json.loads(response.data)['question_id']
+        self.assertNotEqual(os.stat(snapshot.path).st_ino, inode)
+        self.assertEqual(os.path.getsize(snapshot.log_path), 16)
+        self.assertTrue(worker.contains(4, question_id))
+        self.client().delete(f'/questions/{question_id}')
+        self.assertFalse(worker.contains(4, question_id))
+
+        # check a row without difficulty, written outside of the app,
+        # doesn't break the rebuilt snapshot
+        question = Question('Is this difficulty missing?', 'Yes', 4, None)
+        question.insert()
+        rebuilt = QuestionSnapshot(snapshot.path, ttl=0)
+        self.assertEqual(rebuilt.counts()[4, None], 1)
+        self.assertTrue(rebuilt.contains(4, question.id))
+        self.client().delete(f'/questions/{question.id}')
+        self.assertFalse(worker.contains(4, question.id))
+
+        # check the default snapshot is in the instance folder
+        app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path})
+        path = app.extensions['trivia']['question_snapshot'].path
+        self.assertEqual(os.path.dirname(path), app.instance_path)
+
+    def test_read_replica_routing(self):
+        """Tests reads go to a replica unless the client just wrote"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            # the replica is a copy of the SQLite test db, or the db of
+            # TEST_REPLICA_PATH, which isn't replicated
+            replica = dotenv_values('.env').get('TEST_REPLICA_PATH')
+            if replica is None:
+                url = make_url(self.database_path)
+                if url.get_backend_name() != 'sqlite':
+                    self.skipTest('TEST_REPLICA_PATH is not set')
+                shutil.copy(url.database, f'{directory}/replica.db')
+                replica = f'sqlite:///{directory}/replica.db'
+            app = create_app({'SQLALCHEMY_DATABASE_URI': self.database_path,
+                              'DB_REPLICA_URIS': [replica]})
+            writer, reader = app.test_client(), app.test_client()
+
+            # create a question, written to the primary
+            response = writer.post('/questions', json={
+                'question': 'Which planet has the most moons?',
+                'answer': 'Saturn',
+                'difficulty': 3,
+                'category': '1'
+            })
+            question_id = json.loads(response.data)['question_id']
+            sticky = response.headers['Set-Cookie'].split(';')[0]
+            path = f'/questions?after={question_id - 1}'
+
+            # check other clients read from the replica, without the question
+            response = reader.get(path)
+            self.assertEqual(response.status_code, 404)
+
+            # check the writer reads its own write from the primary
+            response = writer.get(path)
+            data = json.loads(response.data)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['questions'][0]['id'], question_id)
+
+            # check a cacheable page read from the replica isn't served to
+            # the writer
+            path = '/categories/1/questions'
+            response = reader.get(path)
+            self.assertNotIn(question_id, [question['id'] for question
+                                           in json.loads(response.data)[
+                                               'questions']])
+            response = writer.get(path)
+            self.assertIn(question_id, [question['id'] for question
+                                        in json.loads(response.data)[
+                                            'questions']])
+
+            # check the ASGI app routes its reads the same way
+            asgi_app = AsyncTrivia(app)
+
+            async def search(cookie):
+                headers = [(b'cookie', cookie.encode())] if cookie else []
+                communicator = ApplicationCommunicator(asgi_app, {
+                    'type': 'http', 'http_version': '1.1', 'method': 'POST',
+                    'path': '/search', 'scheme': 'http',
+                    'server': ('testserver', 80), 'query_string': b'',
+                    'headers': headers})
+                await communicator.send_input({
+                    'type': 'http.request', 'body': json.dumps(
+                        {'searchTerm': 'most moons'}).encode()})
+                start = await communicator.receive_output()
+                await communicator.receive_output()
+                return start['status']
+
+            async def scenario():
+                try:
+                    return await search(None), await search(sticky)
+                finally:
+                    await asgi_app.dispose()
+
+            self.assertEqual(asyncio.run(scenario()), (404, 201))
+
+            writer.delete(f'/questions/{question_id}')
+
+        # check the replicas are picked in turn
+        router = ReplicaRouter(['replica_0', 'replica_1'])
+        self.assertEqual([router.acquire() for _ in range(3)],
+                         ['replica_0', 'replica_1', 'replica_0'])
+
+        # check the replica with the fewest requests in progress is picked
+        router = ReplicaRouter(['replica_0', 'replica_1'],
+                               policy='least_connections')
+        first, second = router.acquire(), router.acquire()
+        self.assertNotEqual(first, second)
+        router.release(first)
+        self.assertEqual(router.acquire(), first)
+
+    def test_asgi_entry_point(self):
+        """Tests the ASGI app answers like the Flask app"""
+
+        asgi_app = AsyncTrivia(self.app)
+
+        async def send(method, path, body=None):
+            communicator = ApplicationCommunicator(asgi_app, {
+                'type': 'http', 'http_version': '1.1', 'method': method,
+                'path': path, 'scheme': 'http', 'server': ('testserver', 80),
+                'query_string': b'', 'headers': []})
+            await communicator.send_input({
+                'type': 'http.request',
+                'body': json.dumps(body).encode() if body else b''})
+            start = await communicator.receive_output()
+            content = b''
+            while True:
+                message = await communicator.receive_output()
+                content += message.get('body', b'')
+                if not message.get('more_body', False):
+                    break
+            return start['status'], json.loads(content)
+
+        async def scenario():
+            try:
+                # play a quiz of the Science category until it is exhausted
+                quiz = {'previous_questions': [],
+                        'quiz_category': {'type': 'Science', 'id': 1}}
+                played = []
+                while True:
+                    status, data = await send('POST', '/quizzes', quiz)
+                    self.assertEqual(status, 201)
+                    quiz['quiz_session'] = data['quiz_session']
+                    if 'question' not in data:
+                        break
+                    played.append(data['question'])
+                # search for a question
+                search = await send('POST', '/search', {'searchTerm': 'What'})
+                # bad quiz requests get the JSON errors of the Flask app
+                error = await send('POST', '/quizzes', {})
+                # other routes are served by the Flask app
+                categories = await send('GET', '/categories')
+                return played, search, error, categories
+            finally:
+                await asgi_app.engine.dispose()
+
+        played, search, error, categories = asyncio.run(scenario())
+
+        # check every question of the category was played once
+        with self.app.app_context():
+            category_questions = Question.query.filter(
+                Question.category == 1).all()
+        self.assertEqual(sorted(question['id'] for question in played),
+                         sorted(question.id for question in category_questions))
+        self.assertTrue(all(question['category'] == 1 for question in played))
+        # check the search results match the Flask app
+        response = self.client().post('/search', json={'searchTerm': 'What'})
+        self.assertEqual(search, (201, json.loads(response.data)))
+        self.assertEqual(error, (400, {'success': False, 'error': 400,
+                                       'message': 'Bad request'}))
+        self.assertEqual(categories[0], 200)
+        self.assertEqual(categories[1]['categories']['1'], 'Science')
+
 
 # Make the tests conveniently executable as a script.
 if __name__ == "__main__":
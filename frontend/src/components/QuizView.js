@@ -10,6 +10,7 @@ class QuizView extends Component {
     super();
     this.state = {
       quizCategory: null,
+      roundQuestions: [],
       previousQuestions: [],
       showAnswer: false,
       categories: {},
@@ -36,27 +37,22 @@ class QuizView extends Component {
   }
 
   selectCategory = ({ type, id = 0 }) => {
-    this.setState({ quizCategory: { type, id } }, this.getNextQuestion);
+    this.setState({ quizCategory: { type, id } }, this.getRound);
   };
 
   handleChange = (event) => {
     this.setState({ [event.target.name]: event.target.value });
   };
 
-  getNextQuestion = () => {
-    const previousQuestions = [...this.state.previousQuestions];
-    if (this.state.currentQuestion.id) {
-      previousQuestions.push(this.state.currentQuestion.id);
-    }
-
+  getRound = () => {
     $.ajax({
-      url: "/quizzes", //TODO: update request URL
+      url: "/quizzes/round",
       type: "POST",
       dataType: "json",
       contentType: "application/json",
       data: JSON.stringify({
-        previous_questions: previousQuestions,
         quiz_category: this.state.quizCategory,
+        size: questionsPerPlay,
       }),
       xhrFields: {
         withCredentials: true,
@@ -65,10 +61,10 @@ class QuizView extends Component {
       success: (result) => {
         this.setState({
           showAnswer: false,
-          previousQuestions: previousQuestions,
-          currentQuestion: result.question,
+          roundQuestions: result.questions,
+          currentQuestion: result.questions[0],
           guess: "",
-          forceEnd: result.question ? false : true,
+          forceEnd: false,
         });
         return;
       },
@@ -77,7 +73,7 @@ class QuizView extends Component {
           alert("Category has no questions!");
           return this.restartGame()
         } else {
-          alert("Unable to load question. Please try your request again");
+          alert("Unable to load questions. Please try your request again");
         }
 
         return;
@@ -85,6 +81,21 @@ class QuizView extends Component {
     });
   };
 
+  getNextQuestion = () => {
+    const previousQuestions = [
+      ...this.state.previousQuestions,
+      this.state.currentQuestion.id,
+    ];
+    const question = this.state.roundQuestions[previousQuestions.length];
+    this.setState({
+      showAnswer: false,
+      previousQuestions: previousQuestions,
+      currentQuestion: question || {},
+      guess: "",
+      forceEnd: question ? false : true,
+    });
+  };
+
   submitGuess = (event) => {
     event.preventDefault();
     let evaluate = this.evaluateAnswer();
@@ -97,6 +108,7 @@ class QuizView extends Component {
   restartGame = () => {
     this.setState({
       quizCategory: null,
+      roundQuestions: [],
       previousQuestions: [],
       showAnswer: false,
       numCorrect: 0,
@@ -1,8 +1,13 @@
 import React, { Component } from 'react'
+import $ from 'jquery';
+
+// Milliseconds without a keystroke before the suggestions are fetched.
+const suggestDelay = 100;
 
 class Search extends Component {
   state = {
     query: '',
+    suggestions: [],
   }
 
   getInfo = (event) => {
@@ -14,6 +19,33 @@ class Search extends Component {
     this.setState({
       query: this.search.value
     })
+    clearTimeout(this.suggestTimer);
+    this.suggestTimer = setTimeout(this.getSuggestions, suggestDelay);
+  }
+
+  getSuggestions = () => {
+    const prefix = this.state.query;
+    if (!prefix) {
+      return this.setState({ suggestions: [] });
+    }
+    $.ajax({
+      url: `/search/suggest?prefix=${encodeURIComponent(prefix)}`,
+      type: "GET",
+      success: (result) => {
+        // Late answers to an older prefix are dropped.
+        if (prefix === this.state.query) {
+          this.setState({ suggestions: result.suggestions });
+        }
+        return;
+      },
+      error: (error) => {
+        return;
+      },
+    });
+  }
+
+  componentWillUnmount() {
+    clearTimeout(this.suggestTimer);
   }
 
   render() {
@@ -23,7 +55,13 @@ class Search extends Component {
           placeholder="Search questions..."
           ref={input => this.search = input}
           onChange={this.handleInputChange}
+          list="search-suggestions"
         />
+        <datalist id="search-suggestions">
+          {this.state.suggestions.map((suggestion) => (
+            <option key={suggestion} value={suggestion} />
+          ))}
+        </datalist>
         <input type="submit" value="Submit" className="button"/>
       </form>
     )